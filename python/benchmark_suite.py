@@ -0,0 +1,432 @@
+#!/bin/env python
+"""Benchmarks of the analysis scripts on synthetic data.
+
+Nothing here needs the LSST stack, a repository or Vizier: `SyntheticButler`
+serves ``src``, ``deepDiff_diaSrc`` and ``forced_src`` catalogs and
+``calexp`` and ``deepDiff_differenceExp`` exposures generated from a
+`SyntheticSky`, and `SyntheticRefcat` serves its UCAC4 stars. The stars appear
+(slightly shifted, as on the real images) in the ``src`` catalogs, and part
+of the DIA sources cluster around them.
+
+Each benchmark runs over the first 1, 8, ... 62 CCDs of a visit and times
+one stage per CCD:
+
+* ``zscale``: `diasource_mosaic.zscale_image` on the calexp.
+* ``mosaic``: cutouts and page compositing for the DIA sources.
+* ``shift_edge``: `match_to_image_sources`, `compute_shift` and
+  `is_edge_object`.
+* ``correlation``: the whole of `star_diffim_correlation`.
+* ``sql``: writing all of the correlations with `BulkCorrelationWriter`
+  (one record per run, not per CCD).
+
+The results are written as a JSON baseline, and can be compared with an
+earlier one to catch regressions::
+
+    python benchmark_suite.py --output benchmark_baseline.json
+    python benchmark_suite.py --compare benchmark_baseline.json
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import platform
+import argparse
+import tempfile
+
+import numpy as np
+
+from refcat_cache import UCAC4_DTYPE, angular_separation
+from stage_timing import StageTimer, stage_report
+
+
+# DECam CCD size (columns, rows) and pixel scale.
+CCD_SHAPE = (2048, 4096)
+PIXEL_SCALE = 0.2632/3600
+
+# CCDs are laid out on an 8 x 8 grid starting at this position (degrees).
+FIELD_ORIGIN = (150.0, 2.0)
+CCD_SPACING = (0.16, 0.31)
+
+BENCHMARKS = ["zscale", "mosaic", "shift_edge", "correlation", "sql"]
+
+
+class SyntheticCatalog(dict):
+    """Columns of a catalog, accessed like an afw SourceCatalog."""
+
+    def get(self, name):
+        return self[name]
+
+    def __len__(self):
+        return len(next(iter(self.values())))
+
+class SyntheticMaskedImage(object):
+
+    def __init__(self, image, mask, variance):
+        self._arrays = (image, mask, variance)
+
+    def getArrays(self):
+        return self._arrays
+
+class SyntheticExposure(object):
+
+    def __init__(self, image, mask, variance):
+        self._masked_image = SyntheticMaskedImage(image, mask, variance)
+
+    def getMaskedImage(self):
+        return self._masked_image
+
+
+class SyntheticSky(object):
+    """Deterministic stars, sources and images for the CCDs of a visit.
+
+    Parameters
+    ----------
+    stars_per_ccd : int
+        UCAC4 stars on each CCD.
+
+    sources_per_ccd : int
+        ``src`` rows per CCD, including the stars.
+
+    dia_sources_per_ccd : int
+        DIA sources per CCD; `clustered_fraction` of them are within an
+        arcminute of a star.
+
+    n_distinct_images : int
+        Number of different pixel arrays generated for each exposure type;
+        CCDs share them, to keep the memory use of a 62 CCD visit low.
+    """
+
+    def __init__(self, stars_per_ccd=150, sources_per_ccd=2000, dia_sources_per_ccd=1000,
+                 clustered_fraction=0.3, n_distinct_images=2, seed=1234):
+        self.stars_per_ccd = stars_per_ccd
+        self.sources_per_ccd = sources_per_ccd
+        self.dia_sources_per_ccd = dia_sources_per_ccd
+        self.clustered_fraction = clustered_fraction
+        self.n_distinct_images = n_distinct_images
+        self.seed = seed
+        self.shift = (0.4/3600, -0.3/3600)
+
+        stars = [self.stars(ccdnum) for ccdnum in range(1, 63)]
+        self.all_stars = np.concatenate(stars)
+        self._images = {}
+        self._mask = np.zeros(CCD_SHAPE[::-1], dtype=np.int32)
+        self._mask[:, :20] = 1
+        self._variance = np.full(CCD_SHAPE[::-1], 100.0, dtype=np.float32)
+
+    def _rng(self, *key):
+        return np.random.RandomState(zlib.crc32(repr((self.seed,) + key).encode()) & 0xffffffff)
+
+    @staticmethod
+    def ccd_center(ccdnum):
+        column, row = (ccdnum - 1) % 8, (ccdnum - 1) // 8
+        return FIELD_ORIGIN[0] + column*CCD_SPACING[0], FIELD_ORIGIN[1] + row*CCD_SPACING[1]
+
+    @classmethod
+    def pixel_to_sky(cls, ccdnum, x, y):
+        """A tangent-plane approximation of the CCD's WCS, in degrees."""
+        ra0, dec0 = cls.ccd_center(ccdnum)
+        dec = dec0 + (np.asarray(y) - CCD_SHAPE[1]/2)*PIXEL_SCALE
+        ra = ra0 + (np.asarray(x) - CCD_SHAPE[0]/2)*PIXEL_SCALE/np.cos(np.radians(dec0))
+        return ra, dec
+
+    def stars(self, ccdnum):
+        rng = self._rng("stars", ccdnum)
+        stars = np.zeros(self.stars_per_ccd, dtype=UCAC4_DTYPE)
+        x, y = rng.rand(self.stars_per_ccd)*CCD_SHAPE[0], rng.rand(self.stars_per_ccd)*CCD_SHAPE[1]
+        stars['RAJ2000'], stars['DEJ2000'] = self.pixel_to_sky(ccdnum, x, y)
+        stars['f.mag'] = 8 + 8*rng.rand(self.stars_per_ccd)
+        stars['a.mag'] = stars['f.mag'] + 0.1*rng.randn(self.stars_per_ccd)
+        return stars
+
+    def src(self, visit, ccdnum):
+        rng = self._rng("src", visit, ccdnum)
+        stars = self.stars(ccdnum)
+        n_other = max(self.sources_per_ccd - len(stars), 0)
+        ra0, dec0 = self.ccd_center(ccdnum)
+        star_x = CCD_SHAPE[0]/2 + (stars['RAJ2000'] + self.shift[0] - ra0)*np.cos(np.radians(dec0))/PIXEL_SCALE
+        star_y = CCD_SHAPE[1]/2 + (stars['DEJ2000'] + self.shift[1] - dec0)/PIXEL_SCALE
+        x = np.concatenate([star_x + 0.1*rng.randn(len(stars)), rng.rand(n_other)*CCD_SHAPE[0]])
+        y = np.concatenate([star_y + 0.1*rng.randn(len(stars)), rng.rand(n_other)*CCD_SHAPE[1]])
+        ra, dec = self.pixel_to_sky(ccdnum, x, y)
+        return SyntheticCatalog(coord_ra=np.radians(ra), coord_dec=np.radians(dec),
+                                base_SdssCentroid_x=x, base_SdssCentroid_y=y)
+
+    def dia_sources(self, visit, ccdnum):
+        """The ``deepDiff_diaSrc`` and ``forced_src`` catalogs of a CCD."""
+        rng = self._rng("dia", visit, ccdnum)
+        n = self.dia_sources_per_ccd
+        x, y = rng.rand(n)*CCD_SHAPE[0], rng.rand(n)*CCD_SHAPE[1]
+        clustered = rng.rand(n) < self.clustered_fraction
+        stars = self.stars(ccdnum)
+        ra0, dec0 = self.ccd_center(ccdnum)
+        near = rng.randint(0, len(stars), np.sum(clustered))
+        radius = 60*rng.rand(np.sum(clustered))**2/0.2632
+        angle = 2*np.pi*rng.rand(np.sum(clustered))
+        x[clustered] = CCD_SHAPE[0]/2 + (stars['RAJ2000'][near] + self.shift[0] - ra0) * \
+            np.cos(np.radians(dec0))/PIXEL_SCALE + radius*np.cos(angle)
+        y[clustered] = CCD_SHAPE[1]/2 + (stars['DEJ2000'][near] + self.shift[1] - dec0)/PIXEL_SCALE + \
+            radius*np.sin(angle)
+        x, y = np.clip(x, 0, CCD_SHAPE[0] - 1), np.clip(y, 0, CCD_SHAPE[1] - 1)
+        ra, dec = self.pixel_to_sky(ccdnum, x, y)
+
+        dia_src = SyntheticCatalog(id=np.arange(n, dtype=np.int64) + 1000000*ccdnum,
+                                   coord_ra=np.radians(ra), coord_dec=np.radians(dec),
+                                   ip_diffim_NaiveDipoleCentroid_x=x, ip_diffim_NaiveDipoleCentroid_y=y,
+                                   classification_dipole=(rng.rand(n) < 0.1).astype(int),
+                                   base_PsfFlux_flux=50*rng.randn(n), base_PsfFlux_fluxSigma=np.full(n, 8.0))
+        science_flux = 10*rng.randn(n) + 40*clustered
+        forced_src = SyntheticCatalog(base_PsfFlux_flux=science_flux,
+                                      base_PsfFlux_fluxSigma=np.full(n, 5.0),
+                                      template_base_PsfFlux_flux=10*rng.randn(n),
+                                      template_base_PsfFlux_fluxSigma=np.full(n, 5.0))
+        return dia_src, forced_src
+
+    def exposure(self, datasetType, ccdnum):
+        key = (datasetType, ccdnum % self.n_distinct_images)
+        if key not in self._images:
+            rng = self._rng("image", *key)
+            image = (10*rng.randn(CCD_SHAPE[1], CCD_SHAPE[0])).astype(np.float32)
+            if datasetType == "calexp":
+                image += 100
+                stars = (rng.rand(200)*CCD_SHAPE[1]).astype(int), (rng.rand(200)*CCD_SHAPE[0]).astype(int)
+                image[stars] += 1e4
+            self._images[key] = image
+        return SyntheticExposure(self._images[key], self._mask, self._variance)
+
+class SyntheticButler(object):
+    """Serves a `SyntheticSky` through the parts of the butler API that the
+    scripts use. Datasets it can not make (e.g. ``calexp_md`` and
+    ``*_filename``) raise RuntimeError, like missing data in a repository.
+    """
+
+    def __init__(self, sky):
+        self.sky = sky
+
+    def get(self, datasetType, dataId=None, immediate=True, **kwargs):
+        dataId = dict(dataId or {}, **kwargs)
+        visit, ccdnum = dataId.get("visit"), dataId.get("ccdnum")
+        if datasetType == "src":
+            return self.sky.src(visit, ccdnum)
+        elif datasetType == "deepDiff_diaSrc":
+            return self.sky.dia_sources(visit, ccdnum)[0]
+        elif datasetType == "forced_src":
+            return self.sky.dia_sources(visit, ccdnum)[1]
+        elif datasetType in ("calexp", "deepDiff_differenceExp"):
+            return self.sky.exposure(datasetType, ccdnum)
+        raise RuntimeError("No synthetic {:s} dataset".format(datasetType))
+
+class SyntheticRefcat(object):
+    """A reference catalog provider for the stars of a `SyntheticSky`."""
+
+    def __init__(self, sky):
+        self.sky = sky
+
+    def query_cone(self, ra, dec, radius):
+        stars = self.sky.all_stars
+        return stars[angular_separation(ra, dec, stars['RAJ2000'], stars['DEJ2000']) <= radius]
+
+
+class Quiet(object):
+    """Silences the progress output of the scripts while they are timed, here
+    and in the benchmarks of the scripts themselves.
+    """
+
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+
+def benchmark_zscale(butler, visit, ccdnums, timer):
+    from diasource_mosaic import zscale_image
+    for ccdnum in ccdnums:
+        image, mask, variance = butler.get("calexp", visit=visit, ccdnum=ccdnum).getMaskedImage().getArrays()
+        with timer.stage("zscale") as stage:
+            zscale_image(image, mask=mask)
+            stage.update(ccdnum=ccdnum, rows=image.size)
+
+def benchmark_mosaic(butler, visit, ccdnums, timer, cutout_size=20, sources_per_page=21, max_pages=12):
+    from diasource_mosaic import extract_source_cutouts, composite_page
+    for ccdnum in ccdnums:
+        dia_src = butler.get("deepDiff_diaSrc", visit=visit, ccdnum=ccdnum)
+        images = [butler.get(datasetType, visit=visit, ccdnum=ccdnum).getMaskedImage().getArrays()[0]
+                  for datasetType in ("calexp", "calexp", "deepDiff_differenceExp")]
+        n_sources = min(len(dia_src), sources_per_page*max_pages)
+        xs = dia_src.get("ip_diffim_NaiveDipoleCentroid_x")[:n_sources]
+        ys = dia_src.get("ip_diffim_NaiveDipoleCentroid_y")[:n_sources]
+        is_dipole = dia_src.get("classification_dipole")[:n_sources] == 1
+        with timer.stage("mosaic") as stage:
+            cutouts = extract_source_cutouts(images[0], images[1], images[2], xs, ys, xs, ys,
+                                             cutout_size=cutout_size)
+            for start in range(0, n_sources, sources_per_page):
+                composite_page(cutouts[start:start + sources_per_page], is_dipole[start:start + sources_per_page],
+                               -30, 30)
+            stage.update(ccdnum=ccdnum, rows=n_sources)
+
+def benchmark_shift_edge(butler, refcat, visit, ccdnums, timer):
+    import astropy.units as u
+    import astropy.coordinates as coord
+    from star_diffim_correlation import match_to_image_sources, compute_shift, is_edge_object
+    for ccdnum in ccdnums:
+        src = butler.get("src", visit=visit, ccdnum=ccdnum)
+        center_ra, center_dec = SyntheticSky.ccd_center(ccdnum)
+        stars = refcat.query_cone(center_ra, center_dec, 0.3)
+        star_catalog = coord.SkyCoord(ra=stars['RAJ2000'], dec=stars['DEJ2000'], unit=(u.deg, u.deg))
+        source_catalog = coord.SkyCoord(ra=src.get('coord_ra'), dec=src.get('coord_dec'), unit=(u.rad, u.rad))
+        with timer.stage("shift_edge") as stage, Quiet():
+            idx, _ = match_to_image_sources(star_catalog, source_catalog)
+            compute_shift(star_catalog, source_catalog, idx=idx)
+            is_edge_object(star_catalog, source_catalog, src.get("base_SdssCentroid_x"),
+                           src.get("base_SdssCentroid_y"), idx=idx)
+            stage.update(ccdnum=ccdnum, rows=len(star_catalog))
+
+def benchmark_correlation(butler, refcat, visit, ccdnums, timer):
+    """Returns the correlations, for `benchmark_sql`."""
+    from star_diffim_correlation import star_diffim_correlation
+    correlations = []
+    for ccdnum in ccdnums:
+        with timer.stage("correlation") as stage, Quiet():
+            correlation = star_diffim_correlation(visit, ccdnum, butler, refcat=refcat, use_wcs=False)
+            stage.update(ccdnum=ccdnum, rows=len(correlation["star_idx"]))
+        correlations.append(correlation)
+    return correlations
+
+def benchmark_sql(correlations, timer):
+    import sqlalchemy
+    from star_diffim_correlation import Base, BulkCorrelationWriter, enable_sqlite_wal, write_correlation
+    work_dir = tempfile.mkdtemp()
+    try:
+        engine = sqlalchemy.create_engine("sqlite:///" + os.path.join(work_dir, "star_diffim.sqlite3"))
+        enable_sqlite_wal(engine)
+        Base.metadata.create_all(engine)
+        with timer.stage("sql") as stage:
+            writer = BulkCorrelationWriter(engine)
+            for correlation in correlations:
+                write_correlation(correlation, writer=writer)
+                writer.add_status(correlation["visit"], correlation["ccdnum"], "ok", 0.0)
+            writer.flush()
+            stage["rows"] = sum(len(correlation["source_mags"]) + len(correlation["star_idx"])
+                                for correlation in correlations)
+        engine.dispose()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def run_benchmark_suite(sizes=(1, 8, 62), benchmarks=BENCHMARKS, visit=197367, **sky_kwargs):
+    """Run the benchmarks on the first `sizes` CCDs of a synthetic visit.
+
+    Returns
+    -------
+    results : list of dict
+        One per benchmark and size: ``benchmark``, ``n_ccds``, the ``total``
+        wall time and its per-CCD ``p50`` and ``p95`` (seconds), and ``rows``.
+    """
+    sky = SyntheticSky(**sky_kwargs)
+    butler = SyntheticButler(sky)
+    refcat = SyntheticRefcat(sky)
+
+    results = []
+    for n_ccds in sizes:
+        ccdnums = range(1, n_ccds + 1)
+        timer = StageTimer(visit=visit, n_ccds=n_ccds)
+        if "zscale" in benchmarks:
+            benchmark_zscale(butler, visit, ccdnums, timer)
+        if "mosaic" in benchmarks:
+            benchmark_mosaic(butler, visit, ccdnums, timer)
+        if "shift_edge" in benchmarks:
+            benchmark_shift_edge(butler, refcat, visit, ccdnums, timer)
+        if "correlation" in benchmarks or "sql" in benchmarks:
+            correlations = benchmark_correlation(butler, refcat, visit, ccdnums, timer)
+            if "sql" in benchmarks:
+                benchmark_sql(correlations, timer)
+
+        for summary in stage_report(timer.records):
+            if summary["stage"] not in benchmarks:
+                continue
+            results.append({"benchmark": summary["stage"], "n_ccds": n_ccds, "total": summary["total"],
+                            "p50": summary["p50"], "p95": summary["p95"], "rows": summary["rows"]})
+    return results
+
+def write_baseline(path, results, config):
+    baseline = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                "numpy": np.__version__, "machine": platform.machine(), "node": platform.node(),
+                "config": config, "results": results}
+    tmp_path = "{:s}.{:d}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def compare_results(results, baseline_results, tolerance=1.25, min_difference=0.01):
+    """Pair up results with a baseline by benchmark and number of CCDs.
+
+    Returns
+    -------
+    comparisons : list of dict
+        ``benchmark``, ``n_ccds``, ``total``, ``baseline`` and ``ratio``, and
+        ``regression``, True if the total is more than `tolerance` times the
+        baseline and at least `min_difference` seconds longer (so that
+        timing noise on the smallest sizes isn't reported).
+    """
+    baseline = dict(((result["benchmark"], result["n_ccds"]), result["total"]) for result in baseline_results)
+    comparisons = []
+    for result in results:
+        key = (result["benchmark"], result["n_ccds"])
+        if key not in baseline:
+            continue
+        ratio = result["total"]/baseline[key] if baseline[key] > 0 else np.inf
+        comparisons.append({"benchmark": key[0], "n_ccds": key[1], "total": result["total"],
+                            "baseline": baseline[key], "ratio": ratio,
+                            "regression": ratio > tolerance and result["total"] - baseline[key] >= min_difference})
+    return comparisons
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 8, 62], help="Numbers of CCDs to run on")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--stars-per-ccd", type=int, default=150)
+    parser.add_argument("--sources-per-ccd", type=int, default=2000)
+    parser.add_argument("--dia-sources-per-ccd", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=None, help="Write the results to this JSON baseline file")
+    parser.add_argument("--compare", default=None, help="Compare the results with this JSON baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Slowdown relative to the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    config = {"sizes": args.sizes, "benchmarks": args.benchmarks, "stars_per_ccd": args.stars_per_ccd,
+              "sources_per_ccd": args.sources_per_ccd, "dia_sources_per_ccd": args.dia_sources_per_ccd,
+              "seed": args.seed}
+    results = run_benchmark_suite(sizes=args.sizes, benchmarks=args.benchmarks,
+                                  stars_per_ccd=args.stars_per_ccd, sources_per_ccd=args.sources_per_ccd,
+                                  dia_sources_per_ccd=args.dia_sources_per_ccd, seed=args.seed)
+
+    print("{:<12s} {:>6s} {:>9s} {:>9s} {:>9s} {:>10s}".format("benchmark", "CCDs", "total s", "p50 s", "p95 s",
+                                                               "rows"))
+    for result in results:
+        print("{:<12s} {:>6d} {:>9.3f} {:>9.4f} {:>9.4f} {:>10d}".format(
+            result["benchmark"], result["n_ccds"], result["total"], result["p50"], result["p95"], result["rows"]))
+
+    if args.output:
+        write_baseline(args.output, results, config)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        other_config = dict((key, value) for key, value in baseline["config"].items() if key != "sizes")
+        if other_config != dict((key, value) for key, value in config.items() if key != "sizes"):
+            print("Warning: baseline was run with a different configuration: {}".format(baseline["config"]))
+        comparisons = compare_results(results, baseline["results"], tolerance=args.tolerance)
+        for comparison in comparisons:
+            print("{:<12s} {:>6d} {:>9.3f} vs {:>9.3f} s ({:.2f}x){:s}".format(
+                comparison["benchmark"], comparison["n_ccds"], comparison["total"], comparison["baseline"],
+                comparison["ratio"], "  REGRESSION" if comparison["regression"] else ""))
+        if any(comparison["regression"] for comparison in comparisons):
+            sys.exit(1)
@@ -0,0 +1,245 @@
+#!/bin/env python
+"""Columnar access to the star/DIA source correlation database.
+
+The ORM helpers on `SourceDetectionCorrelation` (`dist_array`, `SNR_array`)
+load the detections of one star per query. For the radial density analysis
+it is much faster to pull all of the rows matching a filter with a single
+statement into flat numpy arrays, and histogram them all at once::
+
+    engine = sqlalchemy.create_engine('sqlite:///star_diffim.sqlite3')
+    dists = load_detection_dists(engine, max_visit=197801)
+    curves = radial_density_by_mag(dists, radius_bins, [16, 15, 14, 13, 12, 10, 8])
+"""
+from __future__ import print_function, division
+
+import argparse
+import numpy as np
+import sqlalchemy
+
+from star_diffim_correlation import SourceDetectionCorrelation, DetectionDist, CorrelatedCCD, \
+    BulkCorrelationWriter, Base, EXPECTED_DENSITY_COLUMNS
+
+
+class DetectionDistArrays(object):
+    """Star/detection distances for a set of stars, stored as flat arrays.
+
+    The detections of star ``n`` are
+    ``dists[star_offsets[n]:star_offsets[n + 1]]`` (and likewise for `SNRs`).
+
+    Attributes
+    ----------
+    source_ids, visits, ccdnums, source_mags : array
+        One entry per star.
+    star_offsets : array
+        Start of each star's detections in the per-detection arrays, with a
+        final entry equal to the number of detections.
+    dists, SNRs : array
+        One entry per detection; distances are in arcseconds.
+    """
+
+    def __init__(self, source_ids, visits, ccdnums, source_mags, star_offsets, dists, SNRs):
+        self.source_ids = source_ids
+        self.visits = visits
+        self.ccdnums = ccdnums
+        self.source_mags = source_mags
+        self.star_offsets = star_offsets
+        self.dists = dists
+        self.SNRs = SNRs
+
+    def __len__(self):
+        return len(self.source_ids)
+
+    def dist_array(self, n):
+        return self.dists[self.star_offsets[n]:self.star_offsets[n + 1]]
+
+    def SNR_array(self, n):
+        return self.SNRs[self.star_offsets[n]:self.star_offsets[n + 1]]
+
+    def detection_mags(self):
+        """Magnitude of the source star of every detection."""
+        return np.repeat(self.source_mags, np.diff(self.star_offsets))
+
+
+def load_detection_dists(engine, min_visit=None, max_visit=None, min_mag=None, max_mag=None):
+    """Load the detections around all stars matching a filter in one query.
+
+    The filter selects ``min_visit <= visit < max_visit`` and
+    ``min_mag < source_mag < max_mag``; any bound left as None is not applied.
+    Stars without any detections are included.
+
+    Returns
+    -------
+    dists : DetectionDistArrays
+    """
+    sources = SourceDetectionCorrelation.__table__
+    detections = DetectionDist.__table__
+
+    query = (sqlalchemy.select(sources.c.id, sources.c.visit, sources.c.ccdnum, sources.c.source_mag,
+                               detections.c.dist, detections.c.SNR)
+             .select_from(sources.outerjoin(detections, detections.c.source_id == sources.c.id))
+             .order_by(sources.c.id))
+    if min_visit is not None:
+        query = query.where(sources.c.visit >= min_visit)
+    if max_visit is not None:
+        query = query.where(sources.c.visit < max_visit)
+    if min_mag is not None:
+        query = query.where(sources.c.source_mag > min_mag)
+    if max_mag is not None:
+        query = query.where(sources.c.source_mag < max_mag)
+
+    row_dtype = np.dtype([('id', np.int64), ('visit', np.int64), ('ccdnum', np.int64),
+                          ('source_mag', np.float64), ('dist', np.float64), ('SNR', np.float64)])
+    with engine.connect() as conn:
+        result = conn.execute(query)
+        # NULLs (stars without detections, or missing SNRs) become NaN.
+        rows = np.fromiter((tuple(np.nan if x is None else x for x in row) for row in result),
+                           dtype=row_dtype)
+
+    source_ids, first_rows = np.unique(rows['id'], return_index=True)
+    has_detection = np.isfinite(rows['dist'])
+    star_offsets = np.zeros(len(source_ids) + 1, dtype=np.int64)
+    if len(rows) > 0:
+        star_offsets[1:] = np.cumsum(np.add.reduceat(has_detection.astype(np.int64), first_rows))
+
+    return DetectionDistArrays(source_ids, rows['visit'][first_rows], rows['ccdnum'][first_rows],
+                               rows['source_mag'][first_rows], star_offsets,
+                               rows['dist'][has_detection], rows['SNR'][has_detection])
+
+def load_ccd_expectations(engine):
+    """Load the expected star density of every CCD that was correlated with
+    ``--star-density``, to compare with the observed detections around stars.
+
+    Returns
+    -------
+    ccds : structured array
+        ``visit``, ``ccdnum``, and the `EXPECTED_DENSITY_COLUMNS`
+        (``galactic_b``, ``expected_star_density``,
+        ``expected_masked_fraction``) of each CCD with status "ok".
+    """
+    ccds = CorrelatedCCD.__table__
+    query = (sqlalchemy.select(ccds.c.visit, ccds.c.ccdnum,
+                               *[ccds.c[name] for name in EXPECTED_DENSITY_COLUMNS])
+             .where(ccds.c.status == "ok")
+             .where(ccds.c.galactic_b.isnot(None))
+             .order_by(ccds.c.visit, ccds.c.ccdnum))
+    row_dtype = np.dtype([('visit', np.int64), ('ccdnum', np.int64)] +
+                         [(name, np.float64) for name in EXPECTED_DENSITY_COLUMNS])
+    with engine.connect() as conn:
+        return np.fromiter((tuple(row) for row in conn.execute(query)), dtype=row_dtype)
+
+def normalized_radial_histogram(dists, bins):
+    """Mean detection density around the stars in `dists`, per unit area.
+
+    Equivalent to the notebook's `make_normalized_histogram`, but computed
+    with a single histogram over all stars.
+    """
+    H, _ = np.histogram(dists.dists, bins=bins)
+    norm = np.pi*bins[1:]**2 - np.pi*bins[:-1]**2
+    return H/norm/float(len(dists))
+
+def radial_density_by_mag(dists, radius_bins, mag_bins):
+    """Normalized radial histograms for several magnitude bins at once.
+
+    Parameters
+    ----------
+    dists : DetectionDistArrays
+    radius_bins : array
+        Edges of the radial bins, in arcseconds.
+    mag_bins : array
+        Edges of the magnitude bins, in either increasing or decreasing order.
+
+    Returns
+    -------
+    curves : array
+        Shape ``(len(mag_bins) - 1, len(radius_bins) - 1)``, in the order of
+        `mag_bins`.
+    """
+    mag_bins = np.asarray(mag_bins, dtype=float)
+    order = np.argsort(mag_bins)
+    sorted_bins = mag_bins[order]
+
+    H, _, _ = np.histogram2d(dists.detection_mags(), dists.dists, bins=[sorted_bins, radius_bins])
+    nstars, _ = np.histogram(dists.source_mags, bins=sorted_bins)
+    norm = np.pi*radius_bins[1:]**2 - np.pi*radius_bins[:-1]**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curves = H/norm[np.newaxis, :]/nstars[:, np.newaxis].astype(float)
+
+    if order[0] != 0:
+        curves = curves[::-1]
+    return curves
+
+
+def run_histogram_benchmark(n_stars=50000, dists_per_star=20, seed=1234):
+    """Compares the per-star ORM histogramming of the analysis notebook with
+    `load_detection_dists` on a synthetic database of about a million rows.
+    """
+    import os
+    import time
+    import tempfile
+    from sqlalchemy.orm import sessionmaker
+
+    rng = np.random.RandomState(seed)
+    source_mags = 8 + 8*rng.rand(n_stars)
+    star_idx = np.repeat(np.arange(n_stars), dists_per_star)
+    pair_dists = 120*np.sqrt(rng.rand(len(star_idx)))
+    SNRs = 5 + 10*rng.rand(len(star_idx))
+
+    db_dir = tempfile.mkdtemp()
+    engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(db_dir, "benchmark.sqlite3"))
+    Base.metadata.create_all(engine)
+    writer = BulkCorrelationWriter(engine)
+    writer.add_ccd(197367, 10, source_mags, star_idx, pair_dists, SNRs)
+    writer.flush()
+    print("{:d} stars, {:d} distances".format(n_stars, len(star_idx)))
+
+    radius_bins = np.linspace(0, 120, 60)
+    SDC = SourceDetectionCorrelation
+
+    session = sessionmaker(bind=engine)()
+    start = time.time()
+    filtered_query = session.query(SDC).filter((SDC.visit < 197801) & (SDC.source_mag < 14) &
+                                               (SDC.source_mag > 12))
+    H = np.zeros(len(radius_bins) - 1)
+    for source in filtered_query:
+        source_H, _ = np.histogram(source.dist_array(), bins=radius_bins)
+        H += source_H
+    norm = np.pi*radius_bins[1:]**2 - np.pi*radius_bins[:-1]**2
+    orm_H = H/norm/float(filtered_query.count())
+    orm_time = time.time() - start
+    session.close()
+
+    start = time.time()
+    dists = load_detection_dists(engine, max_visit=197801, min_mag=12, max_mag=14)
+    columnar_H = normalized_radial_histogram(dists, radius_bins)
+    columnar_time = time.time() - start
+
+    assert np.allclose(orm_H, columnar_H), "Histograms differ between methods."
+
+    print("Per-star ORM: {:.2f} s".format(orm_time))
+    print("Columnar:     {:.2f} s ({:.1f}x)".format(columnar_time, orm_time/columnar_time))
+
+    os.remove(os.path.join(db_dir, "benchmark.sqlite3"))
+    os.rmdir(db_dir)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action='store_true',
+                        help="Benchmark against per-star ORM histogramming on a synthetic database")
+    parser.add_argument("--database", default="star_diffim.sqlite3", help="Correlation database")
+    parser.add_argument("--max-visit", type=int, default=197801, help="Only use visits before this one")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_histogram_benchmark()
+    else:
+        radius_bins = np.linspace(0, 120, 60)
+        density_bins = [16, 15, 14, 13, 12, 10, 8]
+        engine = sqlalchemy.create_engine('sqlite:///' + args.database)
+        dists = load_detection_dists(engine, max_visit=args.max_visit)
+        curves = radial_density_by_mag(dists, radius_bins, density_bins)
+        print("radius " + " ".join("{:d}-{:d}".format(end, start)
+                                   for start, end in zip(density_bins[:-1], density_bins[1:])))
+        for n, radius in enumerate(0.5*(radius_bins[1:] + radius_bins[:-1])):
+            print("{:.1f} ".format(radius) + " ".join("{:.3g}".format(c) for c in curves[:, n]))
@@ -2,6 +2,8 @@
 
 from __future__ import print_function, division
 
+import os
+import json
 import argparse
 import numpy as np
 import matplotlib
@@ -9,12 +11,47 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
-import lsst.daf.persistence as dafPersist
+from prefetch import prefetch
+from lazy_exposure import LazyExposure
 
 
-def zscale_image(input_img, contrast=0.25):
+ZSCALE_BAD_MASK_PLANES = ["BAD", "SAT", "EDGE", "NO_DATA", "CR", "INTRP"]
+
+def zscale_image(input_img, contrast=0.25, mask=None, bad_mask_bits=~0, n_samples=20000, n_ranks=101):
     """This emulates ds9's zscale feature. Returns the suggested minimum and
-    maximum values to display."""
+    maximum values to display.
+
+    The image is sampled on a strided grid of about `n_samples` pixels without
+    copying it, skipping NaNs and pixels with any of `bad_mask_bits` set in
+    `mask`. Rather than sorting the samples, the line is fit to `n_ranks`
+    order statistics found with a partial sort.
+    """
+    step = max(1, int(np.sqrt(input_img.size/n_samples)))
+    samples = input_img[::step, ::step]
+    good = np.isfinite(samples)
+    if mask is not None:
+        good &= (mask[::step, ::step] & bad_mask_bits) == 0
+    samples = samples[good]
+    if len(samples) == 0:
+        raise ValueError("No unmasked pixels to compute zscale limits from")
+
+    chop_size = int(0.10*len(samples))
+    subset_length = len(samples) - 2*chop_size
+    i_midpoint = int(subset_length/2)
+
+    ranks = np.unique(np.append(np.linspace(0, subset_length - 1, n_ranks).astype(int), i_midpoint))
+    values = np.partition(samples, ranks + chop_size)[ranks + chop_size]
+    I_mid = values[np.searchsorted(ranks, i_midpoint)]
+
+    fit = np.polyfit(ranks - i_midpoint, values, 1)
+    # fit = [ slope, intercept]
+
+    z1 = I_mid + fit[0]/contrast * (1-i_midpoint)/1.0
+    z2 = I_mid + fit[0]/contrast * (subset_length-i_midpoint)/1.0
+    return z1,z2
+
+def _zscale_image_sorted(input_img, contrast=0.25):
+    """The original zscale, kept for comparison in `run_zscale_benchmark`."""
 
     samples = input_img.flatten()[::500]
     samples.sort()
@@ -31,6 +68,66 @@ def zscale_image(input_img, contrast=0.25):
     z2 = I_mid + fit[0]/contrast * (len(subset)-i_midpoint)/1.0
     return z1,z2
 
+def bad_mask_bits(mask, planes=ZSCALE_BAD_MASK_PLANES):
+    """Bitmask of the named planes that are defined for an afw Mask."""
+    plane_dict = mask.getMaskPlaneDict()
+    bits = 0
+    for plane in planes:
+        if plane in plane_dict:
+            bits |= 1 << plane_dict[plane]
+    return bits
+
+def masked_zscale_limits(masked_image, contrast=0.25):
+    """zscale limits of an afw MaskedImage, excluding bad pixels."""
+    img_arr, mask_arr, var_arr = masked_image.getArrays()
+    return zscale_image(img_arr, contrast=contrast, mask=mask_arr,
+                        bad_mask_bits=bad_mask_bits(masked_image.getMask()))
+
+
+class ZscaleCache(object):
+    """Display limits for each exposure, stored in a JSON sidecar file.
+
+    Entries are keyed by dataset type, dataId and the region of the exposure
+    the limits were computed from ("full", or "box1024" for the central 1024
+    pixel square), and are recomputed if the exposure's file has been
+    modified since they were stored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._limits = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._limits = json.load(f)
+
+    @staticmethod
+    def key(datasetType, dataId, region="full"):
+        return " ".join([datasetType, "region=" + region] +
+                        ["{:s}={}".format(k, v) for k, v in sorted(dataId.items())])
+
+    def get_limits(self, butler, datasetType, dataId, compute, region="full"):
+        """Cached (z1, z2) for `region` of an exposure, calling `compute()` on
+        a miss.
+        """
+        key = self.key(datasetType, dataId, region=region)
+        filename = butler.get(datasetType + "_filename", dataId)[0]
+        mtime = os.path.getmtime(filename) if os.path.exists(filename) else None
+
+        entry = self._limits.get(key)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry["z1"], entry["z2"]
+
+        z1, z2 = compute()
+        self._limits[key] = {"z1": float(z1), "z2": float(z2), "mtime": mtime}
+        self.save()
+        return z1, z2
+
+    def save(self):
+        tmp_path = "{:s}.{:d}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self._limits, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
 #
 # This matches up which exposures were differenced against which templates,
 # and is purely specific to this particular set of data.
@@ -42,47 +139,148 @@ template_catalog = {197790:  [197802, 198372, 198376, 198380, 198384],
                     197371:  [197367, 197375, 197379]}
 # Need to invert this to template_visit_catalog[exposure] = template
 template_visit_catalog = {}
-for templateid, visits in template_catalog.iteritems():
+for templateid, visits in template_catalog.items():
     for visit in visits:
         template_visit_catalog[visit] = templateid
 
 def make_cutout(img, x, y, cutout_size=20):
-    return img[(x-cutout_size/2):(x+cutout_size/2),(y-cutout_size/2):(y+cutout_size/2)]
+    return img[int(x-cutout_size/2):int(x+cutout_size/2),int(y-cutout_size/2):int(y+cutout_size/2)]
 
 def group_items(items, group_length):
-    for n in xrange(0, len(items), group_length):
+    for n in range(0, len(items), group_length):
         yield items[n:(n+group_length)]
 
-if __name__ == "__main__":
+def transform_centroids(src_wcs, dst_wcs, xs, ys, order=2, n_grid=6):
+    """Map pixel positions on one image to pixel positions on another.
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("repo_dir", help="Data Repository")
-    parser.add_argument("visitid", type=int)
-    parser.add_argument("--ccdnum", type=int, default=10)
-    args = parser.parse_args()
+    If the Wcs objects support array transforms (`pixelToSkyArray` and
+    `skyToPixelArray`) those are used directly. Otherwise the mapping is
+    evaluated point by point on a coarse `n_grid` x `n_grid` grid spanning the
+    inputs, and a polynomial of the given order is fit to it and applied to
+    all of the positions at once. Between two exposures of the same field
+    this is accurate to well below a pixel.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if len(xs) == 0:
+        return xs.copy(), ys.copy()
 
-    b = dafPersist.Butler(args.repo_dir)
+    if hasattr(src_wcs, "pixelToSkyArray") and hasattr(dst_wcs, "skyToPixelArray"):
+        ra, dec = src_wcs.pixelToSkyArray(xs, ys)
+        return dst_wcs.skyToPixelArray(ra, dec)
 
-    template_visit = template_visit_catalog[args.visitid]
-    templateExposure = b.get("calexp", visit=template_visit, ccdnum=args.ccdnum, immediate=True)
-    template_img,_,_ = templateExposure.getMaskedImage().getArrays()
-    template_wcs = templateExposure.getWcs()
+    grid_x, grid_y = np.meshgrid(np.linspace(xs.min(), xs.max(), n_grid),
+                                 np.linspace(ys.min(), ys.max(), n_grid))
+    grid_x = grid_x.flatten()
+    grid_y = grid_y.flatten()
+    out_x = np.zeros(len(grid_x))
+    out_y = np.zeros(len(grid_y))
+    for n, (x, y) in enumerate(zip(grid_x, grid_y)):
+        xycoord = dst_wcs.skyToPixel(src_wcs.pixelToSky(x, y))
+        out_x[n] = xycoord.getX()
+        out_y[n] = xycoord.getY()
 
-    sourceExposure = b.get("calexp", visit=args.visitid, ccdnum=args.ccdnum, immediate=True)
-    source_img,_,_ = sourceExposure.getMaskedImage().getArrays()
+    def design_matrix(x, y):
+        # Scale to order unity to keep the fit well conditioned.
+        x = (x - grid_x.mean())/max(np.ptp(grid_x), 1.0)
+        y = (y - grid_y.mean())/max(np.ptp(grid_y), 1.0)
+        return np.column_stack([x**i * y**j for i in range(order + 1) for j in range(order + 1 - i)])
 
-    subtractedExposure = b.get("deepDiff_differenceExp", visit=args.visitid, ccdnum=args.ccdnum, immediate=True)
-    subtracted_img,_,_ = subtractedExposure.getMaskedImage().getArrays()
-    subtracted_wcs = subtractedExposure.getWcs()
+    A = design_matrix(grid_x, grid_y)
+    coeff_x = np.linalg.lstsq(A, out_x, rcond=None)[0]
+    coeff_y = np.linalg.lstsq(A, out_y, rcond=None)[0]
+    A_all = design_matrix(xs, ys)
+    return A_all.dot(coeff_x), A_all.dot(coeff_y)
 
-    diaSources = b.get("deepDiff_diaSrc", visit=args.visitid, ccdnum=args.ccdnum, immediate=True)
+def extract_cutouts(img, xs, ys, cutout_size=20, out=None, fill=np.nan):
+    """Extract square cutouts centered on each (x, y) in one indexing operation.
+
+    Pixels that fall off the edge of `img` are set to `fill`.
+
+    Parameters
+    ----------
+    img : 2-d array
+    xs, ys : array
+        Column and row position of each cutout center.
+    out : array, optional
+        Preallocated array of shape (len(xs), cutout_size, cutout_size), or
+        a view into a larger array, to write the cutouts into.
 
-    masked_img = subtractedExposure.getMaskedImage()
-    img_arr, mask_arr, var_arr = masked_img.getArrays()
-    z1, z2 = zscale_image(img_arr)
+    Returns
+    -------
+    out : array
+    """
+    if out is None:
+        out = np.empty((len(xs), cutout_size, cutout_size), dtype=np.float32)
+    offsets = np.arange(cutout_size) - cutout_size//2
+    rows = np.floor(np.asarray(ys)).astype(int)[:, np.newaxis] + offsets
+    cols = np.floor(np.asarray(xs)).astype(int)[:, np.newaxis] + offsets
 
-    cutout_size = 30
+    row_ok = (rows >= 0) & (rows < img.shape[0])
+    col_ok = (cols >= 0) & (cols < img.shape[1])
+    out[:] = img[np.clip(rows, 0, img.shape[0] - 1)[:, :, np.newaxis],
+                 np.clip(cols, 0, img.shape[1] - 1)[:, np.newaxis, :]]
+    out[~(row_ok[:, :, np.newaxis] & col_ok[:, np.newaxis, :])] = fill
+    return out
 
+def extract_source_cutouts(template_img, source_img, subtracted_img, source_xs, source_ys,
+                           template_xs, template_ys, cutout_size=20):
+    """Cutouts of the template, science, and difference images for every
+    source, in an array of shape (N, 3, cutout_size, cutout_size).
+    """
+    cutouts = np.empty((len(source_xs), 3, cutout_size, cutout_size), dtype=np.float32)
+    extract_cutouts(template_img, template_xs, template_ys, cutout_size, out=cutouts[:, 0])
+    extract_cutouts(source_img, source_xs, source_ys, cutout_size, out=cutouts[:, 1])
+    extract_cutouts(subtracted_img, source_xs, source_ys, cutout_size, out=cutouts[:, 2])
+    return cutouts
+
+def composite_page(cutouts, is_dipole, z1, z2, nrows=7, ncols=3, gap=4, zoom=3):
+    """Lay out one page of cutout triplets as a single RGBA image.
+
+    The triplets fill a `nrows` x `ncols` grid in row order, as in the
+    matplotlib mosaic. Dipoles are marked with a red bar to the left of their
+    triplet.
+    """
+    n_sources, n_images, size, _ = cutouts.shape
+    cell_height = size + gap
+    cell_width = n_images*size + gap
+    page = np.ones((nrows*cell_height + gap, ncols*cell_width + gap, 4), dtype=np.float32)
+
+    scaled = plt.cm.gray(np.clip((cutouts - z1)/(z2 - z1), 0, 1))
+    for n in range(n_sources):
+        row = gap + (n // ncols)*cell_height
+        col = gap + (n % ncols)*cell_width
+        # (3, size, size, 4) -> (size, 3*size, 4)
+        page[row:row + size, col:col + n_images*size] = scaled[n].transpose(1, 0, 2, 3).reshape(size, -1, 4)
+        if is_dipole[n]:
+            page[row:row + size, col - gap:col - gap//2] = (1, 0, 0, 1)
+
+    if zoom > 1:
+        page = page.repeat(zoom, axis=0).repeat(zoom, axis=1)
+    return page
+
+def render_mosaic_batch(diaSources, template_img, source_img, subtracted_img, template_wcs, subtracted_wcs,
+                        z1, z2, output_format, cutout_size=20, sources_per_page=21, max_pages=12):
+    """Write mosaic pages with vectorized cutouts and one imsave per page."""
+    source_xs = np.asarray(diaSources.get("ip_diffim_NaiveDipoleCentroid_x"))
+    source_ys = np.asarray(diaSources.get("ip_diffim_NaiveDipoleCentroid_y"))
+    is_dipole = np.asarray(diaSources.get("classification_dipole")) == 1
+
+    n_sources = min(len(source_xs), sources_per_page*max_pages)
+    template_xs, template_ys = transform_centroids(subtracted_wcs, template_wcs,
+                                                   source_xs[:n_sources], source_ys[:n_sources])
+    cutouts = extract_source_cutouts(template_img, source_img, subtracted_img,
+                                     source_xs[:n_sources], source_ys[:n_sources],
+                                     template_xs, template_ys, cutout_size=cutout_size)
+
+    for group_n, start in enumerate(range(0, n_sources, sources_per_page)):
+        end = min(start + sources_per_page, n_sources)
+        page = composite_page(cutouts[start:end], is_dipole[start:end], z1, z2)
+        plt.imsave(output_format.format(group_n), page)
+
+def render_mosaic_matplotlib(diaSources, template_img, source_img, subtracted_img, template_wcs, subtracted_wcs,
+                             z1, z2, output_format, max_pages=12):
+    """Write mosaic pages with one matplotlib axis per cutout."""
     for group_n, source_group in enumerate(group_items(diaSources, 21)):
         plt.figure(1).clear()
         top_level_grid = gridspec.GridSpec(7, 3)
@@ -110,7 +308,261 @@ if __name__ == "__main__":
             if is_dipole:
                 plt.ylabel("Dipole")
 
-        plt.savefig("diasource_mosaic_visit{:d}_ccd{:d}_{:d}.png".format(args.visitid, args.ccdnum, group_n))
-        if group_n > 10:
+        plt.savefig(output_format.format(group_n))
+        if group_n + 1 >= max_pages:
             break
 
+
+def lazy_zscale_limits(exposure, box_size=1024, contrast=0.25):
+    """zscale limits of the central `box_size` square of a `LazyExposure`,
+    excluding bad pixels.
+    """
+    min_x, min_y, max_x, max_y = exposure.bbox
+    x0, y0 = (min_x + max_x)//2 - box_size//2, (min_y + max_y)//2 - box_size//2
+    bbox = (x0, y0, x0 + box_size - 1, y0 + box_size - 1)
+    img_arr, _ = exposure.subarray("image", bbox)
+    mask_arr, _ = exposure.subarray("mask", bbox)
+    return zscale_image(img_arr, contrast=contrast, mask=mask_arr,
+                        bad_mask_bits=exposure.mask_bits(ZSCALE_BAD_MASK_PLANES))
+
+def iter_mosaic_pages(butler, visit, ccdnums, cutout_size=20, sources_per_page=21, zscale_cache=None):
+    """Generate the cutouts of every DIA source in a visit, one page at a time.
+
+    The three exposures of each CCD are opened once as `LazyExposure`s and
+    only the pixels around each source are read from their FITS sections, so
+    the memory needed is one page of cutouts, independent of the number of
+    sources.
+
+    Yields
+    ------
+    visit, ccdnum, page_n : int
+    cutouts : array
+        Shape (n, 3, cutout_size, cutout_size), as from `extract_source_cutouts`.
+    is_dipole : array
+    z1, z2 : float
+        Display limits for the CCD.
+    """
+    for ccdnum in ccdnums:
+        data_id = dict(visit=visit, ccdnum=ccdnum)
+        template_id = dict(visit=template_visit_catalog[visit], ccdnum=ccdnum)
+        try:
+            diaSources = butler.get("deepDiff_diaSrc", data_id, immediate=True)
+        except RuntimeError:
+            print("No diaSources for visit {:d} ccd {:d}".format(visit, ccdnum))
+            continue
+
+        source_xs = np.asarray(diaSources.get("ip_diffim_NaiveDipoleCentroid_x"))
+        source_ys = np.asarray(diaSources.get("ip_diffim_NaiveDipoleCentroid_y"))
+        is_dipole = np.asarray(diaSources.get("classification_dipole")) == 1
+        del diaSources
+
+        template_wcs = butler.get("calexp_wcs", template_id)
+        subtracted_wcs = butler.get("deepDiff_differenceExp_wcs", data_id)
+        template_xs, template_ys = transform_centroids(subtracted_wcs, template_wcs, source_xs, source_ys)
+
+        exposures = [LazyExposure.from_butler(butler, "calexp", template_id, memmap=False),
+                     LazyExposure.from_butler(butler, "calexp", data_id, memmap=False),
+                     LazyExposure.from_butler(butler, "deepDiff_differenceExp", data_id, memmap=False)]
+        compute = lambda: lazy_zscale_limits(exposures[2], box_size=1024)
+        if zscale_cache is not None:
+            z1, z2 = zscale_cache.get_limits(butler, "deepDiff_differenceExp", data_id, compute,
+                                             region="box1024")
+        else:
+            z1, z2 = compute()
+        for page_n, start in enumerate(range(0, len(source_xs), sources_per_page)):
+            page = slice(start, start + sources_per_page)
+            n_sources = len(source_xs[page])
+            cutouts = np.empty((n_sources, 3, cutout_size, cutout_size), dtype=np.float32)
+            exposures[0].cutouts("image", template_xs[page], template_ys[page], cutout_size, out=cutouts[:, 0])
+            exposures[1].cutouts("image", source_xs[page], source_ys[page], cutout_size, out=cutouts[:, 1])
+            exposures[2].cutouts("image", source_xs[page], source_ys[page], cutout_size, out=cutouts[:, 2])
+            yield visit, ccdnum, page_n, cutouts, is_dipole[page], z1, z2
+        for exposure in exposures:
+            exposure.close()
+
+def write_mosaic_stream(butler, visit, ccdnums, output_format, cutout_size=20, prefetch_pages=2,
+                        zscale_cache=None):
+    """Write mosaic pages for every DIA source in a visit, reading the next
+    pages while the current one is rendered.
+
+    `output_format` is formatted with the `visit`, `ccdnum`, and `page`
+    keywords. Returns the number of pages written.
+    """
+    n_pages = 0
+    pages = iter_mosaic_pages(butler, visit, ccdnums, cutout_size=cutout_size, zscale_cache=zscale_cache)
+    for visit, ccdnum, page_n, cutouts, is_dipole, z1, z2 in prefetch(pages, maxsize=prefetch_pages):
+        plt.imsave(output_format.format(visit=visit, ccdnum=ccdnum, page=page_n),
+                   composite_page(cutouts, is_dipole, z1, z2))
+        n_pages += 1
+    return n_pages
+
+
+def run_mosaic_benchmark(n_pages=4, cutout_size=20, seed=1234):
+    """Times the matplotlib and batch mosaic renderers on synthetic images."""
+    import os
+    import time
+    import shutil
+    import tempfile
+
+    class IdentityWcs(object):
+        class Point(object):
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+            def getX(self):
+                return self.x
+            def getY(self):
+                return self.y
+        def pixelToSky(self, x, y):
+            return (x, y)
+        def skyToPixel(self, sky):
+            return self.Point(*sky)
+
+    class SyntheticSources(list):
+        def get(self, name):
+            return np.array([source.get(name) for source in self])
+
+    rng = np.random.RandomState(seed)
+    shape = (4096, 2048)
+    images = [rng.randn(*shape).astype(np.float32) for n in range(3)]
+    n_sources = 21*n_pages
+    sources = SyntheticSources({"ip_diffim_NaiveDipoleCentroid_x": x, "ip_diffim_NaiveDipoleCentroid_y": y,
+                                "classification_dipole": int(rng.rand() < 0.2)}
+                               for x, y in zip(rng.rand(n_sources)*shape[1], rng.rand(n_sources)*shape[0]))
+    wcs = IdentityWcs()
+    output_dir = tempfile.mkdtemp()
+
+    start = time.time()
+    render_mosaic_matplotlib(sources, images[0], images[1], images[2], wcs, wcs, -3, 3,
+                             os.path.join(output_dir, "mpl_{:d}.png"), max_pages=n_pages)
+    mpl_time = time.time() - start
+
+    start = time.time()
+    render_mosaic_batch(sources, images[0], images[1], images[2], wcs, wcs, -3, 3,
+                        os.path.join(output_dir, "batch_{:d}.png"), cutout_size=cutout_size, max_pages=n_pages)
+    batch_time = time.time() - start
+    shutil.rmtree(output_dir)
+
+    print("{:d} pages of {:d} sources".format(n_pages, 21))
+    print("Matplotlib: {:.2f} pages/s".format(n_pages/mpl_time))
+    print("Batch:      {:.2f} pages/s ({:.1f}x)".format(n_pages/batch_time, mpl_time/batch_time))
+
+def run_zscale_benchmark(n_trials=5, seed=1234):
+    """Times `zscale_image` against the original sort-based version on
+    DECam-sized (4096 x 2048) synthetic images.
+    """
+    import time
+
+    rng = np.random.RandomState(seed)
+    shape = (4096, 2048)
+    img = (100 + 10*rng.randn(*shape)).astype(np.float32)
+    stars = (rng.rand(200)*shape[0]).astype(int), (rng.rand(200)*shape[1]).astype(int)
+    img[stars] += 1e4
+    mask = np.zeros(shape, dtype=np.int32)
+    mask[:, :20] = 1
+    img[:, :20] = np.nan
+
+    start = time.time()
+    for n in range(n_trials):
+        sorted_limits = _zscale_image_sorted(np.nan_to_num(img))
+    sorted_time = (time.time() - start)/n_trials
+
+    start = time.time()
+    for n in range(n_trials):
+        limits = zscale_image(img, mask=mask)
+    fast_time = (time.time() - start)/n_trials
+
+    print("zscale on {:d}x{:d}".format(*shape))
+    print("Sorted:  {:.4f} s, limits {:.2f} {:.2f}".format(sorted_time, *sorted_limits))
+    print("Partial: {:.4f} s, limits {:.2f} {:.2f} ({:.1f}x)".format(fast_time, limits[0], limits[1],
+                                                                     sorted_time/fast_time))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("repo_dir", nargs="?", help="Data Repository")
+    parser.add_argument("visitid", nargs="?", type=int)
+    parser.add_argument("--ccdnum", type=int, default=10)
+    parser.add_argument("--batch", action="store_true",
+                        help="Composite each page into one image instead of drawing matplotlib axes")
+    parser.add_argument("--cutout-size", type=int, default=20,
+                        help="Cutout size in --batch and --stream mode, as in the matplotlib mosaic")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write every DIA source of the visit, reading only the pixels around each source")
+    parser.add_argument("--ccd-range", type=int, nargs=2, default=[1, 62], metavar=("FIRST", "LAST"),
+                        help="CCDs to include in --stream mode")
+    parser.add_argument("--prefetch", type=int, default=2, help="Pages to read ahead in --stream mode")
+    parser.add_argument("--zscale-cache", default="diasource_mosaic_zscale.json",
+                        help="JSON file caching the display limits of each exposure (empty to disable)")
+    parser.add_argument("--no-lazy", dest="lazy", action="store_false",
+                        help="Read whole exposures with the butler instead of reading pixels from the exposure "
+                        "files on demand (single CCD mode only)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Benchmark the matplotlib and batch renderers, and zscale, on synthetic data")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_mosaic_benchmark()
+        run_zscale_benchmark()
+        raise SystemExit
+
+    if args.repo_dir is None or args.visitid is None:
+        parser.error("repo_dir and visitid are required")
+
+    import lsst.daf.persistence as dafPersist
+    b = dafPersist.Butler(args.repo_dir)
+
+    zscale_cache = ZscaleCache(args.zscale_cache) if args.zscale_cache else None
+
+    if args.stream:
+        ccdnums = range(args.ccd_range[0], args.ccd_range[1] + 1)
+        output_format = "diasource_mosaic_visit{visit:d}_ccd{ccdnum:d}_{page:d}.png"
+        n_pages = write_mosaic_stream(b, args.visitid, ccdnums, output_format,
+                                      cutout_size=args.cutout_size, prefetch_pages=args.prefetch,
+                                      zscale_cache=zscale_cache)
+        print("Wrote {:d} pages".format(n_pages))
+        raise SystemExit
+
+    template_visit = template_visit_catalog[args.visitid]
+    subtracted_id = dict(visit=args.visitid, ccdnum=args.ccdnum)
+    if args.lazy:
+        # Memory-mapped views of the whole planes; only the pages around the
+        # sources are read.
+        template_id = dict(visit=template_visit, ccdnum=args.ccdnum)
+        template_img = LazyExposure.from_butler(b, "calexp", template_id).array("image")
+        template_wcs = b.get("calexp_wcs", template_id)
+        source_img = LazyExposure.from_butler(b, "calexp", subtracted_id).array("image")
+        subtractedExposure = LazyExposure.from_butler(b, "deepDiff_differenceExp", subtracted_id)
+        subtracted_img = subtractedExposure.array("image")
+        subtracted_wcs = b.get("deepDiff_differenceExp_wcs", subtracted_id)
+        compute = lambda: zscale_image(subtracted_img, mask=subtractedExposure.array("mask"),
+                                       bad_mask_bits=subtractedExposure.mask_bits(ZSCALE_BAD_MASK_PLANES))
+    else:
+        templateExposure = b.get("calexp", visit=template_visit, ccdnum=args.ccdnum, immediate=True)
+        template_img,_,_ = templateExposure.getMaskedImage().getArrays()
+        template_wcs = templateExposure.getWcs()
+
+        sourceExposure = b.get("calexp", visit=args.visitid, ccdnum=args.ccdnum, immediate=True)
+        source_img,_,_ = sourceExposure.getMaskedImage().getArrays()
+
+        subtractedExposure = b.get("deepDiff_differenceExp", visit=args.visitid, ccdnum=args.ccdnum,
+                                   immediate=True)
+        subtracted_img,_,_ = subtractedExposure.getMaskedImage().getArrays()
+        subtracted_wcs = subtractedExposure.getWcs()
+
+        masked_img = subtractedExposure.getMaskedImage()
+        compute = lambda: masked_zscale_limits(masked_img)
+
+    diaSources = b.get("deepDiff_diaSrc", visit=args.visitid, ccdnum=args.ccdnum, immediate=True)
+
+    if zscale_cache is not None:
+        z1, z2 = zscale_cache.get_limits(b, "deepDiff_differenceExp", subtracted_id, compute)
+    else:
+        z1, z2 = compute()
+
+    output_format = "diasource_mosaic_visit{:d}_ccd{:d}_{{:d}}.png".format(args.visitid, args.ccdnum)
+    if args.batch:
+        render_mosaic_batch(diaSources, template_img, source_img, subtracted_img, template_wcs, subtracted_wcs,
+                            z1, z2, output_format, cutout_size=args.cutout_size)
+    else:
+        render_mosaic_matplotlib(diaSources, template_img, source_img, subtracted_img, template_wcs,
+                                 subtracted_wcs, z1, z2, output_format)
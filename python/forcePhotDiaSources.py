@@ -2,17 +2,218 @@
 
 from __future__ import print_function, division
 
+import os
+import time
+import resource
+from collections import OrderedDict
+
+import numpy as np
+
 import lsst
 import lsst.meas.base as measBase
 import lsst.afw.table as afwTable
 import lsst.pipe.base as pipeBase
 
+from run_manifest import RunManifest, dataset_fingerprints, file_fingerprint, files_current, invalidated_units, \
+    plan_units, plan_report
+
+def schemaSourceFile(butler, datasetType):
+    """!The file the schema of a catalog dataset is read from
+
+    @param butler       Butler for the repository
+    @param datasetType  Catalog dataset type, e.g. "deepDiff_diaSrc"
+    @return the path of the "<datasetType>_schema" dataset if it exists, or else of one example catalog
+    """
+    try:
+        filename = butler.get(datasetType + "_schema_filename")[0]
+        if os.path.exists(filename):
+            return filename
+    except (RuntimeError, KeyError):
+        pass
+    visits = butler.queryMetadata(datasetType, "visit")
+    ccds = butler.queryMetadata(datasetType, "ccdnum", visit=visits[0])
+    return butler.get(datasetType + "_filename", visit=visits[0], ccdnum=ccds[0])[0]
+
+def loadRefSchema(butler, datasetType):
+    """!Load the schema of a catalog dataset without reading any catalog rows
+
+    The schema is read from the FITS header of its schemaSourceFile: the
+    "<datasetType>_schema" dataset, or failing that one example catalog.
+
+    @param butler       Butler for the repository
+    @param datasetType  Catalog dataset type, e.g. "deepDiff_diaSrc"
+    @return the catalog Schema
+    """
+    return afwTable.Schema.readFits(schemaSourceFile(butler, datasetType))
+
+def forcedPhotInputs(butler, dataId, templateId, config, previous=None):
+    """!Fingerprints (see run_manifest.py) of the files measured for one DIA source catalog
+
+    @param butler      Butler for the repository
+    @param dataId      Data ID of the DIA source catalog
+    @param templateId  Data ID of its template calexp
+    @param config      Task config; the variance scale table is an input if it is set
+    @param previous    Earlier fingerprints, whose hashes are reused for unchanged files
+    @return dict of fingerprints, None for missing files
+    """
+    inputs = dataset_fingerprints(butler, [("diaSrc", "deepDiff_diaSrc", dataId), ("calexp", "calexp", dataId),
+                                           ("diffim", "deepDiff_differenceExp", dataId),
+                                           ("template", "calexp", templateId)],
+                                  use_hash=config.manifestHash, previous=previous)
+    if config.varianceScaleTable:
+        inputs["varianceScaleTable"] = file_fingerprint(config.varianceScaleTable, use_hash=config.manifestHash,
+                                                        previous=(previous or {}).get("varianceScaleTable"))
+    return inputs
+
+def removeInvalidatedOutputs(butler, config):
+    """!Delete the forced_src outputs of catalogs in config.manifest whose inputs were removed
+
+    The catalogs are also removed from the manifest.
+
+    @param butler  Butler for the repository
+    @param config  Task config
+    @return the number of catalogs invalidated
+    """
+    manifest = RunManifest(config.manifest, use_hash=config.manifestHash)
+    invalidated = invalidated_units(manifest)
+    for dataId in invalidated:
+        try:
+            filename = butler.get("forced_src_filename", dataId)[0]
+        except RuntimeError:
+            filename = None
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+        manifest.remove(dataId)
+    manifest.save()
+    return len(invalidated)
+
+def planForcedPhotReruns(butler, dataRefs, templateExpRef, config):
+    """!Select the data refs whose inputs are new or changed since they were recorded in config.manifest,
+    or whose forced_src output is missing or changed
+
+    Nothing is deleted or written; see removeInvalidatedOutputs.
+
+    @param butler          Butler for the repository
+    @param dataRefs        Data refs of the DIA source catalogs to measure
+    @param templateExpRef  Data refs of the template visit
+    @param config          Task config
+    @return the data refs to measure, and their input fingerprints keyed by RunManifest.key(dataId)
+    """
+    manifest = RunManifest(config.manifest, use_hash=config.manifestHash)
+    refsByKey = OrderedDict((manifest.key(dataRef.dataId), dataRef) for dataRef in dataRefs)
+
+    def fingerprint(dataId, previous):
+        dataRef = refsByKey[manifest.key(dataId)]
+        templateId = ForcedPhotDiaSourcesTask.templateDataId(dataRef, templateExpRef)
+        return forcedPhotInputs(butler, dataRef.dataId, templateId, config, previous=previous)
+
+    def outputsCurrent(dataId, outputs):
+        return files_current(outputs.get("files"), use_hash=config.manifestHash)
+
+    plan = plan_units(manifest, [dataRef.dataId for dataRef in dataRefs], fingerprint,
+                      outputs_current=outputsCurrent)
+    print(plan_report(plan, manifest))
+
+    inputs = dict((manifest.key(dataId), theseInputs) for dataId, theseInputs in plan["new"] + plan["changed"])
+    return [dataRef for key, dataRef in refsByKey.items() if key in inputs], inputs
+
+def formatStageTimes(stageTimes):
+    """!Format the total time of each stage, e.g. "templateRead 1.2 s, scienceMeasurement 3.4 s" """
+    return ", ".join("%s %.1f s" % (name, elapsed) for name, elapsed in stageTimes.items())
+
 class TaskRunnerWithArgs(pipeBase.ButlerInitializedTaskRunner):
+    """!Runs the task on groups of DIA source catalogs that share a template
+
+    Each target is the list of data refs whose template is the same
+    (template visit, ccdnum), so with multiprocessing a whole group goes to
+    one worker and the template is only read once (see
+    ForcedPhotDiaSourcesTask.getTemplateExposure).
+
+    If config.manifest is set, the outputs of catalogs whose inputs were
+    removed are deleted when the runner is run, only data refs whose inputs
+    or outputs changed since the last run are measured (see
+    planForcedPhotReruns), and the inputs and outputs of each measured data
+    ref are returned so the manifest can be updated.
+    """
+
+    def run(self, parsedCmd):
+        """!Remove the outputs invalidated since config.manifest was written, then run the task"""
+        if parsedCmd.config.manifest:
+            nRemoved = removeInvalidatedOutputs(parsedCmd.butler, parsedCmd.config)
+            parsedCmd.log.info("Removed the forced_src outputs of %d invalidated catalogs" % nRemoved)
+        return pipeBase.ButlerInitializedTaskRunner.run(self, parsedCmd)
+
     @staticmethod
     def getTargetList(parsedCmd, **kwargs):
-        return pipeBase.TaskRunner.getTargetList(parsedCmd,
-                                                 templateExpRef=parsedCmd.templateId.refList,
-                                                 **kwargs)
+        templateExpRef = parsedCmd.templateId.refList
+        refList = parsedCmd.id.refList
+        inputs = None
+        if parsedCmd.config.manifest:
+            refList, inputs = planForcedPhotReruns(parsedCmd.butler, refList, templateExpRef, parsedCmd.config)
+
+        groups = OrderedDict()
+        for dataRef in refList:
+            templateId = ForcedPhotDiaSourcesTask.templateDataId(dataRef, templateExpRef)
+            groups.setdefault((templateId['visit'], templateId['ccdnum']), []).append(dataRef)
+
+        kwargs['templateExpRef'] = templateExpRef
+        targets = []
+        for dataRefs in groups.values():
+            groupKwargs = dict(kwargs)
+            if inputs is not None:
+                groupKwargs['manifestInputs'] = [inputs[RunManifest.key(dataRef.dataId)] for dataRef in dataRefs]
+            targets.append((dataRefs, groupKwargs))
+        return targets
+
+    def __call__(self, args):
+        """!Run the task on one group of data refs
+
+        @return a Struct with the template key, the number of data refs and failures, the
+                wall time of the group, the number of template reads and reuses, the total time
+                of each stage of the task (its stageTimes), and the worker's memory high-water
+                mark (in the units of getrusage, kB on Linux) if doReturnResults is set. The memory
+                high-water mark covers the worker's whole lifetime so far, not just this group. With a manifest,
+                `completed` lists the (dataId, inputs, outputs) of every successful data ref, where
+                outputs holds its elapsed time and the fingerprint of its forced_src file.
+        """
+        dataRefs, kwargs = args
+        kwargs = dict(kwargs)
+        manifestInputs = kwargs.pop('manifestInputs', None)
+        task = self.makeTask(args=(dataRefs[0], kwargs))
+        templateId = task.templateDataId(dataRefs[0], kwargs['templateExpRef'])
+        templateKey = (templateId['visit'], templateId['ccdnum'])
+
+        start = time.time()
+        nFailed = 0
+        completed = []
+        for n, dataRef in enumerate(dataRefs):
+            refStart = time.time()
+            if self.doRaise:
+                task.run(dataRef, **kwargs)
+            else:
+                try:
+                    task.run(dataRef, **kwargs)
+                except Exception as e:
+                    nFailed += 1
+                    task.log.fatal("Failed on dataId=%s: %s" % (dataRef.dataId, e))
+                    continue
+            if manifestInputs is not None:
+                outputFingerprint = file_fingerprint(dataRef.get("forced_src_filename")[0],
+                                                     use_hash=self.config.manifestHash)
+                outputs = {"elapsed": time.time() - refStart, "files": {"forced_src": outputFingerprint}}
+                completed.append((dict(dataRef.dataId), manifestInputs[n], outputs))
+        elapsed = time.time() - start
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        task.log.info("Template %s: %d data refs (%d failed) in %.1f s, max RSS %d, template read %d times, "
+                      "reused %d times; %s" % (templateKey, len(dataRefs), nFailed, elapsed, maxRss,
+                                               task.templateReads, task.templateReuses,
+                                               formatStageTimes(task.stageTimes)))
+        if self.doReturnResults:
+            return pipeBase.Struct(templateKey=templateKey, nDataRefs=len(dataRefs), nFailed=nFailed,
+                                   elapsed=elapsed, maxRss=maxRss, completed=completed,
+                                   templateReads=task.templateReads, templateReuses=task.templateReuses,
+                                   stageTimes=dict(task.stageTimes))
 
 class ForcedPhotDiaSourcesConfig(lsst.pex.config.Config):
     """!Config class for forced measurement driver task."""
@@ -21,6 +222,31 @@ class ForcedPhotDiaSourcesConfig(lsst.pex.config.Config):
         target=measBase.ForcedMeasurementTask,
         doc="subtask to do forced measurement"
         )
+    varianceScaleTable = lsst.pex.config.Field(
+        dtype=str,
+        default="",
+        doc="noise_scaling.py table of per-CCD noise; if set, variance planes are scaled by its stddev**2"
+        )
+    manifest = lsst.pex.config.Field(
+        dtype=str,
+        default="",
+        doc="run_manifest.py manifest; if set, only DIA source catalogs whose inputs changed are measured"
+        )
+    manifestHash = lsst.pex.config.Field(
+        dtype=bool,
+        default=False,
+        doc="Compare manifest inputs by content hash, not just size and mtime"
+        )
+    tileRows = lsst.pex.config.Field(
+        dtype=int,
+        default=0,
+        doc="If > 0, read and measure the exposures in bands of this many rows instead of whole"
+        )
+    tileMargin = lsst.pex.config.Field(
+        dtype=int,
+        default=50,
+        doc="Pixels read beyond each band, so that the footprints of sources near its edges are whole"
+        )
     def setDefaults(self):
         # TransformedCentroid takes the centroid from the reference catalog and uses it.
         self.measurement.plugins.names = ["base_TransformedCentroid", "base_PsfFlux"]
@@ -35,58 +261,222 @@ class ForcedPhotDiaSourcesTask(pipeBase.CmdLineTask):
     def __init__(self, butler=None, **kwargs):
         super(lsst.pipe.base.CmdLineTask, self).__init__(**kwargs)
 
-        # We need an example output table from diffim measurement to load.
-        visits = butler.queryMetadata("deepDiff_diaSrc", "visit")
-        ccds = butler.queryMetadata("deepDiff_diaSrc", "ccdnum", visit=visits[0])
-        example_table = butler.get("deepDiff_diaSrc", visit=visits[0], ccdnum=ccds[0])
-
-        self.refSchema = example_table.getSchema()
+        # We need the schema of the output table from diffim measurement.
+        self.refSchema = loadRefSchema(butler, "deepDiff_diaSrc")
         self.makeSubtask("measurement", refSchema=self.refSchema)
         self.dataPrefix = ""
 
+        # The template of the current group of data refs (see
+        # TaskRunnerWithArgs), as ((template visit, ccdnum), exposure).
+        self._template = None
+        self.templateReads = 0
+        self.templateReuses = 0
+        self.stageTimes = OrderedDict()
+
+        self._noiseStddevs = None
+        if self.config.varianceScaleTable:
+            from noise_scaling import read_noise_table
+            self._noiseStddevs = read_noise_table(self.config.varianceScaleTable)
+
+    @staticmethod
+    def templateDataId(diaSourceRef, templateExpRef):
+        """Data ID of the template calexp for the CCD of `diaSourceRef`."""
+        templateId = diaSourceRef.dataId.copy()
+        templateId['visit'] = templateExpRef[0].dataId['visit']
+        return templateId
+
+    def getTemplateExposure(self, butler, templateId):
+        """Load a template calexp, reusing it if it is the one loaded last.
+
+        Many science visits are differenced against the same template, and
+        TaskRunnerWithArgs gives a task all of the data refs of one template
+        in turn, so only that template is kept.
+        """
+        key = (templateId['visit'], templateId['ccdnum'])
+        if self._template is not None and self._template[0] == key:
+            self.templateReuses += 1
+            return self._template[1]
+
+        self._template = None
+        self.templateReads += 1
+        exposure = butler.get("calexp", dataId=templateId)
+        self.scaleVariance(exposure, "calexp", templateId)
+        self._template = (key, exposure)
+        return exposure
+
+    def addStageTime(self, name, elapsed):
+        """Add to the total time of a stage over all data refs, in stageTimes"""
+        self.stageTimes[name] = self.stageTimes.get(name, 0.0) + elapsed
+
+    def scaleVariance(self, exposure, datasetType, dataId):
+        """!Scale the variance plane of an exposure by its measured excess noise
+
+        Does nothing unless config.varianceScaleTable is set. Exposures that
+        are missing from the table are left unscaled, with a warning.
+
+        @param exposure     Exposure to scale in place
+        @param datasetType  Dataset type the exposure was read as, e.g. "calexp"
+        @param dataId       Data ID of the exposure
+        """
+        if self._noiseStddevs is None:
+            return
+        key = (datasetType, dataId['visit'], dataId['ccdnum'])
+        if key not in self._noiseStddevs:
+            self.log.warn("No noise scaling for %s %s; variance not scaled" % (datasetType, dataId))
+            return
+        scale = self._noiseStddevs[key]**2
+        exposure.getMaskedImage().getVariance().getArray()[:] *= scale
+        self.metadata.set("{:s}VarianceScale".format(datasetType), scale)
+
+    def measureExposures(self, refCat, refWcs, exposures):
+        """Run forced measurement of `refCat` on several exposures.
+
+        Footprints are only transformed into the pixel frame of an exposure
+        if it doesn't share that frame with one that was already measured;
+        otherwise the transformed footprints are reused.
+
+        @param refCat     Reference catalog of DIA sources
+        @param refWcs     Wcs of the reference catalog
+        @param exposures  List of (name, exposure, footprintName) tuples, where footprintName
+                          is the name of an earlier exposure on the same pixel grid, or None
+        @return dict of measurement catalogs, keyed by name. The time taken by each stage
+                is added to stageTimes as "<name>Measurement".
+        """
+        measCats = {}
+        for name, exposure, footprintName in exposures:
+            start = time.time()
+            measCat = self.measurement.generateMeasCat(exposure, refCat, refWcs)
+            if footprintName is None:
+                self.measurement.attachTransformedFootprints(measCat, refCat, exposure, refWcs)
+            else:
+                for record, footprintRecord in zip(measCat, measCats[footprintName]):
+                    record.setFootprint(footprintRecord.getFootprint())
+            self.measurement.run(measCat, exposure, refCat, refWcs)
+            measCats[name] = measCat
+
+            elapsed = time.time() - start
+            self.addStageTime("{:s}Measurement".format(name), elapsed)
+            self.log.info("Measured %d sources on %s exposure in %.2f s" % (len(measCat), name, elapsed))
+        return measCats
+
+    def measureInTiles(self, butler, dataId, templateId, refCat, refWcs):
+        """!Run forced measurement of `refCat` band by band, reading only sub-images
+
+        The science CCD is split into bands of config.tileRows rows, and the sources in each band
+        are measured on sub-images of the science, template and difference exposures covering the
+        band and config.tileMargin pixels around it, so only about three bands are in memory at a
+        time instead of three whole exposures. The template sub-image covers the band's corners
+        transformed through the two Wcs. Templates are not cached in this mode.
+
+        @param butler      Butler for the repository
+        @param dataId      Data ID of the science calexp and difference image
+        @param templateId  Data ID of the template calexp
+        @param refCat      Non-empty reference catalog of DIA sources
+        @param refWcs      Wcs of the reference catalog
+        @return dict of measurement catalogs keyed by name, as from measureExposures, in the
+                order of refCat
+        """
+        import lsst.afw.geom as afwGeom
+
+        bbox = butler.get("calexp_bbox", dataId)
+        templateBBox = butler.get("calexp_bbox", templateId)
+        templateWcs = butler.get("calexp_wcs", templateId)
+        margin = self.config.tileMargin
+
+        ys = np.clip(np.nan_to_num(np.asarray(refCat.getY())), bbox.getMinY(), bbox.getMaxY())
+        tileCats = {"science": [], "template": [], "diffim": []}
+        tileIndices = []
+        for y0 in range(bbox.getMinY(), bbox.getMaxY() + 1, self.config.tileRows):
+            y1 = min(y0 + self.config.tileRows - 1, bbox.getMaxY())
+            inTile = (ys >= y0) & (ys < y1 + 1)
+            if not inTile.any():
+                continue
+
+            tileBBox = afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), y0 - margin),
+                                     afwGeom.Point2I(bbox.getMaxX(), y1 + margin))
+            tileBBox.clip(bbox)
+            corners = [templateWcs.skyToPixel(refWcs.pixelToSky(afwGeom.Point2D(x, y)))
+                       for x in (tileBBox.getMinX(), tileBBox.getMaxX())
+                       for y in (tileBBox.getMinY(), tileBBox.getMaxY())]
+            templateTileBBox = afwGeom.Box2I(
+                afwGeom.Point2I(int(np.floor(min(c.getX() for c in corners))) - margin,
+                                int(np.floor(min(c.getY() for c in corners))) - margin),
+                afwGeom.Point2I(int(np.ceil(max(c.getX() for c in corners))) + margin,
+                                int(np.ceil(max(c.getY() for c in corners))) + margin))
+            templateTileBBox.clip(templateBBox)
+
+            exposure = butler.get("calexp_sub", dataId, bbox=tileBBox, immediate=True)
+            self.scaleVariance(exposure, "calexp", dataId)
+            template_exposure = butler.get("calexp_sub", templateId, bbox=templateTileBBox, immediate=True)
+            self.scaleVariance(template_exposure, "calexp", templateId)
+            diffim_exposure = butler.get("deepDiff_differenceExp_sub", dataId, bbox=tileBBox, immediate=True)
+            self.scaleVariance(diffim_exposure, "deepDiff_differenceExp", dataId)
+
+            measCats = self.measureExposures(refCat.subset(inTile), refWcs,
+                                             [("science", exposure, None),
+                                              ("template", template_exposure, None),
+                                              ("diffim", diffim_exposure, "science")])
+            for name in tileCats:
+                tileCats[name].append(measCats[name])
+            tileIndices.append(np.flatnonzero(inTile))
+            del exposure, template_exposure, diffim_exposure
+        self.metadata.set("measurementTiles", len(tileIndices))
+
+        #
+        # Put the records of the bands back into the order of refCat, in
+        # contiguous catalogs so their columns can be read as arrays.
+        #
+        order = np.argsort(np.concatenate(tileIndices))
+        measCats = {}
+        for name, cats in tileCats.items():
+            records = [record for cat in cats for record in cat]
+            measCat = afwTable.SourceCatalog(cats[0].getTable())
+            measCat.reserve(len(records))
+            for n in order:
+                measCat.append(measCat.getTable().copyRecord(records[n]))
+            measCats[name] = measCat
+        return measCats
 
     def run(self, diaSourceRef, templateExpRef=None):
         """ Perform forced photometry on the science and template exposures that went into a DiaSrc.
         """
 
         butler = diaSourceRef.getButler()
-        exposure = butler.get("calexp", dataId=diaSourceRef.dataId)
-        refWcs = exposure.getWcs()
-
         refCat =  diaSourceRef.get() #self.fetchReferences(exposure)
-        measCat = self.measurement.generateMeasCat(exposure, refCat, refWcs)
-
-        #self.log.info("Performing forced measurement on science image %s" % scienceExpRef.dataId)
-
-        self.measurement.attachTransformedFootprints(measCat, refCat, exposure, refWcs)
-        self.measurement.run(measCat, exposure, refCat, refWcs)
+        if self.config.tileRows > 0 and len(refCat) > 0:
+            refWcs = butler.get("calexp_wcs", dataId=diaSourceRef.dataId)
+            measCats = self.measureInTiles(butler, diaSourceRef.dataId,
+                                           self.templateDataId(diaSourceRef, templateExpRef), refCat, refWcs)
+            self.writeMeasurements(diaSourceRef, refCat, measCats)
+            return
 
-        #
-        # Now we rerun measurement on the template exposure.
-        #
-        templateId = diaSourceRef.dataId.copy()
-        #pdb.set_trace()
-        templateId['visit'] = templateExpRef[0].dataId['visit']
-        template_exposure = butler.get("calexp", dataId=templateId)
+        exposure = butler.get("calexp", dataId=diaSourceRef.dataId)
+        self.scaleVariance(exposure, "calexp", diaSourceRef.dataId)
+        refWcs = exposure.getWcs()
 
-        #self.log.info("Performing forced measurement on science image %s" % scienceExpRef.dataId)
-        template_measCat = self.measurement.generateMeasCat(template_exposure,
-                                                            refCat, refWcs)
-        self.measurement.attachTransformedFootprints(template_measCat, refCat,
-                                                     template_exposure, refWcs)
-        self.measurement.run(template_measCat, template_exposure, refCat, refWcs)
+        start = time.time()
+        template_exposure = self.getTemplateExposure(butler, self.templateDataId(diaSourceRef,
+                                                                                 templateExpRef))
+        self.addStageTime("templateRead", time.time() - start)
 
+        diffim_exposure = butler.get("deepDiff_differenceExp", dataId=diaSourceRef.dataId)
+        self.scaleVariance(diffim_exposure, "deepDiff_differenceExp", diaSourceRef.dataId)
 
         #
-        # Measure the diffim
+        # Measure the science, template, and diffim. The diffim is on the
+        # science image's pixel grid, so it can share its footprints.
         #
-        diffim_exposure = butler.get("deepDiff_differenceExp", dataId=diaSourceRef.dataId)
+        measCats = self.measureExposures(refCat, refWcs, [("science", exposure, None),
+                                                          ("template", template_exposure, None),
+                                                          ("diffim", diffim_exposure, "science")])
+        self.writeMeasurements(diaSourceRef, refCat, measCats)
 
-        diffim_measCat = self.measurement.generateMeasCat(diffim_exposure,
-                                                            refCat, refWcs)
-        self.measurement.attachTransformedFootprints(diffim_measCat, refCat,
-                                                     diffim_exposure, refWcs)
-        self.measurement.run(diffim_measCat, diffim_exposure, refCat, refWcs)
+    def writeMeasurements(self, diaSourceRef, refCat, measCats):
+        """!Combine the science, template and diffim measurements into one forced_src table and write it
+        """
+        measCat = measCats["science"]
+        template_measCat = measCats["template"]
+        diffim_measCat = measCats["diffim"]
 
         #
         # Set up a table mapper so we can add the (upcoming) template measurement
@@ -141,5 +531,18 @@ class ForcedPhotDiaSourcesTask(pipeBase.CmdLineTask):
 
 if __name__ == "__main__":
 
-    ForcedPhotDiaSourcesTask.parseAndRun()
+    results = ForcedPhotDiaSourcesTask.parseAndRun(doReturnResults=True)
+    config = results.parsedCmd.config
+    manifest = RunManifest(config.manifest, use_hash=config.manifestHash) if config.manifest else None
+    for result in results.resultList:
+        if result is None:
+            continue
+        print("template {}: {:d} data refs, {:d} failed, {:.1f} s, max RSS {:d}, {:d} template reads; {}".format(
+              result.templateKey, result.nDataRefs, result.nFailed, result.elapsed, result.maxRss,
+              result.templateReads, formatStageTimes(result.stageTimes)))
+        if manifest is not None:
+            for dataId, inputs, outputs in result.completed:
+                manifest.record(dataId, inputs, outputs)
+    if manifest is not None:
+        manifest.save()
 
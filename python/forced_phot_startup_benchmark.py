@@ -0,0 +1,57 @@
+#!/bin/env python
+"""Startup time of ``forcePhotDiaSources.py``.
+
+`ForcedPhotDiaSourcesTask` needs the schema of the ``deepDiff_diaSrc``
+catalogs before it can measure anything. This compares reading a whole
+example catalog for its schema (the old startup path) with reading only its
+header with `forcePhotDiaSources.loadRefSchema`::
+
+    python forced_phot_startup_benchmark.py /path/to/repo
+"""
+from __future__ import print_function, division
+
+import time
+import argparse
+
+from forcePhotDiaSources import ForcedPhotDiaSourcesTask, ForcedPhotDiaSourcesConfig, loadRefSchema
+
+
+def _load_schema_from_catalog(butler, datasetType):
+    """Load the schema of `datasetType` by reading a whole example catalog."""
+    visits = butler.queryMetadata(datasetType, "visit")
+    ccds = butler.queryMetadata(datasetType, "ccdnum", visit=visits[0])
+    return butler.get(datasetType, visit=visits[0], ccdnum=ccds[0]).getSchema()
+
+def run_startup_benchmark(repo, n_trials=3):
+    """Best of `n_trials` times of each way of loading the schema, and of
+    constructing the task.
+    """
+    import lsst.daf.persistence as dafPersist
+
+    butler = dafPersist.Butler(repo)
+
+    def time_it(func):
+        times = []
+        for n in range(n_trials):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        return min(times)
+
+    catalog_time = time_it(lambda: _load_schema_from_catalog(butler, "deepDiff_diaSrc"))
+    schema_time = time_it(lambda: loadRefSchema(butler, "deepDiff_diaSrc"))
+    task_time = time_it(lambda: ForcedPhotDiaSourcesTask(butler=butler, config=ForcedPhotDiaSourcesConfig()))
+
+    print("Schema from full catalog: {:.3f} s".format(catalog_time))
+    print("Schema-only:              {:.3f} s".format(schema_time))
+    print("Task construction:        {:.3f} s".format(task_time))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("repo", help="Repository with deepDiff_diaSrc outputs")
+    parser.add_argument("--trials", type=int, default=3, help="Number of times to run each case")
+    args = parser.parse_args()
+
+    run_startup_benchmark(args.repo, n_trials=args.trials)
@@ -0,0 +1,199 @@
+#!/bin/env python
+"""Forced-photometry filtering of DIA sources.
+
+The "corrected" SNR of a DIA source is the difference of its forced fluxes on
+the science and template images, divided by their combined error,
+``(F_sci - F_tmp)/sqrt(sigma_sci**2 + sigma_tmp**2)``. Sources with
+``|SNR| > 5`` that are not classified as dipoles are the candidates used by
+the rest of the analysis. The kernels here (`corrected_snr`,
+`candidate_mask`, `classify_noise`) work on plain arrays of any length.
+
+For a whole visit, the ``forced_src`` catalogs written by
+``forcePhotDiaSources.py`` and their ``deepDiff_diaSrc`` catalogs are first
+ingested into a `source_store.SourceStore`, and the candidates are written to
+a single file per visit that `star_diffim_correlation.py --candidates-dir`
+reads instead of the catalogs. A second file per visit lists the CCDs that
+were ingested and their number of DIA sources, so that CCDs whose catalogs
+could not be read are not mistaken for CCDs without candidates::
+
+    python forced_src_filter.py /path/to/repo source_store 197367 197388
+"""
+from __future__ import print_function, division
+
+import os
+import argparse
+
+import numpy as np
+
+
+# Store column name: (dataset, catalog column name)
+STORE_COLUMNS = [("id", ("deepDiff_diaSrc", "id")),
+                 ("coord_ra", ("deepDiff_diaSrc", "coord_ra")),
+                 ("coord_dec", ("deepDiff_diaSrc", "coord_dec")),
+                 ("centroid_x", ("deepDiff_diaSrc", "ip_diffim_NaiveDipoleCentroid_x")),
+                 ("centroid_y", ("deepDiff_diaSrc", "ip_diffim_NaiveDipoleCentroid_y")),
+                 ("classification_dipole", ("deepDiff_diaSrc", "classification_dipole")),
+                 ("detection_flux", ("deepDiff_diaSrc", "base_PsfFlux_flux")),
+                 ("detection_fluxSigma", ("deepDiff_diaSrc", "base_PsfFlux_fluxSigma")),
+                 ("science_flux", ("forced_src", "base_PsfFlux_flux")),
+                 ("science_fluxSigma", ("forced_src", "base_PsfFlux_fluxSigma")),
+                 ("template_flux", ("forced_src", "template_base_PsfFlux_flux")),
+                 ("template_fluxSigma", ("forced_src", "template_base_PsfFlux_fluxSigma"))]
+
+STORE_DTYPES = {"ccdnum": np.int32, "id": np.int64, "classification_dipole": np.int8}
+
+CANDIDATE_DTYPE = np.dtype([("ccdnum", np.int32), ("id", np.int64),
+                            ("coord_ra", np.float64), ("coord_dec", np.float64),
+                            ("centroid_x", np.float64), ("centroid_y", np.float64),
+                            ("SNR", np.float64), ("positive_noise", np.bool_), ("negative_noise", np.bool_)])
+
+CCD_DTYPE = np.dtype([("ccdnum", np.int32), ("n_sources", np.int64)])
+
+
+def corrected_snr(science_flux, science_fluxSigma, template_flux, template_fluxSigma):
+    """SNR of the science minus template forced flux."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.asarray(science_flux) - np.asarray(template_flux)) / \
+            np.sqrt(np.asarray(science_fluxSigma)**2 + np.asarray(template_fluxSigma)**2)
+
+def candidate_mask(snr, classification_dipole, threshold=5.0):
+    """Non-dipole sources with a corrected SNR above `threshold` in either sign."""
+    with np.errstate(invalid='ignore'):
+        return (np.abs(snr) > threshold) & (np.asarray(classification_dipole) == 0)
+
+def classify_noise(science_flux, science_fluxSigma, template_flux, template_fluxSigma, threshold=5.0):
+    """Flag significant sources that are not significant on either input image.
+
+    A source is positive noise if its corrected |SNR| is above `threshold`,
+    but its science image SNR is below ``threshold*sqrt(2)`` in magnitude and
+    above its template SNR; negative noise is the same with the science and
+    template images swapped. These are the cuts from the forced photometry
+    notebook.
+
+    Returns
+    -------
+    positive_noise, negative_noise : array of bool
+    """
+    snr = corrected_snr(science_flux, science_fluxSigma, template_flux, template_fluxSigma)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        science_snr = np.asarray(science_flux)/np.asarray(science_fluxSigma)
+        template_snr = np.asarray(template_flux)/np.asarray(template_fluxSigma)
+        significant = np.abs(snr) > threshold
+        positive_noise = significant & (np.abs(science_snr) < threshold*np.sqrt(2)) & (science_snr > template_snr)
+        negative_noise = significant & (np.abs(template_snr) < threshold*np.sqrt(2)) & (science_snr < template_snr)
+    return positive_noise, negative_noise
+
+
+def catalog_columns(diff_src, forced_src):
+    """The store columns of one CCD's diaSrc and forced_src catalogs, which
+    have one row per DIA source in the same order.
+    """
+    assert len(diff_src) == len(forced_src), "diaSrc and forced_src catalog lengths must match."
+    catalogs = {"deepDiff_diaSrc": diff_src, "forced_src": forced_src}
+    return dict((name, np.array(catalogs[dataset].get(column), dtype=STORE_DTYPES.get(name, np.float64)))
+                for name, (dataset, column) in STORE_COLUMNS)
+
+def filter_candidates(columns, threshold=5.0):
+    """Select the candidates from the columns of a store query, in store
+    order.
+
+    Returns
+    -------
+    candidates : array
+        Structured array with `CANDIDATE_DTYPE`.
+    """
+    flux_columns = [columns[name] for name in ("science_flux", "science_fluxSigma",
+                                               "template_flux", "template_fluxSigma")]
+    snr = corrected_snr(*flux_columns)
+    keep, = np.where(candidate_mask(snr, columns["classification_dipole"], threshold=threshold))
+    positive_noise, negative_noise = classify_noise(*flux_columns, threshold=threshold)
+
+    candidates = np.zeros(len(keep), dtype=CANDIDATE_DTYPE)
+    for name in ("ccdnum", "id", "coord_ra", "coord_dec", "centroid_x", "centroid_y"):
+        candidates[name] = columns[name][keep]
+    candidates["SNR"] = snr[keep]
+    candidates["positive_noise"] = positive_noise[keep]
+    candidates["negative_noise"] = negative_noise[keep]
+    return candidates
+
+def candidates_path(candidates_dir, visit):
+    return os.path.join(candidates_dir, "visit{:d}_candidates.npy".format(visit))
+
+def candidate_ccds_path(candidates_dir, visit):
+    return os.path.join(candidates_dir, "visit{:d}_ccds.npy".format(visit))
+
+def write_candidates(candidates_dir, visit, candidates, ccds):
+    """Write the candidates of a visit, and its ingested `ccds` (with
+    `CCD_DTYPE`).
+    """
+    for path, array in [(candidates_path(candidates_dir, visit), candidates),
+                        (candidate_ccds_path(candidates_dir, visit), ccds)]:
+        tmp_path = "{:s}.{:d}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.rename(tmp_path, path)
+
+def load_candidates(candidates_dir, visit, ccdnum=None):
+    """The candidates of a visit, or of one of its CCDs.
+
+    Raises IOError if the visit has not been filtered.
+    """
+    candidates = np.load(candidates_path(candidates_dir, visit), mmap_mode="r")
+    if ccdnum is None:
+        return candidates
+    start, end = np.searchsorted(candidates["ccdnum"], [ccdnum, ccdnum + 1])
+    return candidates[start:end]
+
+def load_candidate_ccds(candidates_dir, visit):
+    """The CCDs of a visit that were ingested, with `CCD_DTYPE`. The
+    candidates of any other CCD are unknown, not empty.
+
+    Raises IOError if the visit has not been filtered.
+    """
+    return np.load(candidate_ccds_path(candidates_dir, visit))
+
+def filter_visit(store, visit, candidates_dir=None, threshold=5.0):
+    """Write the candidate file of a visit from its partitions in a
+    `source_store.SourceStore`.
+
+    Parameters
+    ----------
+    candidates_dir : str, optional
+        Directory for the candidate files; by default the store directory.
+
+    Returns
+    -------
+    n_sources, n_candidates, n_positive_noise, n_negative_noise : int
+    """
+    names = ["ccdnum", "id", "coord_ra", "coord_dec", "centroid_x", "centroid_y", "classification_dipole",
+             "science_flux", "science_fluxSigma", "template_flux", "template_fluxSigma"]
+    columns = store.query(names, visits=[visit])
+    candidates = filter_candidates(columns, threshold=threshold)
+    ccds = np.array(store.visit_ccds(visit), dtype=CCD_DTYPE)
+    write_candidates(candidates_dir or store.store_dir, visit, candidates, ccds)
+    return (len(columns["id"]), len(candidates),
+            int(np.sum(candidates["positive_noise"])), int(np.sum(candidates["negative_noise"])))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("repo", help="Repository with forced_src outputs")
+    parser.add_argument("store_dir", help="source_store.py column store, which also holds the candidate files")
+    parser.add_argument("visits", help="VisitIDs to process", type=int, nargs="+")
+    parser.add_argument("--nccds", help="Number of CCDs per visit", type=int, default=62)
+    parser.add_argument("--threshold", help="Corrected SNR threshold", type=float, default=5.0)
+    parser.add_argument("--skip-ingest", action="store_true",
+                        help="Filter visits already in the store, without reading the catalogs again")
+    args = parser.parse_args()
+
+    from source_store import SourceStore
+    store = SourceStore(args.store_dir)
+    if not args.skip_ingest:
+        import lsst.daf.persistence as dafPersist
+        store.ingest(dafPersist.Butler(args.repo), args.visits, range(1, args.nccds + 1))
+
+    for visit in args.visits:
+        n_sources, n_candidates, n_positive, n_negative = filter_visit(store, visit, threshold=args.threshold)
+        print("visit {:d}: {:d} sources, {:d} candidates, {:d} positive noise, "
+              "{:d} negative noise".format(visit, n_sources, n_candidates, n_positive, n_negative))
@@ -0,0 +1,262 @@
+#!/bin/env python
+"""Lazy, region-at-a-time access to the pixels of an exposure FITS file.
+
+A ``calexp`` or ``deepDiff_differenceExp`` file holds the image, mask and
+variance planes in three HDUs. Reading it through the butler materializes
+all three full frames (about 100 MB for a DECam CCD), even when only a few
+hundred 30 pixel cutouts are needed. `LazyExposure` opens the file without
+reading any pixels, and returns NumPy arrays for any bounding box:
+
+* For uncompressed HDUs opened with ``memmap=True`` (the default), the
+  arrays are views of a memory map of the file, so only the pages that are
+  touched are read. These pages are clean page cache: they count towards
+  RSS while the file is open, but the kernel can drop them at any time.
+  Cutouts scattered over a CCD touch most pages of it.
+* Otherwise (tile-compressed HDUs, or ``memmap=False``), only the rows or
+  compression tiles overlapping the box are read and decompressed, into a
+  new array. This keeps the RSS of cutout readers to a few MB.
+
+Bounding boxes are in the parent pixel coordinates of the exposure (offset by
+its ``LTV1``/``LTV2`` origin), inclusive, given either as
+``(min_x, min_y, max_x, max_y)`` or as an ``lsst.afw.geom.Box2I``.
+
+The peak memory of reading cutouts this way, compared with reading the whole
+exposure, is measured by::
+
+    python lazy_exposure.py --benchmark
+"""
+from __future__ import print_function, division
+
+import os
+import argparse
+
+import numpy as np
+from astropy.io import fits
+
+
+PLANES = ("image", "mask", "variance")
+
+
+def _bbox_bounds(bbox):
+    if hasattr(bbox, "getMinX"):
+        return bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()
+    return tuple(int(value) for value in bbox)
+
+class LazyExposure(object):
+    """The image, mask and variance planes of an exposure FITS file, read on
+    demand.
+
+    Parameters
+    ----------
+    path : str
+        FITS file with the image, mask and variance HDUs. They are found by
+        their ``EXTTYPE`` or ``EXTNAME``, or else taken to be HDUs 1 to 3.
+
+    memmap : bool
+        Memory-map uncompressed HDUs.
+    """
+
+    def __init__(self, path, memmap=True):
+        self.path = path
+        self._fits = fits.open(path, memmap=memmap, lazy_load_hdus=True)
+        self._memmap = memmap
+
+        extensions = list(self._fits)[1:]
+        self._hdus = {}
+        for hdu in extensions:
+            plane = str(hdu.header.get("EXTTYPE", hdu.name)).lower()
+            if plane in PLANES:
+                self._hdus[plane] = hdu
+        if len(self._hdus) != len(PLANES):
+            self._hdus = dict(zip(PLANES, extensions))
+
+        header = self._hdus["image"].header
+        self.width, self.height = header["NAXIS1"], header["NAXIS2"]
+        self.x0, self.y0 = -int(header.get("LTV1", 0)), -int(header.get("LTV2", 0))
+
+    @classmethod
+    def from_butler(cls, butler, datasetType, dataId, memmap=True):
+        return cls(butler.get(datasetType + "_filename", dataId)[0], memmap=memmap)
+
+    @property
+    def bbox(self):
+        return self.x0, self.y0, self.x0 + self.width - 1, self.y0 + self.height - 1
+
+    def is_memmapped(self, plane="image"):
+        """Whether arrays of `plane` are views of a memory map of the file."""
+        hdu = self._hdus[plane]
+        return self._memmap and not isinstance(hdu, fits.CompImageHDU) and \
+            hdu.header.get("BZERO", 0) == 0 and hdu.header.get("BSCALE", 1) == 1
+
+    def array(self, plane="image"):
+        """The whole plane. Only lazy if it `is_memmapped`."""
+        return self._hdus[plane].data
+
+    def subarray(self, plane, bbox):
+        """The pixels of `plane` in `bbox`, which is clipped to the exposure.
+
+        Returns
+        -------
+        array : 2-d array
+            Rows are y and columns x; a view if the plane `is_memmapped`.
+        bbox : tuple
+            The clipped (min_x, min_y, max_x, max_y) of `array`.
+        """
+        min_x, min_y, max_x, max_y = _bbox_bounds(bbox)
+        min_x, min_y = max(min_x, self.x0), max(min_y, self.y0)
+        max_x, max_y = min(max_x, self.x0 + self.width - 1), min(max_y, self.y0 + self.height - 1)
+        rows = slice(min_y - self.y0, max(max_y - self.y0 + 1, min_y - self.y0))
+        cols = slice(min_x - self.x0, max(max_x - self.x0 + 1, min_x - self.x0))
+        if self.is_memmapped(plane):
+            return self._hdus[plane].data[rows, cols], (min_x, min_y, max_x, max_y)
+        return self._hdus[plane].section[rows, cols], (min_x, min_y, max_x, max_y)
+
+    def cutouts(self, plane, xs, ys, cutout_size=20, out=None, fill=np.nan):
+        """Square cutouts of `plane` centered on each (x, y), in parent
+        coordinates, as from `diasource_mosaic.extract_cutouts`. Pixels off
+        the edge of the exposure are set to `fill`.
+        """
+        xs, ys = np.asarray(xs) - self.x0, np.asarray(ys) - self.y0
+        if self.is_memmapped(plane):
+            from diasource_mosaic import extract_cutouts
+            return extract_cutouts(self._hdus[plane].data, xs, ys, cutout_size=cutout_size, out=out, fill=fill)
+
+        if out is None:
+            out = np.empty((len(xs), cutout_size, cutout_size), dtype=np.float32)
+        section = self._hdus[plane].section
+        for n, (x, y) in enumerate(zip(xs, ys)):
+            col0 = int(np.floor(x)) - cutout_size//2
+            row0 = int(np.floor(y)) - cutout_size//2
+            rows = slice(max(row0, 0), min(row0 + cutout_size, self.height))
+            cols = slice(max(col0, 0), min(col0 + cutout_size, self.width))
+            out[n] = fill
+            if rows.start < rows.stop and cols.start < cols.stop:
+                out[n, (rows.start - row0):(rows.stop - row0), (cols.start - col0):(cols.stop - col0)] = \
+                    section[rows, cols]
+        return out
+
+    def mask_plane_dict(self):
+        """Mask plane bit numbers, from the ``MP_`` keywords of the mask header."""
+        header = self._hdus["mask"].header
+        return dict((key[3:], header[key]) for key in header if key.startswith("MP_"))
+
+    def mask_bits(self, planes):
+        """Bitmask of the named mask planes that are defined."""
+        plane_dict = self.mask_plane_dict()
+        bits = 0
+        for plane in planes:
+            if plane in plane_dict:
+                bits |= 1 << plane_dict[plane]
+        return bits
+
+    def close(self):
+        self._fits.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_synthetic_exposure(path, shape=(4096, 2048), compress=False, seed=1234):
+    """Write a DECam-sized exposure with the layout of an afw FITS file."""
+    rng = np.random.RandomState(seed)
+    image = (100 + 10*rng.randn(*shape)).astype(np.float32)
+    mask = np.zeros(shape, dtype=np.int32)
+    mask[:, :20] = 1 << 4
+    variance = np.full(shape, 100.0, dtype=np.float32)
+
+    hdus = [fits.PrimaryHDU()]
+    for plane, data in zip(PLANES, (image, mask, variance)):
+        header = fits.Header([("EXTTYPE", plane.upper()), ("LTV1", -0), ("LTV2", -0)])
+        if plane == "mask":
+            header.update([("MP_BAD", 0), ("MP_SAT", 1), ("MP_CR", 3), ("MP_EDGE", 4)])
+        if compress:
+            hdus.append(fits.CompImageHDU(data, header=header, compression_type="RICE_1" if plane == "mask"
+                                          else "GZIP_2", quantize_level=0 if plane != "mask" else None))
+        else:
+            hdus.append(fits.ImageHDU(data, header=header))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+def _memory_status():
+    """Peak and current anonymous and file-backed RSS, in MB, from /proc."""
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmHWM", "RssAnon", "RssFile"):
+                status[key] = int(value.split()[0])/1024
+    return status
+
+def _measure_cutouts(path, mode, n_sources, cutout_size, queue):
+    before = _memory_status()
+    rng = np.random.RandomState(0)
+    xs, ys = rng.rand(n_sources)*2048, rng.rand(n_sources)*4096
+    cutouts = np.empty((n_sources, 3, cutout_size, cutout_size), dtype=np.float32)
+    if mode == "full":
+        with fits.open(path, memmap=False) as hdus:
+            from diasource_mosaic import extract_cutouts
+            planes = [hdu.data for hdu in hdus[1:4]]
+            for n in range(3):
+                extract_cutouts(planes[n], xs, ys, cutout_size, out=cutouts[:, n])
+            after = _memory_status()
+    else:
+        with LazyExposure(path, memmap=(mode == "memmap")) as exposure:
+            for n, plane in enumerate(PLANES):
+                exposure.cutouts(plane, xs, ys, cutout_size, out=cutouts[:, n])
+            after = _memory_status()
+    queue.put({"peak": after["VmHWM"] - before["VmHWM"], "anon": after["RssAnon"] - before["RssAnon"],
+               "file": after["RssFile"] - before["RssFile"]})
+
+def run_memory_benchmark(n_sources=252, cutout_size=30):
+    """Peak RSS of reading cutouts from all three planes of a DECam-sized
+    exposure: whole planes as the butler reads them, memory-mapped views,
+    and section reads of uncompressed and tile-compressed files. Each case
+    runs in a fresh process.
+    """
+    import time
+    import shutil
+    import tempfile
+    import multiprocessing
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        plain_path = os.path.join(work_dir, "calexp.fits")
+        compressed_path = os.path.join(work_dir, "calexp_compressed.fits")
+        write_synthetic_exposure(plain_path)
+        write_synthetic_exposure(compressed_path, compress=True)
+
+        print("{:d} cutouts of {:d} pixels from 3 planes of 4096x2048".format(n_sources, cutout_size))
+        print("{:<26s} {:>8s} {:>12s} {:>12s} {:>8s}".format("", "time s", "peak RSS MB", "anon RSS MB",
+                                                              "file MB"))
+        for name, path, mode in [("Full planes", plain_path, "full"),
+                                 ("Lazy, memory-mapped", plain_path, "memmap"),
+                                 ("Lazy, sections", plain_path, "sections"),
+                                 ("Lazy, compressed sections", compressed_path, "sections")]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_measure_cutouts,
+                                              args=(path, mode, n_sources, cutout_size, queue))
+            start = time.time()
+            process.start()
+            memory = queue.get()
+            process.join()
+            print("{:<26s} {:>8.2f} {:>12.1f} {:>12.1f} {:>8.1f}".format(name, time.time() - start,
+                                                                         memory["peak"], memory["anon"],
+                                                                         memory["file"]))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Measure the peak memory of cutouts from whole and lazily read exposures")
+    parser.add_argument("--n-sources", type=int, default=252, help="Number of cutouts in the benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_memory_benchmark(n_sources=args.n_sources)
+    else:
+        parser.print_help()
@@ -0,0 +1,254 @@
+#!/bin/env python
+"""Per-CCD noise scaling statistics.
+
+The noise analysis notebook found that the pixel values of the Decam images
+scatter more than their variance planes say. This measures that excess for
+every CCD of a repository: the sigma-clipped mean and standard deviation of
+``image/sqrt(variance)`` over pixels without any of the `NOISE_MASK_PLANES`
+set. A standard deviation of 1.1 means the variance plane should be scaled by
+1.1**2.
+
+The statistics are accumulated in one pass over horizontal tiles of the
+image, in preallocated buffers, so no full-frame temporary arrays are made.
+CCDs are processed in parallel worker processes, and the results are written
+to a CSV table that ``forcePhotDiaSources.py`` can use to rescale the
+variance planes before measurement (``config.varianceScaleTable``)::
+
+    python noise_scaling.py /path/to/repo noise_scaling.csv 197367 197388 -j 8
+"""
+from __future__ import print_function, division
+
+import os
+import csv
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+
+NOISE_MASK_PLANES = ["INTRP", "EDGE", "DETECTED", "BAD", "NO_DATA", "DETECTED_NEGATIVE"]
+
+NOISE_TABLE_COLUMNS = ["datasetType", "visit", "ccdnum", "n_pixels", "mean", "stddev"]
+
+
+def mask_plane_bits(mask, planes=NOISE_MASK_PLANES):
+    """Bitmask of the named planes that are defined for an afw Mask."""
+    plane_dict = mask.getMaskPlaneDict()
+    bits = 0
+    for plane in planes:
+        if plane in plane_dict:
+            bits |= 1 << plane_dict[plane]
+    return bits
+
+def clipped_noise_statistics(image, mask, variance, bad_mask_bits, n_sigma=5.0, n_iter=3, tile_rows=256,
+                             bin_width=0.002, bin_range=25.0):
+    """Sigma-clipped mean and standard deviation of ``image/sqrt(variance)``.
+
+    Pixels with any of `bad_mask_bits` set, or with a non-positive or
+    non-finite variance, are excluded.
+
+    The image is read once, in `tile_rows`-row tiles. The normalized values
+    are binned (`bin_width` wide over +/- `bin_range`, plus an underflow and
+    an overflow bin), keeping the count, sum and sum of squares of each bin,
+    and the clipping iterations are then done on the bins: a bin is kept if
+    the mean of its values is within the clipping bounds. The result differs
+    from clipping individual pixels only through the bins that straddle a
+    bound.
+
+    Returns
+    -------
+    mean, stddev : float
+    n_pixels : int
+        Number of pixels left after the final clipping.
+    """
+    height, width = image.shape
+    tile_rows = min(tile_rows, height)
+    n_bins = int(np.ceil(2*bin_range/bin_width)) + 2
+    counts = np.zeros(n_bins)
+    sums = np.zeros(n_bins)
+    sum_squares = np.zeros(n_bins)
+
+    normalized = np.empty((tile_rows, width), dtype=np.float64)
+    scratch = np.empty((tile_rows, width), dtype=np.float64)
+    bin_idx = np.empty((tile_rows, width), dtype=np.intp)
+    good = np.empty((tile_rows, width), dtype=bool)
+    for row in range(0, height, tile_rows):
+        rows = min(tile_rows, height - row)
+        z, tmp, idx, ok = [buf[:rows] for buf in (normalized, scratch, bin_idx, good)]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.sqrt(variance[row:row + rows], out=tmp)
+            np.divide(image[row:row + rows], tmp, out=z)
+        np.isfinite(z, out=ok)
+        ok &= (mask[row:row + rows] & bad_mask_bits) == 0
+        ok &= variance[row:row + rows] > 0
+
+        # Bin 0 is underflow, bin n_bins - 1 overflow.
+        np.add(z, bin_range, out=tmp)
+        tmp /= bin_width
+        np.clip(tmp, -1, n_bins - 2, out=tmp)
+        np.floor(tmp, out=tmp)
+        tmp += 1
+        # Non-finite pixels are not selected, but must not reach the cast.
+        np.copyto(tmp, 0, where=~ok)
+        idx[...] = tmp
+
+        selected_idx = idx[ok]
+        selected_z = z[ok]
+        counts += np.bincount(selected_idx, minlength=n_bins)
+        sums += np.bincount(selected_idx, weights=selected_z, minlength=n_bins)
+        sum_squares += np.bincount(selected_idx, weights=selected_z**2, minlength=n_bins)
+
+    occupied = counts > 0
+    bin_means = np.zeros(n_bins)
+    bin_means[occupied] = sums[occupied]/counts[occupied]
+    keep = occupied
+    for iteration in range(n_iter + 1):
+        count = counts[keep].sum()
+        if count == 0:
+            return np.nan, np.nan, 0
+        mean = sums[keep].sum()/count
+        stddev = np.sqrt(max(sum_squares[keep].sum()/count - mean**2, 0.0))
+        keep = occupied & (np.abs(bin_means - mean) <= n_sigma*stddev)
+    return mean, stddev, int(count)
+
+def _clipped_noise_statistics_full_frame(image, mask, variance, bad_mask_bits, n_sigma=5.0, n_iter=3):
+    """`clipped_noise_statistics` with full-frame temporaries, as in the noise
+    analysis notebook. Only kept for benchmarking.
+    """
+    sel_ok, = np.where((mask.flatten() & bad_mask_bits == 0) & (variance.flatten() > 0))
+    rescaled_image = image/np.sqrt(np.where(variance > 0, variance, np.nan))
+    values = rescaled_image.flatten()[sel_ok]
+    values = values[np.isfinite(values)]
+    for n in range(n_iter):
+        mean, stddev = np.mean(values), np.std(values)
+        values = values[np.abs(values - mean) <= n_sigma*stddev]
+    return np.mean(values), np.std(values), len(values)
+
+def exposure_noise_statistics(exposure, planes=NOISE_MASK_PLANES, **kwargs):
+    masked_image = exposure.getMaskedImage()
+    image, mask, variance = masked_image.getArrays()
+    return clipped_noise_statistics(image, mask, variance, mask_plane_bits(masked_image.getMask(), planes),
+                                    **kwargs)
+
+
+#
+# Process pool over a repository. Each worker holds its own butler.
+#
+_worker_butler = None
+
+def _init_worker(repo):
+    global _worker_butler
+    import lsst.daf.persistence as dafPersist
+    _worker_butler = dafPersist.Butler(repo)
+
+def _noise_task(task):
+    """Measures one (datasetType, visit, ccdnum); returns None if it can not be read."""
+    datasetType, visit, ccdnum = task
+    try:
+        exposure = _worker_butler.get(datasetType, visit=visit, ccdnum=ccdnum, immediate=True)
+    except RuntimeError:
+        return None
+    mean, stddev, n_pixels = exposure_noise_statistics(exposure)
+    return {"datasetType": datasetType, "visit": visit, "ccdnum": ccdnum,
+            "n_pixels": n_pixels, "mean": mean, "stddev": stddev}
+
+def run_noise_statistics(repo, tasks, jobs=1):
+    """Measure the noise statistics of many (datasetType, visit, ccdnum).
+
+    Returns
+    -------
+    rows : list of dict
+        One per readable exposure, with the `NOISE_TABLE_COLUMNS`, sorted.
+    """
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(repo,))
+        results = pool.imap_unordered(_noise_task, tasks)
+    else:
+        pool = None
+        _init_worker(repo)
+        results = (_noise_task(task) for task in tasks)
+
+    rows = [row for row in results if row is not None]
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return sorted(rows, key=lambda row: (row["datasetType"], row["visit"], row["ccdnum"]))
+
+def write_noise_table(path, rows):
+    tmp_path = "{:s}.{:d}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=NOISE_TABLE_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    os.rename(tmp_path, path)
+
+def read_noise_table(path):
+    """Read a table from `write_noise_table`.
+
+    Returns
+    -------
+    stddevs : dict
+        Clipped standard deviation keyed by (datasetType, visit, ccdnum).
+    """
+    stddevs = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            stddevs[(row["datasetType"], int(row["visit"]), int(row["ccdnum"]))] = float(row["stddev"])
+    return stddevs
+
+
+def run_noise_benchmark(n_trials=3, seed=1234):
+    """Compares the tiled statistics with full-frame temporaries on a
+    DECam-sized (4096 x 2048) synthetic exposure.
+    """
+    rng = np.random.RandomState(seed)
+    shape = (4096, 2048)
+    variance = (100 + rng.rand(*shape)).astype(np.float32)
+    image = (1.1*np.sqrt(variance)*rng.randn(*shape)).astype(np.float32)
+    mask = (rng.rand(*shape) < 0.05).astype(np.int32)
+    image[:100, :100] += 1e4
+
+    start = time.time()
+    for n in range(n_trials):
+        full_frame = _clipped_noise_statistics_full_frame(image, mask, variance, 1)
+    full_frame_time = (time.time() - start)/n_trials
+
+    start = time.time()
+    for n in range(n_trials):
+        tiled = clipped_noise_statistics(image, mask, variance, 1)
+    tiled_time = (time.time() - start)/n_trials
+
+    assert np.allclose(full_frame[:2], tiled[:2]), "Statistics differ between methods."
+    print("Full frame: {:.3f} s, mean {:.4f} stddev {:.4f}".format(full_frame_time, *full_frame[:2]))
+    print("Tiled:      {:.3f} s, mean {:.4f} stddev {:.4f} ({:.1f}x)".format(tiled_time, tiled[0], tiled[1],
+                                                                             full_frame_time/tiled_time))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action='store_true',
+                        help="Benchmark against full-frame statistics on synthetic data")
+    parser.add_argument("repo", nargs="?", help="Repository with calexps and difference images")
+    parser.add_argument("output", nargs="?", help="CSV table to write")
+    parser.add_argument("visits", help="VisitIDs to process", type=int, nargs="*")
+    parser.add_argument("--datasets", nargs="+", default=["calexp", "deepDiff_differenceExp"],
+                        help="Exposure dataset types to measure")
+    parser.add_argument("--nccds", help="Number of CCDs per visit", type=int, default=62)
+    parser.add_argument("--jobs", "-j", help="Number of worker processes", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_noise_benchmark()
+    else:
+        if args.repo is None or args.output is None or not args.visits:
+            parser.error("repo, output and visits are required")
+        tasks = [(datasetType, visit, ccdnum) for datasetType in args.datasets
+                 for visit in args.visits for ccdnum in range(1, args.nccds + 1)]
+        start = time.time()
+        rows = run_noise_statistics(args.repo, tasks, jobs=args.jobs)
+        write_noise_table(args.output, rows)
+        print("Measured {:d} of {:d} exposures in {:.1f} s".format(len(rows), len(tasks), time.time() - start))
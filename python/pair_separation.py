@@ -0,0 +1,243 @@
+#!/bin/env python
+"""Pixel separation histograms of DIA sources, for finding detector defects.
+
+Sources that recur at the same pixel position in different visits (or that
+cluster within one visit) show up as an excess of small separations relative
+to randomly placed sources. `separation_histograms` computes both histograms
+for any number of visits and CCDs at once: the CCDs are laid out side by side
+on one plane, far enough apart that no source can be matched to another CCD,
+and every visit is matched with a single KD-tree query.
+
+Random catalogs are generated from a seed by `random_positions`, so they can
+be reused across calls and runs.
+
+With a ``source_store.py`` store, the defect analysis of the notebook is::
+
+    python pair_separation.py source_store 197367 197388 197400 199021
+"""
+from __future__ import print_function, division
+
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# Spacing between CCDs on the combined plane, in pixels. Much larger than a
+# DECam CCD, so no separation bin can span two CCDs.
+CCD_STRIDE = 100000.0
+
+
+def random_positions(n, width=2000, height=4000, seed=None):
+    """Uniformly distributed pixel positions on a `width` x `height` CCD.
+
+    Returns
+    -------
+    x, y : array
+    """
+    rng = np.random.RandomState(seed)
+    return rng.rand(n)*width, rng.rand(n)*height
+
+def _combined_positions(x, y, ccdnums):
+    return np.column_stack([np.asarray(x, dtype=float) + CCD_STRIDE*np.asarray(ccdnums),
+                            np.asarray(y, dtype=float)])
+
+def _chunked(function, points, workers):
+    """Apply `function` to `workers` chunks of `points` in threads and sum the results."""
+    if workers <= 1 or len(points) < 2*workers:
+        return function(points)
+    pool = ThreadPool(workers)
+    try:
+        return np.sum(pool.map(function, np.array_split(points, workers)), axis=0)
+    finally:
+        pool.close()
+
+def pair_separation_histogram(x, y, visits, ccdnums, dist_bins, use_same_visit=False, statistic="nearest",
+                              workers=1):
+    """Histogram of the separations between sources on the same CCD.
+
+    Parameters
+    ----------
+    x, y : array
+        Pixel position of each source.
+
+    visits, ccdnums : array
+        Visit and CCD of each source.
+
+    dist_bins : array
+        Edges of the separation bins, in pixels.
+
+    use_same_visit : bool
+        If True, match sources with the other sources of their own visit.
+        Otherwise match each visit with every later visit.
+
+    statistic : str
+        "nearest" histograms the distance from each source to its nearest
+        match (as in the defect notebook); "pairs" counts every pair of
+        sources within the largest bin.
+
+    workers : int
+        Number of threads to split the queries over.
+
+    Returns
+    -------
+    H : array
+    """
+    dist_bins = np.asarray(dist_bins, dtype=float)
+    points = _combined_positions(x, y, ccdnums)
+    visits = np.asarray(visits)
+    unique_visits = np.unique(visits)
+    trees = dict((visit, cKDTree(points[visits == visit])) for visit in unique_visits)
+
+    if use_same_visit:
+        visit_pairs = [(visit, visit) for visit in unique_visits]
+    else:
+        visit_pairs = [(visit, other) for n, visit in enumerate(unique_visits) for other in unique_visits[n + 1:]]
+
+    H = np.zeros(len(dist_bins) - 1)
+    for visit, other_visit in visit_pairs:
+        tree = trees[other_visit]
+        if statistic == "nearest":
+            k = 2 if use_same_visit else 1
+            if tree.n < k:
+                continue
+
+            def nearest_distances(chunk):
+                dists, _ = tree.query(chunk, k=k, distance_upper_bound=np.nextafter(dist_bins[-1], np.inf))
+                dists = dists[:, -1] if k > 1 else dists
+                this_H, _ = np.histogram(dists[np.isfinite(dists)], bins=dist_bins)
+                return this_H
+
+            H += _chunked(nearest_distances, points[visits == visit], workers)
+        elif statistic == "pairs":
+            def pair_counts(chunk):
+                return cKDTree(chunk).count_neighbors(tree, dist_bins)
+
+            cumulative = _chunked(pair_counts, points[visits == visit], workers).astype(float)
+            if use_same_visit:
+                # Every pair is counted in both directions, and every source with itself.
+                cumulative = (cumulative - tree.n)/2
+            H += np.diff(cumulative)
+            # count_neighbors counts separations <= r, np.histogram includes the first edge.
+            if dist_bins[0] <= 0 and not use_same_visit:
+                H[0] += cumulative[0]
+        else:
+            raise ValueError("Unknown statistic {:s}".format(statistic))
+    return H
+
+def separation_histograms(x, y, visits, ccdnums, dist_bins, use_same_visit=False, statistic="nearest",
+                          random_catalog=None, seed=None, workers=1):
+    """Separation histograms of the sources and of randomly placed sources.
+
+    The random catalog has the same visits and CCDs as the sources. Pass the
+    same `seed` (or a `random_catalog` from `random_positions`) to reuse it.
+
+    Returns
+    -------
+    H, H_random : array
+    """
+    if random_catalog is None:
+        random_catalog = random_positions(len(x), seed=seed)
+    random_x, random_y = random_catalog
+    H = pair_separation_histogram(x, y, visits, ccdnums, dist_bins, use_same_visit=use_same_visit,
+                                  statistic=statistic, workers=workers)
+    H_random = pair_separation_histogram(random_x, random_y, visits, ccdnums, dist_bins,
+                                         use_same_visit=use_same_visit, statistic=statistic, workers=workers)
+    return H, H_random
+
+
+def _separation_histograms_skycoord(x, y, visits, dist_bins, use_same_visit=False):
+    """The defect notebook's `separation_histograms` for one CCD, without the
+    random catalog. Only kept for benchmarking.
+    """
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord
+
+    source_coords = SkyCoord(x=x, y=y, z=0, unit="kpc", representation_type="cartesian")
+    H = np.zeros(len(dist_bins) - 1)
+    unique_visits = np.unique(visits)
+    completed_visits = []
+    for visitid in unique_visits:
+        sel_this_visit, = np.where(visits == visitid)
+        if use_same_visit:
+            target_visits = [visitid]
+        else:
+            target_visits = [v for v in unique_visits if v != visitid and v not in completed_visits]
+
+        for other_visitid in target_visits:
+            sel_other_visit, = np.where(visits == other_visitid)
+            nthneighbor = 2 if use_same_visit else 1
+            _, _, match_dist = source_coords[sel_this_visit].match_to_catalog_3d(source_coords[sel_other_visit],
+                                                                                nthneighbor=nthneighbor)
+            this_H, _ = np.histogram(match_dist/u.kpc, bins=dist_bins)
+            H += this_H
+        completed_visits.append(visitid)
+    return H
+
+def run_separation_benchmark(n_visits=4, n_ccds=50, sources_per_ccd=300, seed=1234):
+    """Compares the notebook's per-CCD SkyCoord matching with
+    `pair_separation_histogram` on synthetic sources with some defects.
+    """
+    import time
+
+    rng = np.random.RandomState(seed)
+    n = n_visits*n_ccds*sources_per_ccd
+    visits = np.repeat(197367 + np.arange(n_visits), n_ccds*sources_per_ccd)
+    ccdnums = np.tile(np.repeat(np.arange(10, 10 + n_ccds), sources_per_ccd), n_visits)
+    x, y = random_positions(n, seed=seed)
+    # Put a tenth of the sources on a few fixed defect positions.
+    defects = rng.rand(n) < 0.1
+    x[defects] = 100 + rng.randint(0, 5, np.sum(defects))*400 + rng.randn(np.sum(defects))
+    y[defects] = 2000 + rng.randn(np.sum(defects))
+    dist_bins = np.linspace(0, 20, 20)
+
+    start = time.time()
+    H_skycoord = np.zeros(len(dist_bins) - 1)
+    for ccdnum in np.unique(ccdnums):
+        sel, = np.where(ccdnums == ccdnum)
+        H_skycoord += _separation_histograms_skycoord(x[sel], y[sel], visits[sel], dist_bins)
+    skycoord_time = time.time() - start
+
+    start = time.time()
+    H = pair_separation_histogram(x, y, visits, ccdnums, dist_bins)
+    kdtree_time = time.time() - start
+
+    assert np.allclose(H, H_skycoord), "Histograms differ between methods."
+    print("{:d} visits, {:d} CCDs, {:d} sources".format(n_visits, n_ccds, n))
+    print("Per-CCD SkyCoord: {:.2f} s".format(skycoord_time))
+    print("Combined KD-tree: {:.3f} s ({:.1f}x)".format(kdtree_time, skycoord_time/kdtree_time))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action='store_true',
+                        help="Benchmark against per-CCD SkyCoord matching on synthetic data")
+    parser.add_argument("store_dir", nargs="?", help="source_store.py column store")
+    parser.add_argument("visits", help="VisitIDs to compare", type=int, nargs="*")
+    parser.add_argument("--ccds", type=int, nargs=2, default=[10, 59], metavar=("FIRST", "LAST"))
+    parser.add_argument("--same-visit", action='store_true', help="Match sources within each visit")
+    parser.add_argument("--statistic", choices=["nearest", "pairs"], default="nearest")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the random catalog")
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_separation_benchmark()
+    else:
+        if args.store_dir is None or not args.visits:
+            parser.error("store_dir and visits are required")
+
+        from source_store import SourceStore
+        store = SourceStore(args.store_dir)
+        sources = store.query(["centroid_x", "centroid_y", "visit", "ccdnum"], visits=args.visits,
+                              ccdnums=range(args.ccds[0], args.ccds[1] + 1),
+                              ranges={"classification_dipole": (0, 0), "SNR": (5, None)})
+        dist_bins = np.linspace(0, 20, 20)
+        H, H_random = separation_histograms(sources["centroid_x"], sources["centroid_y"], sources["visit"],
+                                            sources["ccdnum"], dist_bins, use_same_visit=args.same_visit,
+                                            statistic=args.statistic, seed=args.seed, workers=args.workers)
+        print("separation observed random")
+        for center, h, h_random in zip(0.5*(dist_bins[1:] + dist_bins[:-1]), H, H_random):
+            print("{:.2f} {:.0f} {:.0f}".format(center, h, h_random))
@@ -0,0 +1,77 @@
+#!/bin/env python
+"""Run a generator ahead of its consumer in a background thread.
+
+`prefetch` wraps any iterable so that its next few items are produced while
+the caller is still working on the current one, with at most `maxsize` items
+waiting at a time. This overlaps I/O-bound production (butler reads) with
+compute-bound consumption (rendering, matching) while keeping memory use
+bounded::
+
+    for page in prefetch(iter_mosaic_pages(butler, data_ids), maxsize=2):
+        render(page)
+"""
+from __future__ import print_function, division
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_DONE = object()
+
+
+class _Failure(object):
+    """Carries an exception from the producer thread to the consumer."""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def prefetch(iterable, maxsize=2):
+    """Iterate over `iterable`, producing up to `maxsize` items in advance.
+
+    Exceptions raised while producing an item are re-raised in the consumer
+    when it reaches that item. If the consumer stops early the producer thread
+    is stopped the next time it tries to hand over an item.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception:
+            put(_Failure(sys.exc_info()))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc_info[1]
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,268 @@
+#!/bin/env python
+"""Reference catalog providers for star_diffim_correlation.py.
+
+A provider is anything with a ``query_cone(ra, dec, radius)`` method (all in
+degrees) that returns a numpy structured array with the UCAC4 columns in
+`UCAC4_COLUMNS`. `VizierReferenceCatalog` queries Vizier directly, and
+`HealpixCatalogCache` answers cone queries from an on-disk cache of
+HEALPix-sharded catalog files, optionally filling missing shards from another
+provider.
+
+The cache can be filled ahead of time, so that no network access is needed
+during a run, from a catalog file that covers a given cone completely, or
+from Vizier, e.g.::
+
+    python refcat_cache.py ucac4_cache ingest ucac4_dump.fits 150.1 2.2 3.0
+    python refcat_cache.py ucac4_cache prefill 150.1 2.2 3.0
+"""
+from __future__ import print_function, division
+
+import os
+import argparse
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import healpy as hp
+except ImportError:
+    hp = None
+
+
+UCAC4_COLUMNS = ['RAJ2000', 'DEJ2000', 'f.mag', 'a.mag']
+UCAC4_DTYPE = np.dtype([(name, np.float64) for name in UCAC4_COLUMNS])
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees between positions given in degrees."""
+    ra1, dec1, ra2, dec2 = [np.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    sin_ddec = np.sin(0.5*(dec2 - dec1))
+    sin_dra = np.sin(0.5*(ra2 - ra1))
+    a = sin_ddec**2 + np.cos(dec1)*np.cos(dec2)*sin_dra**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+def table_to_catalog(table, columns=UCAC4_COLUMNS):
+    """Convert an astropy Table (or anything indexable by column name) into a
+    structured array with `UCAC4_DTYPE`. Masked entries become NaN.
+    """
+    catalog = np.zeros(len(table), dtype=UCAC4_DTYPE)
+    for name, column in zip(UCAC4_COLUMNS, columns):
+        catalog[name] = np.ma.asarray(table[column], dtype=float).filled(np.nan)
+    return catalog
+
+
+class VizierReferenceCatalog(object):
+    """Queries the UCAC4 catalog (I/322A) from Vizier.
+
+    Parameters
+    ----------
+    catalog : str
+        Vizier catalog identifier.
+
+    row_limit : int
+        Maximum number of rows returned per query, -1 for no limit.
+    """
+
+    def __init__(self, catalog='I/322A', row_limit=2000):
+        self.catalog = catalog
+        self.row_limit = row_limit
+
+    def query_cone(self, ra, dec, radius):
+        from astroquery.vizier import Vizier
+        import astropy.coordinates as coord
+        import astropy.units as u
+
+        vz = Vizier(columns=UCAC4_COLUMNS, row_limit=self.row_limit)
+        results = vz.query_region(coord.SkyCoord(ra=ra, dec=dec, unit=(u.deg, u.deg), frame='icrs'),
+                                  radius=coord.Angle(radius, "deg"),
+                                  catalog=self.catalog)
+        if len(results) == 0:
+            return np.zeros(0, dtype=UCAC4_DTYPE)
+        return table_to_catalog(results[0])
+
+
+class HealpixCatalogCache(object):
+    """Answers cone queries from a local HEALPix-sharded catalog cache.
+
+    Each shard holds all of the catalog entries in one HEALPix pixel (NESTED
+    ordering), stored as a ``.npy`` structured array that is memory-mapped when
+    read. Recently used shards are also held in an in-memory LRU.
+
+    A cache can be shared by several threads: the LRU is locked, and each
+    missing shard is fetched by only one thread while the others wait for it.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the shards.
+
+    backend : provider, optional
+        Used to fill shards that are not yet in the cache. If None, queries
+        touching a missing shard raise `LookupError`.
+
+    nside : int
+        HEALPix resolution of the shards.
+
+    max_shards_in_memory : int
+        Size of the in-memory LRU layer.
+    """
+
+    def __init__(self, cache_dir, backend=None, nside=64, max_shards_in_memory=64):
+        if hp is None:
+            raise RuntimeError("healpy is required for HealpixCatalogCache")
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.nside = nside
+        self.max_shards_in_memory = max_shards_in_memory
+        self._shards = OrderedDict()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+        self.shard_dir = os.path.join(cache_dir, "nside{:d}".format(nside))
+        if not os.path.isdir(self.shard_dir):
+            os.makedirs(self.shard_dir)
+
+    def _shard_path(self, pixel):
+        return os.path.join(self.shard_dir, "{:d}.npy".format(pixel))
+
+    def _write_shard(self, pixel, catalog):
+        path = self._shard_path(pixel)
+        tmp_path = "{:s}.{:d}.{:d}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(catalog, dtype=UCAC4_DTYPE))
+        os.rename(tmp_path, path)
+        with self._lock:
+            self._shards.pop(pixel, None)
+
+    def _fetch_shard(self, pixel):
+        """Fill one shard from the backend with a cone enclosing the pixel."""
+        center_ra, center_dec = hp.pix2ang(self.nside, pixel, nest=True, lonlat=True)
+        corners = hp.boundaries(self.nside, pixel, step=4, nest=True)
+        corner_ra, corner_dec = hp.vec2ang(corners.T, lonlat=True)
+        radius = 1.01*np.max(angular_separation(center_ra, center_dec, corner_ra, corner_dec))
+
+        catalog = self.backend.query_cone(center_ra, center_dec, radius)
+        in_pixel = hp.ang2pix(self.nside, catalog['RAJ2000'], catalog['DEJ2000'],
+                              nest=True, lonlat=True) == pixel
+        self._write_shard(pixel, catalog[in_pixel])
+
+    def get_shard(self, pixel):
+        with self._lock:
+            if pixel in self._shards:
+                shard = self._shards.pop(pixel)
+                self._shards[pixel] = shard
+                return shard
+            fetch_lock = self._fetch_locks.setdefault(pixel, threading.Lock())
+
+        path = self._shard_path(pixel)
+        with fetch_lock:
+            if not os.path.exists(path):
+                if self.backend is None:
+                    raise LookupError("HEALPix pixel {:d} (nside={:d}) is not in the cache "
+                                      "at {:s}".format(pixel, self.nside, self.cache_dir))
+                self._fetch_shard(pixel)
+
+        shard = np.load(path, mmap_mode='r')
+        with self._lock:
+            self._shards[pixel] = shard
+            while len(self._shards) > self.max_shards_in_memory:
+                self._shards.popitem(last=False)
+        return shard
+
+    def query_cone(self, ra, dec, radius):
+        vec = hp.ang2vec(ra, dec, lonlat=True)
+        pixels = hp.query_disc(self.nside, vec, np.radians(radius), inclusive=True, nest=True)
+
+        selected = []
+        for pixel in pixels:
+            shard = self.get_shard(pixel)
+            sel, = np.where(angular_separation(ra, dec, shard['RAJ2000'], shard['DEJ2000']) < radius)
+            selected.append(shard[sel])
+        if len(selected) == 0:
+            return np.zeros(0, dtype=UCAC4_DTYPE)
+        return np.concatenate(selected)
+
+    def footprint_pixels(self, ra, dec, radius):
+        """The shards that lie entirely inside a cone, in degrees. A `radius`
+        of 180 or more is the whole sky.
+        """
+        if radius >= 180:
+            return np.arange(hp.nside2npix(self.nside))
+        inner_radius = np.radians(radius) - hp.max_pixrad(self.nside)
+        if inner_radius <= 0:
+            return np.zeros(0, dtype=np.int64)
+        vec = hp.ang2vec(ra, dec, lonlat=True)
+        return hp.query_disc(self.nside, vec, inner_radius, inclusive=False, nest=True)
+
+    def ingest(self, catalog, ra, dec, radius):
+        """Write the shards that lie entirely inside the cone `ra`, `dec`,
+        `radius` (in degrees), which `catalog` must cover completely,
+        replacing existing ones. Shards without any stars are written empty.
+
+        Shards that are only partly inside the cone are not written, since
+        the catalog may lack some of their stars; they are left as they are,
+        or filled from the backend when needed.
+
+        Returns
+        -------
+        n_shards : int
+        """
+        pixels = self.footprint_pixels(ra, dec, radius)
+        catalog_pixels = hp.ang2pix(self.nside, catalog['RAJ2000'], catalog['DEJ2000'], nest=True, lonlat=True)
+        order = np.argsort(catalog_pixels, kind="mergesort")
+        starts = np.searchsorted(catalog_pixels[order], pixels, side="left")
+        ends = np.searchsorted(catalog_pixels[order], pixels, side="right")
+        for pixel, start, end in zip(pixels, starts, ends):
+            self._write_shard(pixel, catalog[order[start:end]])
+        return len(pixels)
+
+    def ingest_file(self, filename, ra, dec, radius, columns=UCAC4_COLUMNS, format=None):
+        """Fill the cache from a catalog dump (anything astropy.table can read)
+        that covers the given cone completely (see `ingest`).
+        """
+        from astropy.table import Table
+        return self.ingest(table_to_catalog(Table.read(filename, format=format), columns=columns), ra, dec, radius)
+
+    def prefill(self, ra, dec, radius):
+        """Make sure every shard overlapping the given cone is in the cache."""
+        vec = hp.ang2vec(ra, dec, lonlat=True)
+        pixels = hp.query_disc(self.nside, vec, np.radians(radius), inclusive=True, nest=True)
+        for pixel in pixels:
+            self.get_shard(pixel)
+        return len(pixels)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cache_dir", help="Directory for the catalog cache")
+    parser.add_argument("--nside", type=int, default=64, help="HEALPix nside of the cache shards")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    ingest_parser = subparsers.add_parser("ingest", help="Fill the cache from a catalog file")
+    ingest_parser.add_argument("filename")
+    ingest_parser.add_argument("ra", type=float)
+    ingest_parser.add_argument("dec", type=float)
+    ingest_parser.add_argument("radius", type=float,
+                               help="Radius in degrees of the cone the file covers completely; 180 for all sky")
+    ingest_parser.add_argument("--columns", nargs=4, default=UCAC4_COLUMNS,
+                               help="Names of the RA, Dec, f.mag, and a.mag columns in the file")
+    ingest_parser.add_argument("--format", default=None, help="astropy.table format of the file")
+
+    prefill_parser = subparsers.add_parser("prefill", help="Download a region from Vizier")
+    prefill_parser.add_argument("ra", type=float)
+    prefill_parser.add_argument("dec", type=float)
+    prefill_parser.add_argument("radius", type=float, help="Radius in degrees")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        cache = HealpixCatalogCache(args.cache_dir, nside=args.nside)
+        nshards = cache.ingest_file(args.filename, args.ra, args.dec, args.radius, columns=args.columns,
+                                    format=args.format)
+    else:
+        cache = HealpixCatalogCache(args.cache_dir, backend=VizierReferenceCatalog(row_limit=-1),
+                                    nside=args.nside)
+        nshards = cache.prefill(args.ra, args.dec, args.radius)
+    print("{:d} shards in {:s}".format(nshards, cache.shard_dir))
@@ -0,0 +1,252 @@
+#!/bin/env python
+"""Manifests of the inputs and outputs of per-CCD pipeline runs.
+
+A `RunManifest` records, for every unit of work (a dataId such as
+``visit=197367 ccdnum=10``), the fingerprints of the files it was computed
+from and of what it wrote (output files, or a summary of its database rows).
+On the next run `plan_units` compares the current input files with the
+manifest, so that only units that are new, or whose inputs changed or
+outputs are missing or changed, are recomputed, and the outputs of units
+whose inputs were removed are invalidated.
+
+A fingerprint is the size and modification time of a file and, if hashing is
+enabled, the SHA-1 of its contents. With hashes, a file that was rewritten
+with the same contents still matches; the hash is only recomputed when the
+size or modification time changed.
+
+``star_diffim_correlation.py --manifest`` and ``forcePhotDiaSources.py -c
+manifest=...`` use this to make reruns incremental. Which recorded inputs
+or output files have changed on disk since can be listed with::
+
+    python run_manifest.py star_diffim_manifest.json
+"""
+from __future__ import print_function, division
+
+import os
+import json
+import hashlib
+import argparse
+
+
+def file_fingerprint(path, use_hash=False, previous=None):
+    """Fingerprint of a file, or None if it does not exist.
+
+    If `previous` (an earlier fingerprint of the same file) has the same size
+    and modification time, its hash is reused instead of reading the file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    fingerprint = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime}
+    if use_hash:
+        if previous is not None and previous.get("sha1") is not None and \
+                previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+            fingerprint["sha1"] = previous["sha1"]
+        else:
+            sha1 = hashlib.sha1()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(block)
+            fingerprint["sha1"] = sha1.hexdigest()
+    return fingerprint
+
+def dataset_fingerprints(butler, datasets, use_hash=False, previous=None):
+    """Fingerprints of the files behind butler datasets.
+
+    Parameters
+    ----------
+    datasets : list of (name, datasetType, dataId)
+        Datasets to fingerprint, and the name to store each under (e.g.
+        "template" for the template calexp of a difference image).
+
+    previous : dict, optional
+        Earlier fingerprints, keyed by name, whose hashes can be reused.
+
+    Returns
+    -------
+    fingerprints : dict
+        Fingerprint (None if missing) keyed by name.
+    """
+    previous = previous or {}
+    fingerprints = {}
+    for name, datasetType, dataId in datasets:
+        try:
+            filename = butler.get(datasetType + "_filename", dataId)[0]
+        except RuntimeError:
+            fingerprints[name] = None
+            continue
+        fingerprints[name] = file_fingerprint(filename, use_hash=use_hash, previous=previous.get(name))
+    return fingerprints
+
+def refresh_fingerprints(inputs, use_hash=False):
+    """Fingerprint the files of recorded `inputs` again, by their stored paths."""
+    return dict((name, file_fingerprint(fingerprint["path"], use_hash=use_hash, previous=fingerprint)
+                 if fingerprint is not None else None) for name, fingerprint in inputs.items())
+
+def files_current(fingerprints, use_hash=False):
+    """Whether recorded fingerprints (e.g. of the output files of a unit) all
+    still match their files. False if there are none, or any is missing.
+    """
+    if not fingerprints or any(fingerprint is None for fingerprint in fingerprints.values()):
+        return False
+    return inputs_match(refresh_fingerprints(fingerprints, use_hash=use_hash), fingerprints)
+
+def inputs_match(inputs, recorded):
+    """Whether two sets of input fingerprints describe the same files.
+
+    Files are compared by hash when both fingerprints have one, and by size
+    and modification time otherwise.
+    """
+    if recorded is None or set(inputs) != set(recorded):
+        return False
+    for name, fingerprint in inputs.items():
+        other = recorded[name]
+        if fingerprint is None or other is None:
+            if fingerprint is not other:
+                return False
+        elif fingerprint.get("sha1") is not None and other.get("sha1") is not None:
+            if fingerprint["sha1"] != other["sha1"] or fingerprint["size"] != other["size"]:
+                return False
+        elif fingerprint["size"] != other["size"] or fingerprint["mtime"] != other["mtime"]:
+            return False
+    return True
+
+
+class RunManifest(object):
+    """Inputs and outputs of every completed unit of a pipeline, stored in a
+    JSON file.
+
+    Parameters
+    ----------
+    path : str
+        Manifest file; it is created on the first `save`.
+
+    use_hash : bool
+        Also compare input files by the hash of their contents.
+    """
+
+    def __init__(self, path, use_hash=False):
+        self.path = path
+        self.use_hash = use_hash
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    @staticmethod
+    def key(dataId):
+        return " ".join(["{:s}={}".format(k, v) for k, v in sorted(dataId.items())])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, dataId):
+        return self.key(dataId) in self._entries
+
+    def entry(self, dataId):
+        """The recorded ``dataId``, ``inputs`` and ``outputs`` of a unit, or None."""
+        return self._entries.get(self.key(dataId))
+
+    def entries(self):
+        return [self._entries[key] for key in sorted(self._entries)]
+
+    def record(self, dataId, inputs, outputs=None):
+        """Mark a unit as completed from `inputs`, having written `outputs`."""
+        self._entries[self.key(dataId)] = {"dataId": dict(dataId), "inputs": inputs, "outputs": outputs or {}}
+
+    def remove(self, dataId):
+        self._entries.pop(self.key(dataId), None)
+
+    def save(self):
+        tmp_path = "{:s}.{:d}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def invalidated_units(manifest, skip=()):
+    """The dataIds of the units in the manifest with a recorded input file
+    that no longer exists, whose outputs should be removed. Units whose
+    `RunManifest.key` is in `skip` are not checked.
+    """
+    return [entry["dataId"] for entry in manifest.entries() if manifest.key(entry["dataId"]) not in skip and
+            any(value is None for value in refresh_fingerprints(entry["inputs"]).values())]
+
+def plan_units(manifest, dataIds, fingerprint, outputs_current=None):
+    """Decide which units of a run need to be computed.
+
+    Every requested unit is fingerprinted with ``fingerprint(dataId,
+    previous_inputs)``, which returns a dict of input fingerprints (None for a
+    missing input), and the recorded input files of every other unit in the
+    manifest are checked for removal. If given, ``outputs_current(dataId,
+    outputs)`` checks the recorded outputs of units whose inputs match; units
+    whose outputs are missing or changed are recomputed. Unchanged units
+    have their fingerprints updated in the manifest, so files that were
+    touched but matched by hash are not hashed again. Nothing is written to
+    disk.
+
+    Returns
+    -------
+    plan : dict
+        ``new`` and ``changed``: (dataId, inputs) pairs to compute.
+        ``unchanged``: (dataId, inputs) pairs whose recorded outputs are
+        current. ``missing``: requested dataIds with a missing input that
+        were never completed. ``invalidated``: dataIds in the manifest with a
+        missing input, whose outputs should be removed.
+    """
+    plan = {"new": [], "changed": [], "unchanged": [], "missing": [], "invalidated": []}
+    requested = set()
+    for dataId in dataIds:
+        requested.add(manifest.key(dataId))
+        entry = manifest.entry(dataId)
+        inputs = fingerprint(dataId, entry["inputs"] if entry is not None else None)
+        if any(value is None for value in inputs.values()):
+            plan["missing" if entry is None else "invalidated"].append(dataId)
+        elif entry is None:
+            plan["new"].append((dataId, inputs))
+        elif inputs_match(inputs, entry["inputs"]) and \
+                (outputs_current is None or outputs_current(dataId, entry["outputs"])):
+            plan["unchanged"].append((dataId, inputs))
+            manifest.record(dataId, inputs, entry["outputs"])
+        else:
+            plan["changed"].append((dataId, inputs))
+
+    plan["invalidated"] += invalidated_units(manifest, skip=requested)
+    return plan
+
+def plan_report(plan, manifest=None):
+    """A one-line summary of a plan. With the `manifest`, the recorded
+    ``elapsed`` time of the skipped units is included.
+    """
+    n_total = sum(len(plan[name]) for name in ("new", "changed", "unchanged", "missing"))
+    report = "{:d} units: {:d} new, {:d} changed, {:d} unchanged (skipped), {:d} missing inputs, " \
+             "{:d} invalidated".format(n_total, len(plan["new"]), len(plan["changed"]), len(plan["unchanged"]),
+                                       len(plan["missing"]), len(plan["invalidated"]))
+    if manifest is not None:
+        skipped = [manifest.entry(dataId)["outputs"].get("elapsed") for dataId, inputs in plan["unchanged"]]
+        skipped = [elapsed for elapsed in skipped if elapsed is not None]
+        if skipped:
+            report += "; skipped {:.1f} s of recorded work".format(sum(skipped))
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", help="Manifest file")
+    args = parser.parse_args()
+
+    manifest = RunManifest(args.manifest)
+    n_current = 0
+    for entry in manifest.entries():
+        inputs = refresh_fingerprints(entry["inputs"])
+        output_files = entry["outputs"].get("files", {})
+        changed = [name for name in sorted(inputs) if not inputs_match({name: inputs[name]},
+                                                                       {name: entry["inputs"][name]})]
+        changed += [name for name in sorted(output_files) if not files_current({name: output_files[name]})]
+        if changed:
+            print("{:s}: {:s} changed".format(manifest.key(entry["dataId"]), ", ".join(changed)))
+        else:
+            n_current += 1
+    print("{:d} of {:d} units current".format(n_current, len(manifest)))
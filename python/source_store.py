@@ -0,0 +1,318 @@
+#!/bin/env python
+"""Partitioned column store of DIA sources and their forced photometry.
+
+All of the ``deepDiff_diaSrc`` and ``forced_src`` outputs of a set of visits
+are consolidated into one directory, with a ``.npy`` file per visit and column
+(the columns of `forced_src_filter.STORE_COLUMNS`, plus the corrected
+``SNR``). Each CCD is a partition: a contiguous range of rows in its visit's
+files. An index file records the rows and the min/max of every column of
+every partition, so that a query only reads the partitions that can contain
+matching rows, with one memory map per visit and column.
+
+``forced_src_filter.py`` writes its per-visit candidate files from this
+store. This replaces the notebooks' per-CCD loop of SQL queries with one
+scan::
+
+    store = SourceStore("source_store")
+    sources = store.query(["centroid_x", "centroid_y", "visit", "ccdnum"],
+                          visits=[197367, 197388, 197400, 199021],
+                          ranges={"classification_dipole": (0, 0), "SNR": (5, None)})
+
+The store is filled with::
+
+    python source_store.py source_store ingest /path/to/repo 197367 197388
+"""
+from __future__ import print_function, division
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+from forced_src_filter import STORE_COLUMNS, STORE_DTYPES, catalog_columns, corrected_snr
+
+
+COLUMN_NAMES = [name for name, _ in STORE_COLUMNS] + ["SNR"]
+
+
+def add_derived_columns(columns):
+    """Add the corrected SNR to the columns of one partition."""
+    columns["SNR"] = corrected_snr(columns["science_flux"], columns["science_fluxSigma"],
+                                   columns["template_flux"], columns["template_fluxSigma"])
+    return columns
+
+
+class SourceStore(object):
+    """A directory of per-visit column files, partitioned by CCD.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory holding the partitions and ``index.json``.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, "index.json")
+        self._partitions = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for partition in json.load(f):
+                    self._partitions[(partition["visit"], partition["ccdnum"])] = partition
+        elif not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+    def __len__(self):
+        return sum(partition["n_rows"] for partition in self._partitions.values())
+
+    def _column_path(self, visit, name):
+        return os.path.join(self.store_dir, "visit{:d}".format(visit), name + ".npy")
+
+    def add_visit(self, visit, ccd_columns):
+        """Write (or replace) all of the partitions of one visit.
+
+        The index is only updated on disk by `save_index`.
+
+        Parameters
+        ----------
+        ccd_columns : list of (ccdnum, dict)
+            Arrays for every name in `COLUMN_NAMES` for each CCD, e.g. from
+            `forced_src_filter.catalog_columns` and `add_derived_columns`.
+        """
+        path = os.path.dirname(self._column_path(visit, "id"))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for key in [key for key in self._partitions if key[0] == visit]:
+            del self._partitions[key]
+
+        ccd_columns = sorted(ccd_columns, key=lambda item: item[0])
+        lengths = [len(columns["id"]) for ccdnum, columns in ccd_columns]
+        starts = [0] + np.cumsum(lengths).tolist()
+        for name in COLUMN_NAMES:
+            dtype = STORE_DTYPES.get(name, np.float64)
+            pieces = [np.asarray(columns[name], dtype=dtype) for ccdnum, columns in ccd_columns]
+            np.save(self._column_path(visit, name), np.concatenate(pieces) if pieces else np.zeros(0, dtype))
+
+        for (ccdnum, columns), start, n_rows in zip(ccd_columns, starts, lengths):
+            stats = {}
+            for name in COLUMN_NAMES:
+                column = np.asarray(columns[name])
+                finite = column[np.isfinite(column)] if column.dtype.kind == 'f' else column
+                if len(finite) > 0:
+                    stats[name] = [finite.min().item(), finite.max().item()]
+            self._partitions[(visit, ccdnum)] = {"visit": visit, "ccdnum": ccdnum, "start": start,
+                                                 "n_rows": n_rows, "stats": stats}
+
+    def save_index(self):
+        tmp_path = "{:s}.{:d}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(sorted(self._partitions.values(), key=lambda p: (p["visit"], p["ccdnum"])), f, indent=1)
+        os.rename(tmp_path, self.index_path)
+
+    def ingest(self, butler, visits, ccdnums):
+        """Add a partition for every CCD of `visits` that has both catalogs.
+
+        Returns
+        -------
+        n_partitions : int
+        """
+        n_partitions = 0
+        for visit in visits:
+            ccd_columns = []
+            for ccdnum in ccdnums:
+                try:
+                    diff_src = butler.get("deepDiff_diaSrc", visit=visit, ccdnum=ccdnum, immediate=True)
+                    forced_src = butler.get("forced_src", visit=visit, ccdnum=ccdnum, immediate=True)
+                except RuntimeError:
+                    print("Could not load data for visit={:d}, ccdnum={:d}, skipping.".format(visit, ccdnum))
+                    continue
+                ccd_columns.append((ccdnum, add_derived_columns(catalog_columns(diff_src, forced_src))))
+            self.add_visit(visit, ccd_columns)
+            self.save_index()
+            n_partitions += len(ccd_columns)
+        return n_partitions
+
+    def visit_ccds(self, visit):
+        """The (ccdnum, n_rows) of every partition of a visit, including CCDs
+        without any sources, in ccdnum order. CCDs whose catalogs could not
+        be read at ingest have no partition.
+        """
+        return sorted((ccdnum, partition["n_rows"]) for (partition_visit, ccdnum), partition
+                      in self._partitions.items() if partition_visit == visit)
+
+    def partitions(self, visits=None, ccdnums=None, ranges=None):
+        """The (visit, ccdnum) of the partitions that can contain rows matching
+        the predicates of `query`, in sorted order.
+        """
+        visits = None if visits is None else set(visits)
+        ccdnums = None if ccdnums is None else set(ccdnums)
+        selected = []
+        for key, partition in sorted(self._partitions.items()):
+            if partition["n_rows"] == 0:
+                continue
+            if visits is not None and partition["visit"] not in visits:
+                continue
+            if ccdnums is not None and partition["ccdnum"] not in ccdnums:
+                continue
+            if ranges is not None and not all(self._may_overlap(partition, name, low, high)
+                                              for name, (low, high) in ranges.items()):
+                continue
+            selected.append(key)
+        return selected
+
+    @staticmethod
+    def _may_overlap(partition, name, low, high):
+        if name not in partition["stats"]:
+            # All NaN.
+            return False
+        column_min, column_max = partition["stats"][name]
+        return (low is None or column_max >= low) and (high is None or column_min <= high)
+
+    def query(self, columns, visits=None, ccdnums=None, ranges=None):
+        """Scan the store for matching rows.
+
+        Parameters
+        ----------
+        columns : list of str
+            Columns to return: any of `COLUMN_NAMES`, ``visit``, and ``ccdnum``.
+
+        visits, ccdnums : list of int, optional
+            Only return rows from these visits or CCDs.
+
+        ranges : dict, optional
+            Maps column names to inclusive ``(low, high)`` bounds that rows
+            must satisfy; either bound may be None. Rows where the column is
+            NaN never match.
+
+        Returns
+        -------
+        result : dict
+            The requested columns as arrays, in (visit, ccdnum) order.
+        """
+        ranges = ranges or {}
+        keys = self.partitions(visits=visits, ccdnums=ccdnums, ranges=ranges)
+        pieces = dict((name, []) for name in columns)
+        for visit in sorted(set(visit for visit, ccdnum in keys)):
+            partitions = [self._partitions[key] for key in keys if key[0] == visit]
+            rows = np.concatenate([np.arange(p["start"], p["start"] + p["n_rows"]) for p in partitions])
+            row_ccdnums = np.repeat([p["ccdnum"] for p in partitions], [p["n_rows"] for p in partitions])
+
+            keep = np.ones(len(rows), dtype=bool)
+            with np.errstate(invalid='ignore'):
+                for name, (low, high) in ranges.items():
+                    column = np.load(self._column_path(visit, name), mmap_mode="r")[rows]
+                    if low is not None:
+                        keep &= column >= low
+                    if high is not None:
+                        keep &= column <= high
+            rows = rows[keep]
+
+            for name in columns:
+                if name == "visit":
+                    pieces[name].append(np.full(len(rows), visit, dtype=np.int64))
+                elif name == "ccdnum":
+                    pieces[name].append(row_ccdnums[keep].astype(np.int32))
+                else:
+                    pieces[name].append(np.load(self._column_path(visit, name), mmap_mode="r")[rows])
+
+        result = {}
+        for name in columns:
+            if pieces[name]:
+                result[name] = np.concatenate(pieces[name])
+            else:
+                dtype = {"visit": np.int64, "ccdnum": np.int32}.get(name, STORE_DTYPES.get(name, np.float64))
+                result[name] = np.zeros(0, dtype=dtype)
+        return result
+
+
+def run_query_benchmark(n_visits=4, n_ccds=60, rows_per_ccd=2000, seed=1234):
+    """Compares the notebook's per-CCD SQL loop (on SQLite) with one
+    `SourceStore.query` over the same synthetic sources.
+    """
+    import time
+    import shutil
+    import sqlite3
+    import tempfile
+
+    rng = np.random.RandomState(seed)
+    store_dir = tempfile.mkdtemp()
+    store = SourceStore(store_dir)
+    db = sqlite3.connect(os.path.join(store_dir, "benchmark.sqlite3"))
+    db.execute("CREATE TABLE sources (visitid INTEGER, ccdnum INTEGER, centroid_x REAL, centroid_y REAL, "
+               "classification_dipole INTEGER, flux REAL, fluxSigma REAL, "
+               "template_flux REAL, template_fluxSigma REAL)")
+    db.execute("CREATE INDEX ix_sources_visitid_ccdnum ON sources (visitid, ccdnum)")
+
+    visits = 197367 + np.arange(n_visits)
+    for visit in visits:
+        ccd_columns = []
+        for ccdnum in range(1, n_ccds + 1):
+            n = rows_per_ccd
+            columns = dict((name, np.zeros(n)) for name in COLUMN_NAMES)
+            columns["id"] = np.arange(n)
+            columns["centroid_x"] = 2048*rng.rand(n)
+            columns["centroid_y"] = 4096*rng.rand(n)
+            columns["classification_dipole"] = (rng.rand(n) < 0.1).astype(int)
+            columns["science_flux"] = 100*rng.randn(n)
+            columns["template_flux"] = 100*rng.randn(n)
+            columns["science_fluxSigma"] = 20 + rng.rand(n)
+            columns["template_fluxSigma"] = 20 + rng.rand(n)
+            ccd_columns.append((ccdnum, add_derived_columns(columns)))
+            db.executemany("INSERT INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           zip([int(visit)]*n, [ccdnum]*n, columns["centroid_x"], columns["centroid_y"],
+                               columns["classification_dipole"].tolist(), columns["science_flux"],
+                               columns["science_fluxSigma"], columns["template_flux"],
+                               columns["template_fluxSigma"]))
+        store.add_visit(int(visit), ccd_columns)
+    store.save_index()
+    db.commit()
+    query_visits = [int(v) for v in visits[:3]]
+    print("{:d} partitions, {:d} rows".format(len(store.partitions()), len(store)))
+
+    start = time.time()
+    sql_rows = 0
+    for ccdnum in range(10, 60):
+        rows = db.execute("SELECT centroid_x, centroid_y, visitid FROM sources "
+                          "WHERE (visitid=? OR visitid=? OR visitid=?) AND ccdnum=? AND "
+                          "classification_dipole=0 AND "
+                          "((flux - template_flux)/(SQRT(fluxSigma*fluxSigma + "
+                          "template_fluxSigma*template_fluxSigma)) > 5)",
+                          query_visits + [ccdnum]).fetchall()
+        sql_rows += len(rows)
+    sql_time = time.time() - start
+
+    start = time.time()
+    result = store.query(["centroid_x", "centroid_y", "visit", "ccdnum"], visits=query_visits,
+                         ccdnums=range(10, 60), ranges={"classification_dipole": (0, 0), "SNR": (5, None)})
+    store_time = time.time() - start
+    db.close()
+    shutil.rmtree(store_dir)
+
+    assert sql_rows == len(result["visit"]), "Row counts differ between methods."
+    print("SQLite per-CCD loop: {:.3f} s, {:d} rows".format(sql_time, sql_rows))
+    print("Column store scan:   {:.3f} s ({:.1f}x)".format(store_time, sql_time/store_time))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir", help="Directory of the column store")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    ingest_parser = subparsers.add_parser("ingest", help="Add the diaSrc and forced_src outputs of visits")
+    ingest_parser.add_argument("repo", help="Repository with forced_src outputs")
+    ingest_parser.add_argument("visits", help="VisitIDs to ingest", type=int, nargs="+")
+    ingest_parser.add_argument("--nccds", help="Number of CCDs per visit", type=int, default=62)
+
+    subparsers.add_parser("benchmark", help="Benchmark against SQLite on synthetic data (ignores store_dir)")
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        run_query_benchmark()
+    else:
+        import lsst.daf.persistence as dafPersist
+        store = SourceStore(args.store_dir)
+        n_partitions = store.ingest(dafPersist.Butler(args.repo), args.visits, range(1, args.nccds + 1))
+        print("Ingested {:d} partitions, {:d} rows in store".format(n_partitions, len(store)))
@@ -0,0 +1,126 @@
+#!/bin/env python
+"""Per-stage timing records, written as JSON lines.
+
+A `StageTimer` times named stages of a task and records the wall time along
+with any row and byte counts the stage reports::
+
+    timer = StageTimer(visit=197367, ccdnum=10)
+    with timer.stage("butler_read") as stage:
+        src = butler.get("src", visit=197367, ccdnum=10, immediate=True)
+        stage["rows"] = len(src)
+
+Each record is a flat dict (``stage``, ``wall``, the timer's context, and
+optionally ``rows`` and ``bytes``), so records from many tasks and processes
+can be appended to one ``.jsonl`` file and summarized together::
+
+    python stage_timing.py star_diffim_timing.jsonl
+"""
+from __future__ import print_function, division
+
+import json
+import time
+import argparse
+import contextlib
+
+import numpy as np
+
+
+class StageTimer(object):
+    """Records the wall time of named stages.
+
+    Parameters
+    ----------
+    stream : file, optional
+        Records are also written here as JSON lines as they finish.
+
+    **context
+        Added to every record, e.g. ``visit`` and ``ccdnum``.
+    """
+
+    def __init__(self, stream=None, **context):
+        self.stream = stream
+        self.context = context
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block. The yielded record can be given ``rows``
+        and ``bytes`` entries; the record is kept even if the block raises.
+        """
+        record = dict(self.context)
+        record["stage"] = name
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.time() - start
+            self.add(record)
+
+    def add(self, record):
+        self.records.append(record)
+        if self.stream is not None:
+            write_records(self.stream, [record])
+
+    def total(self, name):
+        """Total wall time of all stages called `name`."""
+        return sum(record["wall"] for record in self.records if record["stage"] == name)
+
+
+def write_records(stream, records):
+    for record in records:
+        stream.write(json.dumps(record, sort_keys=True) + "\n")
+    stream.flush()
+
+def read_records(filenames):
+    records = []
+    for filename in filenames:
+        with open(filename) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+def stage_report(records):
+    """Summarize records by stage, in order of first appearance.
+
+    Returns
+    -------
+    rows : list of dict
+        ``stage``, ``count``, ``total``, ``p50`` and ``p95`` of the wall
+        time, and the summed ``rows`` and ``bytes`` (None if never reported).
+    """
+    stages = []
+    by_stage = {}
+    for record in records:
+        if record["stage"] not in by_stage:
+            stages.append(record["stage"])
+            by_stage[record["stage"]] = []
+        by_stage[record["stage"]].append(record)
+
+    report = []
+    for name in stages:
+        wall = np.array([record["wall"] for record in by_stage[name]])
+        summary = {"stage": name, "count": len(wall), "total": wall.sum(),
+                   "p50": np.percentile(wall, 50), "p95": np.percentile(wall, 95)}
+        for key in ("rows", "bytes"):
+            values = [record[key] for record in by_stage[name] if record.get(key) is not None]
+            summary[key] = sum(values) if values else None
+        report.append(summary)
+    return report
+
+def print_stage_report(records):
+    print("{:<16s} {:>6s} {:>9s} {:>9s} {:>9s} {:>11s} {:>11s}".format("stage", "count", "total s", "p50 s",
+                                                                     "p95 s", "rows", "MB"))
+    for summary in stage_report(records):
+        rows = "-" if summary["rows"] is None else "{:d}".format(summary["rows"])
+        megabytes = "-" if summary["bytes"] is None else "{:.1f}".format(summary["bytes"]/1e6)
+        print("{:<16s} {:>6d} {:>9.2f} {:>9.4f} {:>9.4f} {:>11s} {:>11s}".format(
+            summary["stage"], summary["count"], summary["total"], summary["p50"], summary["p95"],
+            rows, megabytes))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logs", nargs="+", help="JSON lines timing logs")
+    args = parser.parse_args()
+
+    print_stage_report(read_records(args.logs))
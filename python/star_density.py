@@ -0,0 +1,323 @@
+#!/bin/env python
+"""Stellar density and masked fraction lookups from a HEALPix star count map.
+
+The ``stellar_masked_fraction`` notebook works from
+``starDensity_r_nside_64.npz`` (written by ``createStarDensitymap.py`` in
+``sims_maf``), which holds cumulative r-band star counts for every HEALPix
+pixel (RING ordering) in a set of magnitude bins. Every run of the notebook
+loads the whole map and transforms every pixel to Galactic coordinates.
+
+`build_star_density_index` does that once, and stores as memory-mappable
+arrays:
+
+* the cumulative counts of every pixel in every magnitude bin,
+* the Galactic latitude of every pixel center,
+* the cumulative counts and area of the survey footprint (Dec below
+  `max_dec`) above each |b| in 1 degree steps, for each magnitude bin.
+
+A `StarDensityMap` on the index then answers "how many stars brighter than
+`mag_limit` are expected here, and what fraction of the area do they mask"
+for any (ra, dec) with a pixel lookup, without reading the rest of the map::
+
+    python star_density.py build starDensity_r_nside_64.npz star_density_index
+    python star_density.py query star_density_index 150.1 2.2 --mag-limit 24.7
+
+As in the notebook, the map values are taken as the number of stars in each
+pixel, and each star masks a circle of `mask_radius` arcseconds.
+"""
+from __future__ import print_function, division
+
+import os
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+try:
+    import healpy as hp
+except ImportError:
+    hp = None
+
+
+ARCSEC_PER_RADIAN = 206265.0
+
+# Edges of the |b| steps of the cumulative latitude curves, in degrees.
+LATITUDE_EDGES = np.arange(0, 91, 1.0)
+
+
+def _require_healpy():
+    if hp is None:
+        raise RuntimeError("healpy is required for star_density")
+
+def galactic_latitude(ra, dec):
+    """Galactic latitude in degrees of ICRS positions in degrees."""
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord
+    return SkyCoord(ra=ra, dec=dec, unit=(u.deg, u.deg), frame="icrs").galactic.b.deg
+
+def pixel_centers(nside):
+    """RA and Dec in degrees of the centers of all RING-ordered pixels."""
+    _require_healpy()
+    theta, phi = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)))
+    return np.degrees(phi), 90 - np.degrees(theta)
+
+def masked_fraction(counts, pixel_area, mask_radius=1.0):
+    """Fraction of `pixel_area` (steradians) masked by `counts` stars, each
+    masking a circle of `mask_radius` arcseconds.
+    """
+    return counts*np.pi*(mask_radius/ARCSEC_PER_RADIAN)**2/pixel_area
+
+
+def build_star_density_index(npz_path, index_dir, max_dec=0.0):
+    """Write the index arrays for a ``starDensity`` HEALPix map.
+
+    Parameters
+    ----------
+    npz_path : str
+        File with ``starDensity``, cumulative counts of shape
+        (n_pixels, n_bins), and ``bins``, the n_bins + 1 magnitude bin
+        edges. Column j counts the stars brighter than ``bins[j + 1]``.
+
+    index_dir : str
+        Directory to write; it is replaced if it exists.
+
+    max_dec : float
+        Only pixels with centers below this Dec (degrees) are included in the
+        latitude curves, as the survey footprint.
+    """
+    _require_healpy()
+    data = np.load(npz_path)
+    counts = np.asarray(data['starDensity'])
+    mags = np.asarray(data['bins'])[1:]
+    nside = hp.npix2nside(counts.shape[0])
+    ra, dec = pixel_centers(nside)
+    b = galactic_latitude(ra, dec)
+    pixel_area = 4*np.pi/counts.shape[0]
+
+    # Cumulative counts and area above each |b|, summed from the pole down.
+    footprint, = np.where(dec < max_dec)
+    b_idx = np.clip(np.digitize(np.abs(b[footprint]), LATITUDE_EDGES) - 1, 0, len(LATITUDE_EDGES) - 2)
+    n_steps = len(LATITUDE_EDGES) - 1
+    step_counts = np.zeros((n_steps, counts.shape[1]))
+    np.add.at(step_counts, b_idx, counts[footprint])
+    step_area = np.bincount(b_idx, minlength=n_steps)*pixel_area
+    counts_above_b = np.cumsum(step_counts[::-1], axis=0)[::-1]
+    area_above_b = np.cumsum(step_area[::-1])[::-1]
+
+    tmp_path = "{:s}.{:d}.tmp".format(index_dir, os.getpid())
+    os.makedirs(tmp_path)
+    arrays = {"counts": counts.astype(np.float32), "mags": mags, "galactic_b": b.astype(np.float32),
+              "counts_above_b": counts_above_b, "area_above_b": area_above_b}
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+    with open(os.path.join(tmp_path, "index.json"), "w") as f:
+        json.dump({"nside": nside, "nest": False, "max_dec": max_dec, "source": os.path.abspath(npz_path)},
+                  f, indent=1, sort_keys=True)
+
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.rename(tmp_path, index_dir)
+
+
+class StarDensityMap(object):
+    """Queries on an index written by `build_star_density_index`.
+
+    The arrays are memory-mapped, so only the pages holding the queried
+    pixels are read. All methods take scalars or arrays of positions.
+    """
+
+    def __init__(self, index_dir):
+        _require_healpy()
+        with open(os.path.join(index_dir, "index.json")) as f:
+            self.metadata = json.load(f)
+        self.nside = self.metadata["nside"]
+        self.pixel_area = hp.nside2pixarea(self.nside)
+
+        def load(name):
+            return np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r")
+        self.counts = load("counts")
+        self.mags = np.array(load("mags"))
+        self.galactic_b = load("galactic_b")
+        self.counts_above_b = load("counts_above_b")
+        self.area_above_b = np.array(load("area_above_b"))
+
+    def pixel(self, ra, dec):
+        """RING pixel index of positions in degrees."""
+        return hp.ang2pix(self.nside, np.radians(90 - np.asarray(dec)), np.radians(np.asarray(ra)))
+
+    def mag_column(self, mag_limit):
+        """Column of the stars brighter than `mag_limit`, rounded down to a bin
+        edge; -1 if it is brighter than the first edge.
+        """
+        return np.searchsorted(self.mags, mag_limit, side="right") - 1
+
+    def star_counts(self, ra, dec, mag_limit=24.7):
+        """Expected number of stars brighter than `mag_limit` in the pixel of each position."""
+        column = self.mag_column(mag_limit)
+        if column < 0:
+            return np.zeros(np.shape(ra))
+        return np.asarray(self.counts[self.pixel(ra, dec), column], dtype=float)
+
+    def density(self, ra, dec, mag_limit=24.7):
+        """Expected stars brighter than `mag_limit` per square degree."""
+        return self.star_counts(ra, dec, mag_limit)/(self.pixel_area*np.degrees(1)**2)
+
+    def masked_fraction(self, ra, dec, mag_limit=24.7, mask_radius=1.0):
+        """Expected fraction of the area masked by stars brighter than `mag_limit`."""
+        return masked_fraction(self.star_counts(ra, dec, mag_limit), self.pixel_area, mask_radius)
+
+    def latitude(self, ra, dec):
+        """Galactic latitude in degrees of the pixel center of each position."""
+        return np.asarray(self.galactic_b[self.pixel(ra, dec)], dtype=float)
+
+    def masked_fraction_above_latitude(self, b, mag_limit=24.7, mask_radius=1.0):
+        """Masked fraction of all the footprint area at Galactic latitudes
+        above |`b`| (rounded down to a whole degree), as in the notebook's
+        cumulative masked area fraction.
+        """
+        column = self.mag_column(mag_limit)
+        step = np.clip(np.floor(np.abs(b)).astype(int), 0, len(self.area_above_b) - 1)
+        if column < 0:
+            return np.zeros(np.shape(step))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return masked_fraction(self.counts_above_b[step, column], 1.0, mask_radius)/self.area_above_b[step]
+
+
+def _masked_fraction_above_latitude_direct(npz_path, lat, mag_limit=24.7, mask_radius=1.0):
+    """A full-sky re-implementation of the masked fraction above a latitude,
+    with the magnitude column and whole-degree latitude steps of the index.
+    Only kept to check the index in `run_density_benchmark`.
+    """
+    data = np.load(npz_path)
+    sel_mag_bin = np.searchsorted(data['bins'][1:], mag_limit, side="right") - 1
+    sum_density = data['starDensity'][:, sel_mag_bin]
+    pixel_area_str = 4*np.pi/float(len(sum_density))
+    nside = hp.npix2nside(len(sum_density))
+    ra, dec = pixel_centers(nside)
+    b = galactic_latitude(ra, dec)
+    sel, = np.where(dec < 0)
+    counts_above = np.sum(sum_density[sel][np.abs(b[sel]) >= lat])
+    area_above = pixel_area_str*np.sum(np.abs(b[sel]) >= lat)
+    return masked_fraction(counts_above, area_above, mask_radius)
+
+def _masked_fraction_above_latitude_notebook(npz_path, lat, mask_radius=1.0):
+    """The notebook's calculation of the masked fraction above a latitude,
+    with its indexing, for comparison in `run_density_benchmark`.
+
+    This differs from the index in two ways. The magnitude column is
+    ``argmin(|bins - 24.7|)`` into all of the bin edges, not ``bins[1:]``, so
+    it counts the stars brighter than the edge after the one nearest 24.7.
+    And |b| is histogrammed in ``linspace(0, 90, 50)`` bins (1.84 degrees
+    wide); `lat` is rounded to the nearest edge, and the fraction returned is
+    the one above the edge below that.
+    """
+    data = np.load(npz_path)
+    sel_mag_bin = np.argmin(np.abs(data['bins'] - 24.7))
+    sum_density = data['starDensity'][:, sel_mag_bin]
+    pixel_area_str = 4*np.pi/float(len(sum_density))
+    nside = hp.npix2nside(len(sum_density))
+    ra, dec = pixel_centers(nside)
+    b = galactic_latitude(ra, dec)
+    sel, = np.where(dec < 0)
+
+    b_bins = np.linspace(0, 90, 50)
+    differential_counts, _ = np.histogram(np.abs(b[sel]), weights=sum_density[sel], bins=b_bins)
+    cumulative_counts = np.cumsum(differential_counts[::-1])
+    b_bin_areas, _ = np.histogram(np.abs(b[sel]), weights=pixel_area_str*np.ones(len(sel)), bins=b_bins)
+    cumulative_area = np.cumsum(b_bin_areas[::-1])
+    cumulative_masked_fraction = masked_fraction(cumulative_counts, cumulative_area, mask_radius)
+    return cumulative_masked_fraction[np.argmin(np.abs(lat - b_bins[::-1]))]
+
+def _synthetic_star_density(npz_path, nside=64, seed=1234):
+    """Write a map with star counts rising towards the Galactic plane."""
+    rng = np.random.RandomState(seed)
+    bins = np.arange(15.0, 28.0, 0.5)
+    ra, dec = pixel_centers(nside)
+    b = galactic_latitude(ra, dec)
+    total = 2e4*np.exp(-np.abs(b)/15.0)*(1 + 0.1*rng.rand(len(ra)))
+    fraction = 10**(0.3*(np.minimum(bins[1:], 24.7) - 24.7))
+    np.savez(npz_path, starDensity=np.outer(total, fraction), bins=bins)
+
+def run_density_benchmark(n_queries=1000, seed=1234):
+    """Compares the notebook's full-sky calculation with index queries on a
+    synthetic nside 64 map. The index is checked against a direct
+    re-implementation, and the notebook's values, which use different bins
+    (see `_masked_fraction_above_latitude_notebook`), are printed next to it.
+    """
+    import tempfile
+    work_dir = tempfile.mkdtemp()
+    try:
+        npz_path = os.path.join(work_dir, "starDensity_r_nside_64.npz")
+        index_dir = os.path.join(work_dir, "index")
+        _synthetic_star_density(npz_path, seed=seed)
+
+        start = time.time()
+        notebook = [_masked_fraction_above_latitude_notebook(npz_path, lat) for lat in (20, 30)]
+        notebook_time = (time.time() - start)/2
+
+        start = time.time()
+        build_star_density_index(npz_path, index_dir)
+        build_time = time.time() - start
+
+        star_map = StarDensityMap(index_dir)
+        indexed = star_map.masked_fraction_above_latitude(np.array([20, 30]))
+        direct = [_masked_fraction_above_latitude_direct(npz_path, lat) for lat in (20, 30)]
+        assert np.allclose(direct, indexed), "Masked fractions differ between the index and a direct calculation."
+
+        rng = np.random.RandomState(seed)
+        ra, dec = 360*rng.rand(n_queries), np.degrees(np.arcsin(2*rng.rand(n_queries) - 1))
+        start = time.time()
+        for n in range(n_queries):
+            star_map.masked_fraction(ra[n], dec[n])
+        query_time = (time.time() - start)/n_queries
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("Notebook, per latitude:  {:.3f} s".format(notebook_time))
+    print("Index build (once):      {:.3f} s".format(build_time))
+    print("Index, per position:     {:.1f} us".format(1e6*query_time))
+    for lat, notebook_fraction, index_fraction in zip((20, 30), notebook, indexed):
+        print("Masked fraction at |b| > {:d}: notebook bins {:.4f}, index {:.4f}".format(lat, notebook_fraction,
+                                                                                         index_fraction))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    build_parser = subparsers.add_parser("build", help="Build an index from a starDensity map")
+    build_parser.add_argument("npz_path", help="starDensity_r_nside_64.npz from sims_maf")
+    build_parser.add_argument("index_dir", help="Directory for the index")
+    build_parser.add_argument("--max-dec", type=float, default=0.0,
+                              help="Footprint limit for the latitude curves (degrees)")
+
+    query_parser = subparsers.add_parser("query", help="Expected density and masked fraction at a position")
+    query_parser.add_argument("index_dir", help="Directory of the index")
+    query_parser.add_argument("ra", type=float)
+    query_parser.add_argument("dec", type=float)
+    query_parser.add_argument("--mag-limit", type=float, default=24.7)
+    query_parser.add_argument("--mask-radius", type=float, default=1.0, help="Mask radius (arcseconds)")
+
+    subparsers.add_parser("benchmark", help="Benchmark against the notebook's calculation on synthetic data")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_star_density_index(args.npz_path, args.index_dir, max_dec=args.max_dec)
+    elif args.command == "query":
+        star_map = StarDensityMap(args.index_dir)
+        b = star_map.latitude(args.ra, args.dec)
+        print("b = {:.1f} deg".format(float(b)))
+        print("{:.1f} stars/deg^2 brighter than r = {:.1f}".format(float(star_map.density(args.ra, args.dec,
+                                                                                            args.mag_limit)),
+                                                                    args.mag_limit))
+        print("Masked fraction here:      {:.4f}".format(float(star_map.masked_fraction(
+            args.ra, args.dec, args.mag_limit, args.mask_radius))))
+        print("Masked fraction above |b|: {:.4f}".format(float(star_map.masked_fraction_above_latitude(
+            b, args.mag_limit, args.mask_radius))))
+    elif args.command == "benchmark":
+        run_density_benchmark()
+    else:
+        parser.print_help()
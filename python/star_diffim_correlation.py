@@ -2,26 +2,43 @@
 from __future__ import print_function, division
 
 import os
+import time
+import traceback
+import collections
+import multiprocessing
 import numpy as np
 import argparse
 
-from astroquery.vizier import Vizier
 import astropy.coordinates as coord
 import astropy.units as u
+from scipy.spatial import cKDTree
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
+from refcat_cache import VizierReferenceCatalog, HealpixCatalogCache
+from forced_src_filter import corrected_snr, candidate_mask, load_candidates, load_candidate_ccds, \
+    candidates_path, candidate_ccds_path
+from stage_timing import StageTimer, print_stage_report, stage_report
+from prefetch import prefetch
+from star_density import StarDensityMap
+from run_manifest import RunManifest, dataset_fingerprints, file_fingerprint, plan_units, plan_report
+
+
+# Stages of `load_correlation_inputs`, which are overlapped with computation
+# by `iter_correlation_results`.
+LOAD_STAGES = ["butler_read", "candidates_read", "refcat_query", "calexp_md"]
 
 Base = declarative_base()
 class SourceDetectionCorrelation(Base):
     __tablename__ = "SourceDetectionCorrelations"
+    __table_args__ = (sqlalchemy.Index("ix_SourceDetectionCorrelations_visit_ccdnum", "visit", "ccdnum"),)
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     visit = sqlalchemy.Column(sqlalchemy.Integer)
     ccdnum = sqlalchemy.Column(sqlalchemy.Integer)
-    source_mag = sqlalchemy.Column(sqlalchemy.Float)
+    source_mag = sqlalchemy.Column(sqlalchemy.Float, index=True)
     detection_dists = relationship("DetectionDist")
 
     def dist_array(self):
@@ -42,17 +59,323 @@ class DetectionDist(Base):
     __tablename__ = "DetectionDists"
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-    source_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('SourceDetectionCorrelations.id'))
+    source_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('SourceDetectionCorrelations.id'),
+                                  index=True)
     dist = sqlalchemy.Column(sqlalchemy.Float)
     SNR = sqlalchemy.Column(sqlalchemy.Float)
 
     def __repr__(self):
-        return "<DetectionDist(dist={:.4f},SNR={:.2f}')>".format(self.dist)
+        return "<DetectionDist(dist={:.4f}, SNR={})>".format(self.dist, self.SNR)
+
+
+class CorrelatedCCD(Base):
+    """One row per (visit, ccdnum) task run by the driver, with its outcome.
+
+    With ``--star-density``, the Galactic latitude, expected star density and
+    expected masked fraction of the field are stored too; otherwise they are
+    NULL.
+    """
+    __tablename__ = "CorrelatedCCDs"
+    __table_args__ = (sqlalchemy.Index("ix_CorrelatedCCDs_visit_ccdnum", "visit", "ccdnum"),)
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    visit = sqlalchemy.Column(sqlalchemy.Integer)
+    ccdnum = sqlalchemy.Column(sqlalchemy.Integer)
+    status = sqlalchemy.Column(sqlalchemy.String)
+    elapsed = sqlalchemy.Column(sqlalchemy.Float)
+    galactic_b = sqlalchemy.Column(sqlalchemy.Float, nullable=True)
+    expected_star_density = sqlalchemy.Column(sqlalchemy.Float, nullable=True)
+    expected_masked_fraction = sqlalchemy.Column(sqlalchemy.Float, nullable=True)
+
+    def __repr__(self):
+        return "<CorrelatedCCD(visit={:d}, ccdnum={:d}, status='{}')>".format(self.visit, self.ccdnum,
+                                                                            self.status)
+
+
+# Columns of `CorrelatedCCD` filled from the `star_density` lookups of a
+# correlation.
+EXPECTED_DENSITY_COLUMNS = ["galactic_b", "expected_star_density", "expected_masked_fraction"]
+
+def add_missing_columns(engine):
+    """Add the nullable `CorrelatedCCD` columns that databases written by
+    older versions of this script lack. Call after ``create_all``.
+    """
+    ccd_table = CorrelatedCCD.__table__
+    existing = set(column["name"] for column in sqlalchemy.inspect(engine).get_columns(ccd_table.name))
+    with engine.begin() as conn:
+        for name in EXPECTED_DENSITY_COLUMNS:
+            if name not in existing:
+                conn.execute(sqlalchemy.text('ALTER TABLE "{:s}" ADD COLUMN {:s} FLOAT'.format(ccd_table.name,
+                                                                                           name)))
+
+def enable_sqlite_wal(engine):
+    """Switch every connection made by `engine` to write-ahead logging.
+
+    With WAL, readers (e.g. the analysis notebook) don't block the writer, and
+    commits don't need to rewrite the main database file. This has no effect
+    on in-memory databases.
+    """
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+class BulkCorrelationWriter(object):
+    """Writes star/detection correlations with Core executemany inserts.
+
+    Rather than building ORM objects for every star and detection, rows are
+    buffered as plain dicts with ids allocated here, and inserted in large
+    batches with one transaction per batch. Only one writer may be active on
+    a database at a time, since ids are allocated from the current maximum.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine for the correlation database, with the tables already created.
+
+    batch_size : int
+        Number of buffered rows (of both correlation tables) that triggers a
+        flush in `add_status`.
+
+    bright_star_path : str, optional
+        File to append the bright stars given to `add_ccd` to. They are
+        written in the transaction of their CCD's rows, before it commits,
+        and bright stars of CCDs without committed results (from a run that
+        was interrupted in between) are removed when the writer is created,
+        so a resumed run never writes the bright stars of a CCD twice.
+    """
+
+    def __init__(self, engine, batch_size=200000, bright_star_path=None):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.bright_star_path = bright_star_path
+        if bright_star_path is not None:
+            remove_uncommitted_bright_stars(engine, bright_star_path)
+
+        self._source_table = SourceDetectionCorrelation.__table__
+        self._dist_table = DetectionDist.__table__
+        self._ccd_table = CorrelatedCCD.__table__
+        with engine.connect() as conn:
+            max_source_id = conn.execute(sqlalchemy.select(sqlalchemy.func.max(self._source_table.c.id))).scalar()
+            max_dist_id = conn.execute(sqlalchemy.select(sqlalchemy.func.max(self._dist_table.c.id))).scalar()
+        self._next_source_id = (max_source_id or 0) + 1
+        self._next_dist_id = (max_dist_id or 0) + 1
+
+        self._source_rows = []
+        self._dist_rows = []
+        self._ccd_rows = collections.OrderedDict()
+        self._bright_stars = []
+
+    def add_ccd(self, visit, ccdnum, source_mags, star_idx, dists, SNRs, bright_stars=None):
+        """Add the correlations for one CCD.
+
+        Parameters
+        ----------
+        source_mags : array
+            Magnitude of each reference star.
+
+        star_idx : array
+            Index into `source_mags` for each star/detection pair.
+
+        dists : array
+            Star/detection distance for each pair, in arcseconds.
+
+        SNRs : array
+            SNR of the detection in each pair.
+
+        bright_stars : list of str, optional
+            Lines for the bright star file, if the writer has a
+            `bright_star_path`.
+        """
+        if self.bright_star_path is not None and bright_stars:
+            self._bright_stars.extend(bright_stars)
+        source_ids = np.arange(self._next_source_id, self._next_source_id + len(source_mags))
+        self._next_source_id += len(source_mags)
+        dist_ids = np.arange(self._next_dist_id, self._next_dist_id + len(star_idx))
+        self._next_dist_id += len(star_idx)
+
+        self._source_rows.extend({"id": source_id, "visit": visit, "ccdnum": ccdnum, "source_mag": mag}
+                                 for source_id, mag in zip(source_ids.tolist(),
+                                                           np.asarray(source_mags, dtype=float).tolist()))
+        self._dist_rows.extend({"id": dist_id, "source_id": source_id, "dist": dist, "SNR": SNR}
+                               for dist_id, source_id, dist, SNR in zip(dist_ids.tolist(),
+                                                                        source_ids[star_idx].tolist(),
+                                                                        np.asarray(dists, dtype=float).tolist(),
+                                                                        np.asarray(SNRs, dtype=float).tolist()))
+
+    def add_status(self, visit, ccdnum, status, elapsed, correlation=None):
+        """Record the outcome of one (visit, ccdnum) task, and the expected
+        star density of its field if `correlation` has them.
+
+        Call after `add_ccd` for the same CCD. Batches are only flushed here,
+        so the status row is committed in the same transaction as the CCD's
+        correlations, and a CCD is only marked done once its rows are written.
+        The status replaces any recorded for the CCD by an earlier run.
+        """
+        row = {"visit": visit, "ccdnum": ccdnum, "status": status, "elapsed": elapsed}
+        for name in EXPECTED_DENSITY_COLUMNS:
+            row[name] = correlation.get(name) if correlation is not None else None
+        self._ccd_rows[(visit, ccdnum)] = row
+
+        if len(self._source_rows) + len(self._dist_rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert all buffered rows in a single transaction, replacing the
+        earlier status rows of the buffered CCDs, and append the buffered
+        bright stars before it commits.
+        """
+        if len(self._source_rows) == 0 and len(self._ccd_rows) == 0:
+            return
+        ccd_rows = list(self._ccd_rows.values())
+        with self.engine.begin() as conn:
+            if len(ccd_rows) > 0:
+                ccd_table = self._ccd_table
+                conn.execute(ccd_table.delete().where(sqlalchemy.and_(
+                    ccd_table.c.visit == sqlalchemy.bindparam("old_visit"),
+                    ccd_table.c.ccdnum == sqlalchemy.bindparam("old_ccdnum"))),
+                    [{"old_visit": row["visit"], "old_ccdnum": row["ccdnum"]} for row in ccd_rows])
+            for table, rows in [(self._source_table, self._source_rows),
+                                (self._dist_table, self._dist_rows),
+                                (self._ccd_table, ccd_rows)]:
+                if len(rows) > 0:
+                    conn.execute(table.insert(), rows)
+            if len(self._bright_stars) > 0:
+                with open(self.bright_star_path, mode="a") as f:
+                    f.writelines(line + "\n" for line in self._bright_stars)
+                    f.flush()
+                    os.fsync(f.fileno())
+        self._source_rows = []
+        self._dist_rows = []
+        self._ccd_rows = collections.OrderedDict()
+        self._bright_stars = []
+
+def completed_ccds(engine):
+    """Returns the set of (visit, ccdnum) pairs that already have results in
+    the database, either recorded by the driver or (for databases written
+    before `CorrelatedCCD` existed) present in the correlation table.
+    """
+    ccd_table = CorrelatedCCD.__table__
+    source_table = SourceDetectionCorrelation.__table__
+    with engine.connect() as conn:
+        done = set(conn.execute(sqlalchemy.select(ccd_table.c.visit, ccd_table.c.ccdnum)
+                                .where(ccd_table.c.status == "ok")).fetchall())
+        done.update(conn.execute(sqlalchemy.select(source_table.c.visit, source_table.c.ccdnum)
+                                 .distinct()).fetchall())
+    return set((visit, ccdnum) for visit, ccdnum in done)
+
+def ccd_outputs(engine):
+    """The database outputs of every CCD with a task status, as recorded in
+    a run manifest.
+
+    Returns
+    -------
+    outputs : dict
+        Maps (visit, ccdnum) to a dict of the ``status`` and the number of
+        star rows, ``n_stars``.
+    """
+    ccd_table = CorrelatedCCD.__table__
+    source_table = SourceDetectionCorrelation.__table__
+    with engine.connect() as conn:
+        outputs = dict(((visit, ccdnum), {"status": status, "n_stars": 0}) for visit, ccdnum, status in
+                       conn.execute(sqlalchemy.select(ccd_table.c.visit, ccd_table.c.ccdnum, ccd_table.c.status)))
+        counts = conn.execute(sqlalchemy.select(source_table.c.visit, source_table.c.ccdnum,
+                                                sqlalchemy.func.count())
+                              .group_by(source_table.c.visit, source_table.c.ccdnum))
+        for visit, ccdnum, n_stars in counts:
+            if (visit, ccdnum) in outputs:
+                outputs[(visit, ccdnum)]["n_stars"] = n_stars
+    return outputs
+
+def delete_ccd_rows(engine, ccds):
+    """Delete the correlations and task statuses of some (visit, ccdnum) pairs.
+
+    Returns
+    -------
+    n_deleted : int
+        Number of star rows deleted.
+    """
+    source_table = SourceDetectionCorrelation.__table__
+    dist_table = DetectionDist.__table__
+    ccd_table = CorrelatedCCD.__table__
+    n_deleted = 0
+    with engine.begin() as conn:
+        for visit, ccdnum in ccds:
+            source_ids = sqlalchemy.select(source_table.c.id).where((source_table.c.visit == visit) &
+                                                                    (source_table.c.ccdnum == ccdnum))
+            conn.execute(dist_table.delete().where(dist_table.c.source_id.in_(source_ids)))
+            n_deleted += conn.execute(source_table.delete().where((source_table.c.visit == visit) &
+                                                                  (source_table.c.ccdnum == ccdnum))).rowcount
+            conn.execute(ccd_table.delete().where((ccd_table.c.visit == visit) & (ccd_table.c.ccdnum == ccdnum)))
+    return n_deleted
+
+def remove_bright_stars(bright_star_path, ccds):
+    """Rewrite the bright star file without the stars of some (visit, ccdnum) pairs.
+
+    Returns
+    -------
+    n_removed : int
+    """
+    ccds = set(ccds)
+    if not ccds or not os.path.exists(bright_star_path):
+        return 0
+    n_removed = 0
+    tmp_path = "{:s}.{:d}.tmp".format(bright_star_path, os.getpid())
+    with open(bright_star_path) as f, open(tmp_path, "w") as out:
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) == 5 and (int(fields[3]), int(fields[4])) in ccds:
+                n_removed += 1
+            else:
+                out.write(line)
+    os.rename(tmp_path, bright_star_path)
+    return n_removed
+
+def remove_uncommitted_bright_stars(engine, bright_star_path):
+    """Remove the bright stars of CCDs without committed results in the
+    database (see `BulkCorrelationWriter`).
+
+    Returns
+    -------
+    n_removed : int
+    """
+    if not os.path.exists(bright_star_path):
+        return 0
+    with open(bright_star_path) as f:
+        ccds = set((int(fields[3]), int(fields[4])) for fields in (line.strip().split(",") for line in f)
+                   if len(fields) == 5)
+    return remove_bright_stars(bright_star_path, ccds - completed_ccds(engine))
+
 
+def match_to_image_sources(catalog_sources, image_sources):
+    """Finds the nearest image source to each catalog source.
 
-def compute_shift(catalog_sources, image_sources):
+    This is the one match shared by `compute_shift` and `is_edge_object`.
+
+    Returns
+    -------
+    idx : array
+        Index into `image_sources` for each entry in `catalog_sources`.
+    separations : Angle
+        Distance to the matched source.
+    """
+    if len(catalog_sources) == 0 or len(image_sources) == 0:
+        return np.zeros(len(catalog_sources), dtype=int), coord.Angle(np.full(len(catalog_sources), np.inf), u.rad)
+    tree = cKDTree(_unit_vectors(image_sources))
+    chords, idx = tree.query(_unit_vectors(catalog_sources))
+    return idx, coord.Angle(2*np.arcsin(np.minimum(0.5*chords, 1.0)), u.rad)
+
+def compute_shift(catalog_sources, image_sources, idx=None):
     """Computes a small shift between two input catalogs
 
+    Parameters
+    ----------
+    idx : array, optional
+        Nearest image source to each catalog source, from
+        `match_to_image_sources`. Computed here if not given.
+
     Returns
     -------
     delta_ra : float
@@ -61,7 +384,8 @@ def compute_shift(catalog_sources, image_sources):
         Shift in Dec between the catalogs.
     """
 
-    idx, d2, _ = catalog_sources.match_to_catalog_sky(image_sources)
+    if idx is None:
+        idx, _ = match_to_image_sources(catalog_sources, image_sources)
 
     all_delta_ra = image_sources[idx].ra - catalog_sources.ra
     all_delta_dec = image_sources[idx].dec - catalog_sources.dec
@@ -74,13 +398,45 @@ def compute_shift(catalog_sources, image_sources):
 
     return delta_ra, delta_dec
 
-def is_edge_object(catalog_sources, image_sources, image_xs, image_ys):
+def wcs_from_metadata(metadata):
+    """Builds an astropy WCS and the image size from exposure metadata (e.g.
+    ``calexp_md``), or returns None if it does not describe a celestial WCS.
+
+    Returns
+    -------
+    wcs : astropy.wcs.WCS
+    width, height : int
+    """
+    import warnings
+    import astropy.wcs
+    from astropy.io import fits
+
+    header = fits.Header()
+    for key, value in metadata.toDict().items():
+        if isinstance(value, (list, tuple)):
+            value = value[-1]
+        try:
+            header[key] = value
+        except (ValueError, KeyError):
+            pass
+    if "NAXIS1" not in header or "NAXIS2" not in header:
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        wcs = astropy.wcs.WCS(header)
+    if not wcs.has_celestial:
+        return None
+    return wcs, header["NAXIS1"], header["NAXIS2"]
+
+def is_edge_object(catalog_sources, image_sources, image_xs, image_ys, idx=None, wcs=None,
+                   image_size=(2025, 4070), buffer_size=60/0.2632):
     """Returns True for each catalog source if it is near the edge of a chip
 
-    Since we don't have access to the image WCS without downloading all of the
-    images themselves, this instead finds the closest source star (which has
-    its pixel coordinates in the catalog entry) to estimate the catalog star's
-    position.
+    If `wcs` is given, the catalog positions are transformed to pixels with it
+    directly. Otherwise (since we may not have the image WCS without
+    downloading all of the images themselves) this finds the closest source
+    star, which has its pixel coordinates in the catalog entry, to estimate
+    the catalog star's position.
 
     Parameters
     ----------
@@ -96,25 +452,113 @@ def is_edge_object(catalog_sources, image_sources, image_xs, image_ys):
     image_ys: array
         Pixel y-coordinate for sources in `image_sources`.
 
+    idx : array, optional
+        Nearest image source to each catalog source, from
+        `match_to_image_sources`. Computed here if needed and not given.
+
+    wcs : astropy.wcs.WCS, optional
+        WCS of the image.
+
+    image_size : (int, int)
+        Width and height of the image in pixels.
+
+    buffer_size : float
+        Width of the edge region in pixels (60 arcsec at 0.2632 arcsec/pixel
+        by default).
     """
 
-    idx, d2, _ = catalog_sources.match_to_catalog_sky(image_sources)
+    if wcs is not None:
+        xs, ys = wcs.all_world2pix(catalog_sources.ra.deg, catalog_sources.dec.deg, 0)
+    else:
+        if idx is None:
+            idx, _ = match_to_image_sources(catalog_sources, image_sources)
+        xs = np.asarray(image_xs)[idx]
+        ys = np.asarray(image_ys)[idx]
 
     # Objects that are close to the edge of the chip
-    # pixelsize is 0.2632 arcsec
-    buffer_size = 60/0.2632
-    edge_object = (image_xs[idx] < buffer_size) | \
-                  (image_xs[idx] > 2025 - buffer_size) | \
-                  (image_ys[idx] < buffer_size) | \
-                  (image_ys[idx] > 4070 - buffer_size)
+    width, height = image_size
+    edge_object = (xs < buffer_size) | \
+                  (xs > width - buffer_size) | \
+                  (ys < buffer_size) | \
+                  (ys > height - buffer_size)
     return edge_object
 
-def star_diffim_correlation(visit, ccdnum, butler, sql_session=None, debug=False):
+def _unit_vectors(catalog):
+    """Returns an (N, 3) array of unit vectors for the positions in `catalog`."""
+    ra = catalog.ra.radian
+    dec = catalog.dec.radian
+    return np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+
+def correlate_detections(star_catalog, detection_catalog, radius=1*u.arcmin):
+    """Find all detections within `radius` of each star.
+
+    This builds one KD-tree over the unit vectors of the stars and one over
+    the detections, and finds all pairs closer than the chord length
+    corresponding to `radius` in a single call, rather than computing the
+    separation from each star to the full detection catalog.
+
+    Parameters
+    ----------
+    star_catalog : SkyCoord
+        Positions of the reference stars.
+
+    detection_catalog : SkyCoord
+        Positions of the diffim detections.
+
+    radius : Angle or Quantity
+        Maximum separation between a star and a detection.
+
+    Returns
+    -------
+    star_idx : array
+        Index into `star_catalog` for each star/detection pair, sorted so that
+        all pairs for a given star are contiguous.
+    detection_idx : array
+        Index into `detection_catalog` for each pair.
+    separations : Angle
+        On-sky separation of each pair.
+    """
+    if len(star_catalog) == 0 or len(detection_catalog) == 0:
+        empty = np.array([], dtype=int)
+        return empty, empty, coord.Angle(np.array([]), u.deg)
+
+    max_chord = 2*np.sin(0.5*coord.Angle(radius).radian)
+    star_tree = cKDTree(_unit_vectors(star_catalog))
+    detection_tree = cKDTree(_unit_vectors(detection_catalog))
+    pairs = star_tree.sparse_distance_matrix(detection_tree, max_chord, output_type="ndarray")
+
+    separations = 2*np.arcsin(np.minimum(0.5*pairs['v'], 1.0))
+    # Keep the strict inequality used by the per-star loop.
+    sel, = np.where(separations < coord.Angle(radius).radian)
+    order = sel[np.lexsort((pairs['j'][sel], pairs['i'][sel]))]
+    return (pairs['i'][order].astype(int), pairs['j'][order].astype(int),
+            coord.Angle(separations[order], u.radian))
+
+def _correlate_detections_per_star(star_catalog, detection_catalog, radius=1*u.arcmin):
+    """Reference implementation of `correlate_detections` using one separation
+    computation per star. Only kept for benchmarking.
+    """
+    star_idx = []
+    detection_idx = []
+    separations = []
+    for n, star_coord in enumerate(star_catalog):
+        dists = star_coord.separation(detection_catalog)
+        sel, = np.where(dists < radius)
+        star_idx.append(np.zeros(len(sel), dtype=int) + n)
+        detection_idx.append(sel)
+        separations.append(dists[sel].deg)
+    return (np.concatenate(star_idx), np.concatenate(detection_idx),
+            coord.Angle(np.concatenate(separations), u.deg))
+
+def star_diffim_correlation(visit, ccdnum, butler, sql_session=None, debug=False, refcat=None,
+                            writer=None, bright_star_file=None, candidates_dir=None, use_wcs=True, timer=None,
+                            star_density=None):
     """Find bright stars in the field and their diffim sources.
 
-    This pulls the UCAC4 catalog from Vizier, centered on the chip center. It
-    then selects only UCAC4 stars that are on the chip and away from chip
-    edges.
+    This pulls the UCAC4 catalog from `refcat` (by default, directly from
+    Vizier), centered on the chip center. It then selects only UCAC4 stars
+    that are on the chip and away from chip edges, using the calexp WCS and
+    size from ``calexp_md`` if `use_wcs` is set and they can be read.
 
     Since the UCAC4 sources don't quite line up with their corresponding stars
     on the decam images, it finds the nearest source to each UCAC4 star,
@@ -124,51 +568,171 @@ def star_diffim_correlation(visit, ccdnum, butler, sql_session=None, debug=False
 
     The shift might be due to processing the images without TPV support.
 
-    After shifting the UCAC sources, it loops through them and finds all
-    diffim sources within one arcminute, then if `sql_session` is supplied, it
-    adds these distance between the source star and the diffim detection to
-    the database.
+    After shifting the UCAC sources, it finds all diffim sources within one
+    arcminute of every star in a single search (see `correlate_detections`),
+    then if `sql_session` is supplied, it adds these distance between the
+    source star and the diffim detection to the database. If `writer` (a
+    `BulkCorrelationWriter`) is supplied, the same rows are written through it
+    instead of the ORM. Stars brighter than 9th magnitude are appended to
+    `bright_star_file`, if given.
+
+    The diffim sources are those passing the forced photometry SNR cut. If
+    `candidates_dir` is given they are read from the visit's candidate file
+    written by ``forced_src_filter.py``; otherwise the cut is applied here to
+    the diaSrc and forced_src catalogs.
 
+    The time spent in each stage (butler reads, reference catalog query,
+    filtering, matching, edge test, correlation, and writing) is recorded in
+    `timer`, a `stage_timing.StageTimer`, if given.
+
+    The reads are done by `load_correlation_inputs` and the rest by
+    `correlate_inputs`, which can be run on different threads to overlap the
+    I/O of one CCD with the computation of another (see
+    `iter_correlation_results`).
+
+    If `star_density` (a `star_density.StarDensityMap`) is given, the
+    expected density of stars brighter than r = 24.7 and the fraction of the
+    area they mask are looked up at the field center.
+
+    Returns
+    -------
+    correlation : dict or None
+        The shifted star positions and magnitudes, and the star/detection
+        pairs as plain arrays (see `write_correlation`), along with the
+        shift (`delta_ra`, `delta_dec`, in arcseconds), the number of edge
+        stars (`n_edge`), and the time spent matching stars to sources
+        (`match_time`). With `star_density`, also the Galactic latitude
+        (`galactic_b`), expected stars per square degree
+        (`expected_star_density`) and masked fraction
+        (`expected_masked_fraction`) of the field. None if the input catalogs
+        could not be loaded.
     """
 
+    if timer is None:
+        timer = StageTimer(visit=visit, ccdnum=ccdnum)
+    inputs = load_correlation_inputs(visit, ccdnum, butler, refcat=refcat, candidates_dir=candidates_dir,
+                                     use_wcs=use_wcs, timer=timer)
+    if inputs is None:
+        return
+    return correlate_inputs(inputs, sql_session=sql_session, writer=writer, bright_star_file=bright_star_file,
+                            timer=timer, star_density=star_density)
+
+def load_correlation_inputs(visit, ccdnum, butler, refcat=None, candidates_dir=None, use_wcs=True, timer=None):
+    """Read everything `star_diffim_correlation` needs for one CCD: the src
+    catalog, the diffim sources (the diaSrc and forced_src catalogs, or the
+    candidates from `candidates_dir`), the UCAC4 stars around the field center
+    from `refcat`, and, if `use_wcs` is set, the calexp WCS and size.
+
+    This is all of the I/O of the correlation, so that it can run ahead in
+    another thread (see `iter_correlation_inputs`). The time of each read is
+    recorded in `timer`, if given, in the `LOAD_STAGES`.
+
+    Returns
+    -------
+    inputs : dict or None
+        Passed to `correlate_inputs`. None if the catalogs could not be
+        loaded, or, with `candidates_dir`, if they were not ingested.
+    """
+    if timer is None:
+        timer = StageTimer(visit=visit, ccdnum=ccdnum)
+
+    inputs = {"visit": visit, "ccdnum": ccdnum}
+    if candidates_dir is not None:
+        with timer.stage("candidates_read") as stage:
+            ccds = load_candidate_ccds(candidates_dir, visit)
+            ingested, = np.where(ccds["ccdnum"] == ccdnum)
+            if len(ingested) == 0:
+                print("No diffim sources ingested for visit={:d}, ccdnum={:d}, skipping.".format(visit, ccdnum))
+                return
+            inputs["n_diasources"] = int(ccds["n_sources"][ingested[0]])
+            inputs["candidates"] = load_candidates(candidates_dir, visit, ccdnum)
+            stage["rows"] = len(inputs["candidates"])
+            stage["bytes"] = inputs["candidates"].nbytes + ccds.nbytes
 
     try:
-        src = butler.get("src", visit=visit, ccdnum=ccdnum, immediate=True)
-        diff_src = butler.get("deepDiff_diaSrc", visit=visit, ccdnum=ccdnum, immediate=True)
-        diff_force_src = butler.get("forced_src", visit=visit, ccdnum=ccdnum, immediate=True)
+        with timer.stage("butler_read") as stage:
+            inputs["src"] = butler.get("src", visit=visit, ccdnum=ccdnum, immediate=True)
+            datasets = ["src"]
+            stage["rows"] = len(inputs["src"])
+            if candidates_dir is None:
+                inputs["diff_src"] = butler.get("deepDiff_diaSrc", visit=visit, ccdnum=ccdnum, immediate=True)
+                inputs["diff_force_src"] = butler.get("forced_src", visit=visit, ccdnum=ccdnum, immediate=True)
+                datasets += ["deepDiff_diaSrc", "forced_src"]
+                stage["rows"] += len(inputs["diff_src"]) + len(inputs["diff_force_src"])
+            stage["bytes"] = _dataset_bytes(butler, datasets, visit=visit, ccdnum=ccdnum)
     except RuntimeError:
         # It would be nice if we had something more specific than "RuntimeError", but this at least
         # stops us from catching some mapper problems.
         print("Could not load data for visit={:d}, ccdnum={:d}, skipping.".format(visit, ccdnum))
         return
 
-    center_ra = np.degrees(np.median(src.get('coord_ra')))
-    center_dec = np.degrees(np.median(src.get('coord_dec')))
-    print("Field center: {:.3f}, {:.3f}".format(center_ra, center_dec))
-
+    src = inputs["src"]
+    inputs["center_ra"] = np.degrees(np.median(src.get('coord_ra')))
+    inputs["center_dec"] = np.degrees(np.median(src.get('coord_dec')))
 
     # I/322A = UCAC4
-    columns = ['RAJ2000', 'DEJ2000', 'f.mag', 'a.mag']
-    vz = Vizier(columns=columns, row_limit=2000)
-    ucac_results = vz.query_region(coord.SkyCoord(ra=center_ra, dec=center_dec,
-                                                    unit=(u.deg, u.deg), frame='icrs'),
-                                     radius=coord.Angle(0.3, "deg"),
-                                     catalog='I/322A')
-
-    ucac_catalog = coord.SkyCoord(ra=ucac_results[0]['RAJ2000'],
-                                  dec=ucac_results[0]['DEJ2000'],
-                                  unit=(u.deg, u.deg), frame="icrs")
-
-    diff_ra = np.degrees(diff_src.get('coord_ra'))
-    diff_dec = np.degrees(diff_src.get('coord_dec'))
+    if refcat is None:
+        refcat = VizierReferenceCatalog()
+    with timer.stage("refcat_query") as stage:
+        inputs["ucac_results"] = refcat.query_cone(inputs["center_ra"], inputs["center_dec"], 0.3)
+        stage["rows"] = len(inputs["ucac_results"])
+        stage["bytes"] = inputs["ucac_results"].nbytes
+
+    inputs["wcs_and_size"] = None
+    if use_wcs:
+        with timer.stage("calexp_md"):
+            try:
+                inputs["wcs_and_size"] = wcs_from_metadata(butler.get("calexp_md", visit=visit, ccdnum=ccdnum,
+                                                                      immediate=True))
+            except RuntimeError:
+                pass
+    return inputs
+
+def correlate_inputs(inputs, sql_session=None, writer=None, bright_star_file=None, timer=None, star_density=None):
+    """The computation of `star_diffim_correlation`, on the `inputs` read by
+    `load_correlation_inputs`. Reads nothing, except for `star_density`
+    lookups.
+    """
+    visit, ccdnum = inputs["visit"], inputs["ccdnum"]
+    src = inputs["src"]
+    ucac_results = inputs["ucac_results"]
+    if timer is None:
+        timer = StageTimer(visit=visit, ccdnum=ccdnum)
 
-    forced_src_SNR = (diff_force_src['base_PsfFlux_flux'] - diff_force_src['template_base_PsfFlux_flux']) /  \
-                    np.sqrt(diff_force_src['base_PsfFlux_fluxSigma']**2 + diff_force_src['template_base_PsfFlux_fluxSigma']**2)
-    sel_filtered_diasources, = np.where((np.abs(forced_src_SNR) > 5.0) & (diff_src['classification_dipole'] == 0))
-    filtered_SNRs = forced_src_SNR[sel_filtered_diasources]
+    center_ra, center_dec = inputs["center_ra"], inputs["center_dec"]
+    print("Field center: {:.3f}, {:.3f}".format(center_ra, center_dec))
+    if star_density is not None:
+        expected = {"galactic_b": float(star_density.latitude(center_ra, center_dec)),
+                    "expected_star_density": float(star_density.density(center_ra, center_dec)),
+                    "expected_masked_fraction": float(star_density.masked_fraction(center_ra, center_dec))}
+        print("b = {galactic_b:.1f}, expected {expected_star_density:.0f} stars/deg^2, "
+              "masked fraction {expected_masked_fraction:.4f}".format(**expected))
+
+    ucac_catalog = coord.SkyCoord(ra=ucac_results['RAJ2000'],
+                                  dec=ucac_results['DEJ2000'],
+                                  unit=(u.deg, u.deg), frame="icrs")
 
-    diasource_catalog = coord.SkyCoord(ra=diff_ra[sel_filtered_diasources], dec=diff_dec[sel_filtered_diasources],
-                                       unit=(u.deg, u.deg), frame="icrs")
+    with timer.stage("filter") as stage:
+        if "candidates" not in inputs:
+            diff_src, diff_force_src = inputs["diff_src"], inputs["diff_force_src"]
+            forced_src_SNR = corrected_snr(diff_force_src['base_PsfFlux_flux'],
+                                           diff_force_src['base_PsfFlux_fluxSigma'],
+                                           diff_force_src['template_base_PsfFlux_flux'],
+                                           diff_force_src['template_base_PsfFlux_fluxSigma'])
+            sel_filtered_diasources, = np.where(candidate_mask(forced_src_SNR, diff_src['classification_dipole']))
+            filtered_SNRs = forced_src_SNR[sel_filtered_diasources]
+            filtered_ra = np.degrees(diff_src.get('coord_ra'))[sel_filtered_diasources]
+            filtered_dec = np.degrees(diff_src.get('coord_dec'))[sel_filtered_diasources]
+            n_diasources = len(diff_src)
+        else:
+            candidates = inputs["candidates"]
+            filtered_SNRs = candidates['SNR']
+            filtered_ra = np.degrees(candidates['coord_ra'])
+            filtered_dec = np.degrees(candidates['coord_dec'])
+            n_diasources = inputs["n_diasources"]
+        stage["rows"] = len(filtered_SNRs)
+
+    diasource_catalog = coord.SkyCoord(ra=filtered_ra, dec=filtered_dec, unit=(u.deg, u.deg), frame="icrs")
 
     assert len(diasource_catalog) == len(filtered_SNRs), "SNR array and DIA catalog lengths must match."
 
@@ -178,43 +742,132 @@ def star_diffim_correlation(visit, ccdnum, butler, sql_session=None, debug=False
                                     dec=src.get('coord_dec'),
                                     unit=(u.rad, u.rad), frame="icrs")
 
-    ucac_edge_object = is_edge_object(ucac_catalog, source_catalog,
-                                      sources_x, sources_y)
+    #
+    # Match the UCAC stars to the nearest image sources once; this is used for
+    # the edge test (unless we have the WCS) and for the shift.
+    #
+    with timer.stage("match") as stage:
+        ucac_match_idx, _ = match_to_image_sources(ucac_catalog, source_catalog)
+        stage["rows"] = len(ucac_catalog)
+    match_time = stage["wall"]
+    print("Matched {:d} UCAC obj to {:d} sources in {:.3f} s".format(len(ucac_catalog), len(source_catalog),
+                                                                  match_time))
+
+    with timer.stage("edge_test") as stage:
+        wcs = None
+        image_size = (2025, 4070)
+        if inputs["wcs_and_size"] is not None:
+            wcs, width, height = inputs["wcs_and_size"]
+            image_size = (width, height)
+
+        ucac_edge_object = is_edge_object(ucac_catalog, source_catalog,
+                                          sources_x, sources_y, idx=ucac_match_idx,
+                                          wcs=wcs, image_size=image_size)
+        stage["rows"] = len(ucac_edge_object)
 
 
     print("Total UCAC obj {:d}, ok obj {:d}".format(len(ucac_edge_object),
                                                     np.sum(~ucac_edge_object)))
 
-    ok_ucac =np.argwhere(~ucac_edge_object)
-    ok_ucac_mags = ucac_results[0]['f.mag'][ok_ucac]
+    ok_ucac, = np.where(~ucac_edge_object)
+    ok_ucac_mags = ucac_results['f.mag'][ok_ucac]
 
     #
     # There's some shift between our image and the UCAC catalog. It is small,
     # so I find the median shift to the nearest decam object, then apply that to the
     # all the UCAC sources. Pretty sure this is because I'm not using the TPV headers.
     #
-    delta_ra, delta_dec = compute_shift(ucac_catalog[ok_ucac], source_catalog)
+    delta_ra, delta_dec = compute_shift(ucac_catalog[ok_ucac], source_catalog, idx=ucac_match_idx[ok_ucac])
 
     shifted_ucac = coord.SkyCoord(ra=ucac_catalog.ra[ok_ucac] + np.median(delta_ra),
                                   dec=ucac_catalog.dec[ok_ucac] + np.median(delta_dec),
                                   frame='icrs')
 
 
-    bright_star_file = open("bright_star_file", mode="a")
-    print(len(sources_x), len(diasource_catalog), len(diff_src))
-    for ucac_coord,ucac_mag in zip(shifted_ucac, ok_ucac_mags):
-        dists = ucac_coord.separation(diasource_catalog)
-        sel, = np.where(dists < 1*u.arcmin)
-        #print(ucac_mag, np.sort(dists[sel].to(u.arcsec)))
-        if ucac_mag < 9:
-            print("{},{},{},{},{}".format(ucac_coord.ra.deg, ucac_coord.dec.deg, ucac_mag, visit, ccdnum), file=bright_star_file)
+    shifted_ra = shifted_ucac.ra.deg
+    shifted_dec = shifted_ucac.dec.deg
+
+    #
+    # Find all of the star/diasource pairs at once.
+    #
+    print(len(sources_x), len(diasource_catalog), n_diasources)
+    with timer.stage("correlate") as stage:
+        star_idx, detection_idx, separations = correlate_detections(shifted_ucac, diasource_catalog)
+        pair_dists = separations.to(u.arcsec).value
+        pair_SNRs = np.asarray(filtered_SNRs)[detection_idx]
+        stage["rows"] = len(star_idx)
+
+    correlation = {"visit": visit, "ccdnum": ccdnum,
+                   "source_ra": shifted_ra, "source_dec": shifted_dec, "source_mags": ok_ucac_mags,
+                   "star_idx": star_idx, "dists": pair_dists, "SNRs": pair_SNRs,
+                   "delta_ra": delta_ra.to(u.arcsec).value, "delta_dec": delta_dec.to(u.arcsec).value,
+                   "n_edge": int(np.sum(ucac_edge_object)), "match_time": match_time}
+    if star_density is not None:
+        correlation.update(expected)
+    if sql_session is not None or writer is not None or bright_star_file is not None:
+        with timer.stage("write") as stage:
+            write_correlation(correlation, sql_session=sql_session, writer=writer, bright_star_file=bright_star_file)
+            stage["rows"] = len(ok_ucac_mags) + len(star_idx)
+    return correlation
+
+def _dataset_bytes(butler, datasetTypes, **dataId):
+    """Total size of the files behind some butler datasets, or None if any of
+    them can not be found.
+    """
+    total = 0
+    for datasetType in datasetTypes:
+        try:
+            filename = butler.get(datasetType + "_filename", **dataId)[0]
+            total += os.path.getsize(filename)
+        except (RuntimeError, OSError):
+            return None
+    return total
+
+def write_correlation(correlation, sql_session=None, writer=None, bright_star_file=None):
+    """Store the output of `star_diffim_correlation`.
+
+    Parameters
+    ----------
+    correlation : dict
+        Holds the `visit` and `ccdnum`, the per-star arrays `source_ra`,
+        `source_dec` and `source_mags`, and the per-pair arrays `star_idx`
+        (sorted), `dists` (arcseconds) and `SNRs`.
+
+    sql_session : sqlalchemy.orm.Session, optional
+        Adds ORM objects for each star to this session.
+
+    writer : BulkCorrelationWriter, optional
+        Writes the rows through the bulk writer.
 
-        if sql_session:
-            det_dists = [DetectionDist(dist=d.to(u.arcsec).value, SNR=SNR) for d,SNR in zip(dists[sel], filtered_SNRs[sel])]
+    bright_star_file : file, optional
+        Open file to append stars brighter than 9th magnitude to. With a
+        `writer` that has a ``bright_star_path``, they are written by the
+        writer instead, when the rows of the CCD are.
+    """
+    visit = correlation["visit"]
+    ccdnum = correlation["ccdnum"]
+    source_mags = correlation["source_mags"]
+
+    bright_stars = ["{},{},{},{},{}".format(correlation["source_ra"][n], correlation["source_dec"][n],
+                                            source_mags[n], visit, ccdnum)
+                    for n in np.flatnonzero(source_mags < 9)]
+    if bright_star_file:
+        for line in bright_stars:
+            print(line, file=bright_star_file)
+
+    if sql_session:
+        star_bounds = np.searchsorted(correlation["star_idx"], np.arange(len(source_mags) + 1))
+        for n, ucac_mag in enumerate(source_mags):
+            start, end = star_bounds[n], star_bounds[n + 1]
+            det_dists = [DetectionDist(dist=d, SNR=SNR) for d,SNR in zip(correlation["dists"][start:end],
+                                                                          correlation["SNRs"][start:end])]
             sql_entry = SourceDetectionCorrelation(visit=visit, ccdnum=ccdnum, source_mag=ucac_mag,
                                                    detection_dists=det_dists)
             sql_session.add(sql_entry)
-    bright_star_file.close()
+
+    if writer:
+        writer.add_ccd(visit, ccdnum, source_mags, correlation["star_idx"], correlation["dists"],
+                       correlation["SNRs"], bright_stars=bright_stars)
 
 def run_debug(session):
     """This function saves example sources and diffim source distances to the database, then retrieves them.
@@ -234,35 +887,538 @@ def run_debug(session):
     print(session.query(SourceDetectionCorrelation).first().detection_dists)
     print(session.query(SourceDetectionCorrelation).first().dist_array())
 
+def run_correlation_benchmark(n_stars=300, n_detections=20000, field_radius=0.15, seed=1234):
+    """Times `correlate_detections` against the per-star separation loop on a
+    synthetic field, and checks that both find the same pairs.
+    """
+    import time
+
+    rng = np.random.RandomState(seed)
+    def random_field(n):
+        return coord.SkyCoord(ra=150.0 + (rng.rand(n) - 0.5)*2*field_radius,
+                              dec=2.0 + (rng.rand(n) - 0.5)*2*field_radius,
+                              unit=(u.deg, u.deg), frame="icrs")
+    stars = random_field(n_stars)
+    detections = random_field(n_detections)
+
+    start = time.time()
+    loop_star_idx, loop_det_idx, _ = _correlate_detections_per_star(stars, detections)
+    loop_time = time.time() - start
+
+    start = time.time()
+    star_idx, det_idx, _ = correlate_detections(stars, detections)
+    vector_time = time.time() - start
+
+    assert np.array_equal(loop_star_idx, star_idx), "Star indices differ between methods."
+    assert (set(zip(loop_star_idx, loop_det_idx)) == set(zip(star_idx, det_idx))), "Pairs differ between methods."
+
+    print("{:d} stars, {:d} detections, {:d} pairs".format(n_stars, n_detections, len(star_idx)))
+    print("Per-star loop: {:.3f} s".format(loop_time))
+    print("Vectorized:    {:.3f} s ({:.1f}x)".format(vector_time, loop_time/vector_time))
+
+    # The shift and edge test each used to do their own match_to_catalog_sky.
+    sources = random_field(n_detections//5)
+    start = time.time()
+    for n in range(2):
+        sky_idx, _, _ = stars.match_to_catalog_sky(sources)
+    sky_time = time.time() - start
+
+    start = time.time()
+    idx, _ = match_to_image_sources(stars, sources)
+    match_time = time.time() - start
+
+    assert np.array_equal(sky_idx, idx), "Matches differ between methods."
+    print("Two sky matches: {:.3f} s".format(sky_time))
+    print("Shared match:    {:.3f} s ({:.1f}x)".format(match_time, sky_time/match_time))
+
+def run_bulk_insert_benchmark(n_stars=20000, dists_per_star=20, seed=1234):
+    """Compares the insert rate of the ORM path with `BulkCorrelationWriter`,
+    using in-memory sqlite databases as in `run_debug`.
+    """
+    import time
+
+    rng = np.random.RandomState(seed)
+    source_mags = 8 + 8*rng.rand(n_stars)
+    star_idx = np.repeat(np.arange(n_stars), dists_per_star)
+    dists = 60*rng.rand(len(star_idx))
+    SNRs = 5 + 10*rng.rand(len(star_idx))
+    n_rows = n_stars + len(star_idx)
+    star_bounds = np.searchsorted(star_idx, np.arange(n_stars + 1))
+
+    def make_engine():
+        engine = sqlalchemy.create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        return engine
+
+    engine = make_engine()
+    session = sessionmaker(bind=engine)()
+    start = time.time()
+    for n, mag in enumerate(source_mags):
+        begin, end = star_bounds[n], star_bounds[n + 1]
+        det_dists = [DetectionDist(dist=d, SNR=SNR) for d, SNR in zip(dists[begin:end], SNRs[begin:end])]
+        session.add(SourceDetectionCorrelation(visit=1234, ccdnum=10, source_mag=mag,
+                                               detection_dists=det_dists))
+    session.commit()
+    orm_time = time.time() - start
+    session.close()
+
+    engine = make_engine()
+    start = time.time()
+    writer = BulkCorrelationWriter(engine)
+    writer.add_ccd(1234, 10, source_mags, star_idx, dists, SNRs)
+    writer.flush()
+    bulk_time = time.time() - start
+
+    with engine.connect() as conn:
+        n_written = (conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(DetectionDist.__table__)).scalar() +
+                     conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(SourceDetectionCorrelation.__table__)).scalar())
+    assert n_written == n_rows, "Bulk writer did not write all rows."
+
+    print("{:d} rows ({:d} stars, {:d} distances)".format(n_rows, n_stars, len(star_idx)))
+    print("ORM:         {:.0f} rows/s".format(n_rows/orm_time))
+    print("Bulk writer: {:.0f} rows/s ({:.1f}x)".format(n_rows/bulk_time, orm_time/bulk_time))
+
+def run_prefetch_benchmark(n_ccds=16, read_latency=0.02, query_latency=0.05, visit=197367):
+    """Compares loading and correlating CCDs in turn with prefetching their
+    inputs, on the synthetic sky of ``benchmark_suite.py``. Each butler read
+    and reference catalog query is delayed to stand in for disk and network
+    latency.
+    """
+    import time
+    from benchmark_suite import SyntheticSky, SyntheticButler, SyntheticRefcat, Quiet
+
+    class SlowButler(SyntheticButler):
+        def get(self, *args, **kwargs):
+            time.sleep(read_latency)
+            return SyntheticButler.get(self, *args, **kwargs)
+
+    class SlowRefcat(SyntheticRefcat):
+        def query_cone(self, *args, **kwargs):
+            time.sleep(query_latency)
+            return SyntheticRefcat.query_cone(self, *args, **kwargs)
+
+    sky = SyntheticSky(stars_per_ccd=1000, sources_per_ccd=20000, dia_sources_per_ccd=10000)
+    tasks = [(visit, ccdnum) for ccdnum in range(1, n_ccds + 1)]
+    print("{:d} CCDs, {:.2f} s per butler read, {:.2f} s per reference catalog query".format(
+          n_ccds, read_latency, query_latency))
+    for prefetch_depth, load_threads in [(0, 1), (2, 1), (8, 8)]:
+        records = []
+        start = time.time()
+        with Quiet():
+            for result in iter_correlation_results(tasks, SlowButler(sky), refcat=SlowRefcat(sky), use_wcs=False,
+                                                   prefetch_depth=prefetch_depth, load_threads=load_threads):
+                assert result["status"] == "ok", result["error"]
+                records.extend(result["timings"])
+        print("Prefetch {:d}, {:d} load threads: {:.2f} s. ".format(prefetch_depth, load_threads,
+                                                                    time.time() - start), end="")
+        print_io_overlap_report(records)
+
+#
+# Parallel driver. Each worker process holds its own butler and reference
+# catalog, and returns plain arrays; the parent process is the only one that
+# writes to the database and to the bright star file.
+#
+_worker_butler = None
+_worker_refcat = None
+_worker_candidates_dir = None
+_worker_star_density = None
+_worker_prefetch = 0
+_worker_load_threads = 1
+
+def make_refcat(refcat_cache=None, offline=False):
+    if refcat_cache:
+        backend = None if offline else VizierReferenceCatalog(row_limit=-1)
+        return HealpixCatalogCache(refcat_cache, backend=backend)
+    return VizierReferenceCatalog()
+
+def _init_worker(repo, refcat_cache, offline, candidates_dir=None, star_density_dir=None, prefetch_depth=0,
+                 load_threads=1):
+    global _worker_butler, _worker_refcat, _worker_candidates_dir, _worker_star_density
+    global _worker_prefetch, _worker_load_threads
+    import lsst.daf.persistence as dafPersist
+    _worker_butler = dafPersist.Butler(repo)
+    _worker_refcat = make_refcat(refcat_cache, offline)
+    _worker_candidates_dir = candidates_dir
+    _worker_star_density = StarDensityMap(star_density_dir) if star_density_dir else None
+    _worker_prefetch = prefetch_depth
+    _worker_load_threads = load_threads
+
+def iter_correlation_inputs(tasks, butler, refcat=None, candidates_dir=None, use_wcs=True):
+    """Load the inputs of each (visit, ccdnum) in turn with
+    `load_correlation_inputs`.
+
+    Never raises; a failure is reported through the traceback it yields.
+
+    Yields
+    ------
+    visit, ccdnum : int
+    inputs : dict or None
+    error : str or None
+    timer : StageTimer
+        The load stages of the task.
+    """
+    for visit, ccdnum in tasks:
+        timer = StageTimer(visit=visit, ccdnum=ccdnum)
+        inputs = None
+        error = None
+        try:
+            inputs = load_correlation_inputs(visit, ccdnum, butler, refcat=refcat, candidates_dir=candidates_dir,
+                                             use_wcs=use_wcs, timer=timer)
+        except Exception:
+            error = traceback.format_exc()
+        yield visit, ccdnum, inputs, error, timer
+
+def _iter_inputs_concurrently(tasks, butler, refcat=None, candidates_dir=None, use_wcs=True, load_threads=4,
+                              prefetch_depth=4):
+    """Like `iter_correlation_inputs`, in the same order, with the inputs of
+    up to `prefetch_depth` tasks ahead being loaded by a pool of
+    `load_threads` threads.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def load(task):
+        return next(iter_correlation_inputs([task], butler, refcat=refcat, candidates_dir=candidates_dir,
+                                            use_wcs=use_wcs))
+
+    pool = ThreadPool(load_threads)
+    pending = collections.deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(load, (task,)))
+            if len(pending) > prefetch_depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def iter_correlation_results(tasks, butler, refcat=None, candidates_dir=None, star_density=None, use_wcs=True,
+                             prefetch_depth=0, load_threads=1):
+    """Correlate each (visit, ccdnum), with the inputs of up to
+    `prefetch_depth` following tasks loaded in a background thread while the
+    current one is computed (and, as this is a generator, while the caller
+    writes it out).
+
+    Prefetching in one thread can hide at most the compute time. When loading
+    takes longer, mostly waiting on disk or network latency, `load_threads`
+    > 1 loads several tasks at once; `butler` and `refcat` must then be safe
+    to use from several threads. `VizierReferenceCatalog` and
+    `HealpixCatalogCache` are.
+
+    The time spent waiting for the inputs of each task is recorded as an
+    ``io_wait`` stage; without prefetching it is the whole load time, and with
+    it, the part of the load time that was not hidden behind computation.
+    `butler` and `refcat` are only used by the loading thread.
+
+    Never raises; failures are reported through the returned status.
+
+    Yields
+    ------
+    result : dict
+        ``visit``, ``ccdnum``, ``status``, ``elapsed`` (the load and compute
+        time of the task), ``error``, ``correlation``, and ``timings`` (the
+        stage records of the task).
+    """
+    if load_threads > 1:
+        loaded = _iter_inputs_concurrently(tasks, butler, refcat=refcat, candidates_dir=candidates_dir,
+                                           use_wcs=use_wcs, load_threads=load_threads,
+                                           prefetch_depth=prefetch_depth)
+    else:
+        loaded = iter_correlation_inputs(tasks, butler, refcat=refcat, candidates_dir=candidates_dir,
+                                         use_wcs=use_wcs)
+        if prefetch_depth > 0:
+            loaded = prefetch(loaded, maxsize=prefetch_depth)
+
+    while True:
+        start = time.time()
+        try:
+            visit, ccdnum, inputs, error, timer = next(loaded)
+        except StopIteration:
+            return
+        timer.add({"visit": visit, "ccdnum": ccdnum, "stage": "io_wait", "wall": time.time() - start})
+
+        start = time.time()
+        correlation = None
+        if error is not None:
+            status = "failed"
+        elif inputs is None:
+            status = "no_data"
+        else:
+            try:
+                correlation = correlate_inputs(inputs, timer=timer, star_density=star_density)
+                status = "ok"
+            except Exception:
+                status = "failed"
+                error = traceback.format_exc()
+        elapsed = sum(timer.total(stage) for stage in LOAD_STAGES) + time.time() - start
+        timer.add({"visit": visit, "ccdnum": ccdnum, "stage": "task", "wall": elapsed, "status": status})
+        yield {"visit": visit, "ccdnum": ccdnum, "status": status, "elapsed": elapsed,
+               "error": error, "correlation": correlation, "timings": timer.records}
+
+def _correlate_tasks(tasks):
+    """Runs `star_diffim_correlation` for a chunk of (visit, ccdnum) in a
+    worker, prefetching the inputs of the next tasks of the chunk.
+    """
+    return list(iter_correlation_results(tasks, _worker_butler, refcat=_worker_refcat,
+                                         candidates_dir=_worker_candidates_dir, star_density=_worker_star_density,
+                                         prefetch_depth=_worker_prefetch, load_threads=_worker_load_threads))
+
+def print_io_overlap_report(records):
+    """Summarize how much of the load time of the tasks in `records` was
+    spent waiting, rather than hidden behind computation.
+    """
+    totals = dict((summary["stage"], summary["total"]) for summary in stage_report(records))
+    load = sum(totals.get(stage, 0.0) for stage in LOAD_STAGES)
+    compute = totals.get("task", 0.0) - load
+    io_wait = totals.get("io_wait", 0.0)
+    hidden = 1 - io_wait/load if load > 0 else 0.0
+    print("Load {:.2f} s, compute {:.2f} s, I/O wait {:.2f} s ({:.0%} of the load time hidden)".format(
+          load, compute, io_wait, max(hidden, 0.0)))
+
+def correlation_inputs(butler, visit, ccdnum, candidates_dir=None, use_hash=False, previous=None):
+    """Fingerprints (see `run_manifest`) of the files `star_diffim_correlation`
+    reads for one CCD.
+    """
+    dataId = {"visit": visit, "ccdnum": ccdnum}
+    datasets = ["src", "calexp"]
+    if candidates_dir is None:
+        datasets += ["deepDiff_diaSrc", "forced_src"]
+    inputs = dataset_fingerprints(butler, [(datasetType, datasetType, dataId) for datasetType in datasets],
+                                  use_hash=use_hash, previous=previous)
+    if candidates_dir is not None:
+        inputs["candidates"] = file_fingerprint(candidates_path(candidates_dir, visit), use_hash=use_hash,
+                                                previous=(previous or {}).get("candidates"))
+        inputs["candidate_ccds"] = file_fingerprint(candidate_ccds_path(candidates_dir, visit), use_hash=use_hash,
+                                                    previous=(previous or {}).get("candidate_ccds"))
+    return inputs
+
+def plan_correlation_reruns(engine, butler, manifest, tasks, bright_star_path="bright_star_file",
+                            candidates_dir=None):
+    """Select the tasks whose inputs are new or changed since the manifest was
+    written, or whose status or number of stars in the database (see
+    `ccd_outputs`) no longer match the manifest, and remove the outputs that
+    are about to be recomputed or whose inputs were removed, from both the
+    database and the bright star file.
+
+    Outputs are also removed for new tasks, since databases written without a
+    manifest may already hold rows for them.
+
+    Returns
+    -------
+    todo : list of (visit, ccdnum)
+    inputs : dict
+        Input fingerprints of each task in `todo`, to record in the manifest
+        once it is done.
+    """
+    def fingerprint(dataId, previous):
+        return correlation_inputs(butler, dataId["visit"], dataId["ccdnum"], candidates_dir=candidates_dir,
+                                  use_hash=manifest.use_hash, previous=previous)
+
+    outputs = ccd_outputs(engine)
+
+    def outputs_current(dataId, recorded):
+        return outputs.get((dataId["visit"], dataId["ccdnum"])) == {"status": "ok",
+                                                                    "n_stars": recorded.get("n_stars")}
+
+    plan = plan_units(manifest, [{"visit": visit, "ccdnum": ccdnum} for visit, ccdnum in tasks], fingerprint,
+                      outputs_current=outputs_current)
+    print(plan_report(plan, manifest))
+
+    inputs = dict(((dataId["visit"], dataId["ccdnum"]), this_inputs)
+                  for dataId, this_inputs in plan["new"] + plan["changed"])
+    stale = list(inputs) + [(dataId["visit"], dataId["ccdnum"]) for dataId in plan["invalidated"]]
+    n_deleted = delete_ccd_rows(engine, stale)
+    n_removed = remove_bright_stars(bright_star_path, stale)
+    for dataId in plan["invalidated"]:
+        manifest.remove(dataId)
+    manifest.save()
+    print("Removed {:d} stars and {:d} bright stars of {:d} stale CCDs".format(n_deleted, n_removed, len(stale)))
+    return [task for task in tasks if task in inputs], inputs
+
+def run_correlation_tasks(tasks, repo, writer, jobs=1,
+                          refcat_cache=None, offline=False, candidates_dir=None, timer=None,
+                          star_density_dir=None, prefetch_depth=2, load_threads=1, chunk_size=8):
+    """Run `star_diffim_correlation` over many (visit, ccdnum) pairs.
+
+    Parameters
+    ----------
+    tasks : list of (visit, ccdnum)
+        CCDs to process.
+
+    repo : str
+        Butler repository; each worker opens its own butler on it.
+
+    writer : BulkCorrelationWriter
+        Receives all correlations, per-task statuses and, if it has a
+        ``bright_star_path``, bright stars.
+
+    jobs : int
+        Number of worker processes. With 1, tasks run in this process.
+
+    candidates_dir : str, optional
+        Directory of ``forced_src_filter.py`` candidate files to read the
+        filtered diffim sources from.
+
+    timer : StageTimer, optional
+        Receives the stage timings of every task, and of the database writes.
+
+    star_density_dir : str, optional
+        ``star_density.py`` index to look up the expected star density of
+        each CCD in.
+
+    prefetch_depth : int
+        Number of tasks whose inputs are loaded ahead, in a background
+        thread, while the current task is computed (see
+        `iter_correlation_results`). 0 to load and compute in turn.
+
+    load_threads : int
+        Number of threads loading inputs at once.
+
+    chunk_size : int
+        With several jobs, each worker is given this many consecutive tasks
+        at a time, so it has tasks to prefetch.
+
+    Returns
+    -------
+    task_results : list of dict
+        Status, timing and any error traceback of every task.
+    """
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker,
+                                    initargs=(repo, refcat_cache, offline, candidates_dir, star_density_dir,
+                                              prefetch_depth, load_threads))
+        chunks = [tasks[n:(n + chunk_size)] for n in range(0, len(tasks), chunk_size)]
+        results = (result for chunk_results in pool.imap_unordered(_correlate_tasks, chunks)
+                   for result in chunk_results)
+    else:
+        pool = None
+        _init_worker(repo, refcat_cache, offline, candidates_dir, star_density_dir)
+        results = iter_correlation_results(tasks, _worker_butler, refcat=_worker_refcat,
+                                           candidates_dir=candidates_dir, star_density=_worker_star_density,
+                                           prefetch_depth=prefetch_depth, load_threads=load_threads)
+
+    if timer is None:
+        timer = StageTimer()
+
+    task_results = []
+    for result in results:
+        print("visit {:d} ccdnum {:d}: {:s} in {:.1f} s".format(result["visit"], result["ccdnum"],
+                                                                result["status"], result["elapsed"]))
+        if result["error"]:
+            print(result["error"])
+        for record in result.pop("timings"):
+            timer.add(record)
+        with timer.stage("write") as stage:
+            stage.update(visit=result["visit"], ccdnum=result["ccdnum"])
+            correlation = result.pop("correlation")
+            if correlation is not None:
+                write_correlation(correlation, writer=writer)
+                stage["rows"] = len(correlation["source_mags"]) + len(correlation["star_idx"])
+            writer.add_status(result["visit"], result["ccdnum"], result["status"], result["elapsed"],
+                              correlation=correlation)
+        task_results.append(result)
+    with timer.stage("flush"):
+        writer.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return task_results
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action='store_true', help="Enable debugging")
-    parser.add_argument("repo", help="Repository for images")
-    parser.add_argument("visits", help="VisitIDs to process", type=int, nargs="+")
+    parser.add_argument("--benchmark", action='store_true',
+                        help="Benchmark the star/diasource correlation and database writes on synthetic data")
+    parser.add_argument("repo", nargs="?", help="Repository for images")
+    parser.add_argument("visits", help="VisitIDs to process", type=int, nargs="*")
+    parser.add_argument("--refcat-cache", help="Directory of a local HEALPix reference catalog cache",
+                        default=None)
+    parser.add_argument("--offline", action='store_true',
+                        help="Only use the local reference catalog cache, never query Vizier")
+    parser.add_argument("--candidates-dir", default=None,
+                        help="Read filtered diffim sources from forced_src_filter.py candidate files here")
+    parser.add_argument("--timing-log", default="star_diffim_timing.jsonl",
+                        help="Append per-stage timings to this JSON lines file")
+    parser.add_argument("--star-density", default=None,
+                        help="star_density.py index to look up the expected star density of each CCD in")
+    parser.add_argument("--manifest", default=None,
+                        help="Run manifest; only rerun CCDs whose inputs changed since they were recorded in it")
+    parser.add_argument("--hash-inputs", action='store_true',
+                        help="Compare manifest inputs by content hash, not just size and mtime")
+    parser.add_argument("--jobs", "-j", help="Number of worker processes", type=int, default=1)
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="Number of CCDs to load ahead of the one being correlated (0 to disable)")
+    parser.add_argument("--load-threads", type=int, default=1,
+                        help="Number of threads loading CCDs at once, for high latency storage or Vizier queries. "
+                             "They share one butler, which must be safe to use from several threads, and one "
+                             "reference catalog (Vizier queries and the --refcat-cache cache are)")
     parser.add_argument("--nccds", help="Maximum number of CCDS to process (for debugging, by default 62)",
                         type=int, action="store", default=62)
     args = parser.parse_args()
 
-    if args.debug:
+    if not (args.debug or args.benchmark) and (args.repo is None or not args.visits):
+        parser.error("repo and visits are required")
+
+    if args.debug or args.benchmark:
         engine = sqlalchemy.create_engine('sqlite://')
     else:
         engine = sqlalchemy.create_engine('sqlite:///star_diffim.sqlite3')
+        enable_sqlite_wal(engine)
 
     SessionFactory = sessionmaker()
     SessionFactory.configure(bind=engine)
     session = SessionFactory()
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
 
-    if args.debug:
+    if args.benchmark:
+        run_correlation_benchmark()
+        run_prefetch_benchmark()
+        run_bulk_insert_benchmark()
+    elif args.debug:
         run_debug(session)
     else:
-        import lsst.daf.persistence as dafPersist
-        butler = dafPersist.Butler(args.repo)
-        for visit in args.visits:
-            for ccdnum in range(1,args.nccds + 1):
-                print("------------")
-                print("visit {:d} ccdnum: {:d}".format(visit, ccdnum))
-                star_diffim_correlation(visit, ccdnum, butler, sql_session=session)
-                session.commit()
-
+        if args.offline and not args.refcat_cache:
+            parser.error("--offline requires --refcat-cache")
+
+        tasks = [(visit, ccdnum) for visit in args.visits for ccdnum in range(1, args.nccds + 1)]
+        if args.manifest:
+            import lsst.daf.persistence as dafPersist
+            manifest = RunManifest(args.manifest, use_hash=args.hash_inputs)
+            todo, task_inputs = plan_correlation_reruns(engine, dafPersist.Butler(args.repo), manifest, tasks,
+                                                        candidates_dir=args.candidates_dir)
+        else:
+            done = completed_ccds(engine)
+            todo = [task for task in tasks if task not in done]
+            print("{:d} of {:d} CCDs already in the database, skipping them.".format(len(tasks) - len(todo),
+                                                                                      len(tasks)))
+
+        writer = BulkCorrelationWriter(engine, bright_star_path="bright_star_file")
+        with open(args.timing_log, "a") as timing_log:
+            timer = StageTimer(stream=timing_log)
+            task_results = run_correlation_tasks(todo, args.repo, writer, jobs=args.jobs,
+                                                 refcat_cache=args.refcat_cache, offline=args.offline,
+                                                 candidates_dir=args.candidates_dir, timer=timer,
+                                                 star_density_dir=args.star_density, prefetch_depth=args.prefetch,
+                                                 load_threads=args.load_threads)
+
+        if args.manifest:
+            outputs = ccd_outputs(engine)
+            for result in task_results:
+                ccd = (result["visit"], result["ccdnum"])
+                if result["status"] == "ok" and ccd in outputs:
+                    manifest.record({"visit": result["visit"], "ccdnum": result["ccdnum"]}, task_inputs[ccd],
+                                    dict(outputs[ccd], elapsed=result["elapsed"]))
+            manifest.save()
+
+        for status in ("ok", "no_data", "failed"):
+            elapsed = [r["elapsed"] for r in task_results if r["status"] == status]
+            if elapsed:
+                print("{:s}: {:d} CCDs, {:.1f} s total, {:.1f} s median".format(status, len(elapsed),
+                                                                              np.sum(elapsed),
+                                                                              np.median(elapsed)))
+        print_stage_report(timer.records)
+        print_io_overlap_report(timer.records)